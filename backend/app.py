@@ -1,66 +1,241 @@
+import time
+
+_boot_started = time.perf_counter()
+
+import asyncio
+import os
+import sys
 from sanic import Sanic
+from sanic.response import json as sanic_json, text
 from sanic_cors import CORS
+from tortoise import Tortoise, connections
 from tortoise.contrib.sanic import register_tortoise
-from views import api
-from utils import get_env_config, get_database_url, logger
+from views import api, agent_handler
+from utils import get_env_config, get_database_url, logger, json_dumps_bytes, startup_timer
 from models import Agent, MCPServer
+from metrics import registry as metrics_registry, LOG_QUEUE_SIZE
+from log_pipeline import normalize_request_id, set_request_id, logging_stats
+from loop_monitor import loop_monitor, loop_monitor_enabled
+from stdio_pool import stdio_pools
+from stream_log import stream_logs
+from worker_route import worker_router, WORKER_INDEX
+from replay import session_recorder
+
+startup_timer.record("imports", (time.perf_counter() - _boot_started) * 1000)
 
-# 创建 Sanic 应用
-app = Sanic("ai-agents-api")
+TORTOISE_MODULES = {"models": ["models"]}
+
+# 创建 Sanic 应用；日志统一走 log_pipeline 的队列，不使用 Sanic 自带的同步 handler
+app = Sanic("ai-agents-api", dumps=json_dumps_bytes, configure_logging=False)
 
 # 配置 CORS
 CORS(app, resources={
     r"/api/*": {
         "origins": ["http://localhost:3000", "http://localhost:5173"],
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"]
+        "allow_headers": ["Content-Type", "Authorization", "If-None-Match", "X-Request-Id", "Last-Event-ID"],
+        "expose_headers": ["ETag", "X-Next-Cursor", "X-Trace-Id", "X-Request-Id", "X-Stream-Id"]
     }
 })
 
 # 注册蓝图
 app.blueprint(api)
 
-# 配置数据库
+@app.on_request
+async def assign_request_id(request):
+    """沿用客户端的 X-Request-Id 或生成新的，写入上下文供日志与上游请求使用"""
+    request.ctx.request_id = normalize_request_id(request.headers.get("x-request-id"))
+    set_request_id(request.ctx.request_id)
+
+@app.on_response
+async def expose_request_id(request, response):
+    request_id = getattr(request.ctx, "request_id", None)
+    if request_id:
+        response.headers["X-Request-Id"] = request_id
+
+async def seed_defaults():
+    """写入初始数据（幂等）"""
+    # MCP 工具管理已移除 - 现在由独立的 MCP 服务器处理
+
+    # 创建默认的 MCP 服务器（如果不存在）
+    _, created = await MCPServer.get_or_create(
+        name="time_server",
+        defaults={
+            "description": "时间工具服务器(HTTP)",
+            "api_url": "http://127.0.0.1:8000",  # 使用 HTTP 协议，SSE 默认端口
+            "is_active": True,
+        },
+    )
+    if created:
+        logger.info("创建默认 MCP 服务器: time_server")
+
+    # 不再自动创建默认 Agent - 让用户手动创建
+
+async def prepare_database(generate_schemas: bool, seed: bool):
+    """建表与初始数据写入，每次部署只需执行一次"""
+    await Tortoise.init(db_url=get_database_url(), modules=TORTOISE_MODULES)
+    try:
+        if generate_schemas:
+            with startup_timer.phase("generate_schemas"):
+                await Tortoise.generate_schemas(safe=True)
+        if seed:
+            with startup_timer.phase("seed"):
+                await seed_defaults()
+    finally:
+        await connections.close_all()
+
+@app.main_process_start
+async def init_data(app, loop):
+    """初始化数据 - 仅在主进程执行一次，不随 worker 数量重复"""
+    config = get_env_config()
+    if not (config["GENERATE_SCHEMAS"] or config["SEED_DEFAULTS"]):
+        logger.info("快速启动：跳过建表与初始数据写入")
+        return
+    try:
+        await prepare_database(config["GENERATE_SCHEMAS"], config["SEED_DEFAULTS"])
+        logger.info("系统启动完成，等待用户创建 Agent")
+    except Exception as e:
+        logger.error("初始化数据失败: %s", e)
+    # 建表与初始数据只在主进程执行，worker 的启动报告中没有这两个阶段，在这里单独输出
+    startup_timer.log_report(f"主进程 {os.getpid()} 启动耗时")
+
+@app.before_server_start
+async def orm_init_started(app, loop):
+    app.ctx.orm_init_started = time.perf_counter()
+
+# 配置数据库（建表由 init_data 在主进程按需执行）
 register_tortoise(
     app,
     db_url=get_database_url(),
-    modules={"models": ["models"]},
-    generate_schemas=True,
+    modules=TORTOISE_MODULES,
+    generate_schemas=False,
 )
 
 @app.before_server_start
-async def init_data(app, loop):
-    """初始化数据"""
+async def orm_init_finished(app, loop):
+    startup_timer.record("orm_init", (time.perf_counter() - app.ctx.orm_init_started) * 1000)
+
+async def _warmup_once(app) -> bool:
+    """执行一次预热并记录结果；超时或出错时 ok=False 并保留错误信息，就绪检查据此返回 503"""
+    started = time.perf_counter()
+    error = None
     try:
-        # MCP 工具管理已移除 - 现在由独立的 MCP 服务器处理
-        
-        # 创建默认的 MCP 服务器（如果不存在）
-        default_server = await MCPServer.filter(name="time_server").first()
-        if not default_server:
-            await MCPServer.create(
-                name="time_server",
-                description="时间工具服务器(HTTP)",
-                api_url="http://127.0.0.1:8000",  # 使用 HTTP 协议，SSE 默认端口
-                is_active=True
-            )
-            logger.info("创建默认 MCP 服务器: time_server")
-
-        # 不再自动创建默认 Agent - 让用户手动创建
-        logger.info("系统启动完成，等待用户创建 Agent")
-            
+        await asyncio.wait_for(agent_handler.warmup(), timeout=get_env_config()["WARMUP_TIMEOUT"])
+    except asyncio.TimeoutError:
+        error = "预热超时"
+        logger.warning("Worker 预热超时")
     except Exception as e:
-        logger.error(f"初始化数据失败: {str(e)}")
+        error = f"预热失败: {e}"
+        logger.error("Worker 预热失败: %s", e)
+    duration_ms = (time.perf_counter() - started) * 1000
+    app.ctx.warmup.update(
+        done=True, ok=error is None, error=error,
+        attempts=app.ctx.warmup["attempts"] + 1, duration_ms=round(duration_ms, 1),
+    )
+    return error is None
+
+@app.before_server_start
+async def load_replay_index(app, loop):
+    """回放模式下在线程中预先加载录制索引（须在预热之前：预热会读取录制中的 MCP 服务器）"""
+    await session_recorder.load()
+
+@app.before_server_start
+async def warmup(app, loop):
+    """Worker 预热：建立上游连接池、预取工具目录与 Agent 配置，成功后才报告就绪"""
+    app.ctx.warmup = {"done": False, "ok": False, "error": None, "attempts": 0, "pid": os.getpid()}
+    started = time.perf_counter()
+    await _warmup_once(app)
+    startup_timer.record("warmup", (time.perf_counter() - started) * 1000)
+    app.ctx.warmup["startup"] = startup_timer.report()
+    startup_timer.log_report(f"Worker {os.getpid()} 启动耗时")
+
+@app.after_server_start
+async def retry_warmup(app, loop):
+    """启动时预热未成功的 worker 每隔 WARMUP_RETRY_INTERVAL 秒重试，直到成功后才报告就绪"""
+    if app.ctx.warmup["ok"]:
+        return
+    interval = get_env_config()["WARMUP_RETRY_INTERVAL"]
+    if interval <= 0:
+        return
+
+    async def retry():
+        while True:
+            await asyncio.sleep(interval)
+            if await _warmup_once(app):
+                logger.info("Worker %s 第 %s 次预热成功", os.getpid(), app.ctx.warmup["attempts"])
+                return
+
+    app.add_task(retry(), name="warmup_retry")
+
+@app.after_server_start
+async def start_loop_monitor(app, loop):
+    """每个 worker 启动事件循环延迟监控（LOOP_MONITOR=0 关闭）"""
+    if loop_monitor_enabled():
+        loop_monitor.start()
+
+@app.after_server_start
+async def start_worker_router(app, loop):
+    """多 worker 时启动内部路由端口，把任务与流的后续请求转交给所属 worker"""
+    await worker_router.start(get_env_config())
+
+@app.before_server_stop
+async def stop_worker_router(app, loop):
+    await worker_router.close()
+
+@app.before_server_stop
+async def stop_loop_monitor(app, loop):
+    await loop_monitor.stop()
+
+@app.before_server_stop
+async def stop_jobs(app, loop):
+    """取消执行中的异步任务"""
+    await agent_handler.jobs.close()
+
+@app.before_server_stop
+async def stop_streams(app, loop):
+    """取消仍在后台生成的 SSE 流"""
+    await stream_logs.close()
+
+@app.before_server_stop
+async def stop_stdio_pools(app, loop):
+    """关闭 stdio MCP 服务器的常驻子进程"""
+    await stdio_pools.close_all()
 
 @app.route("/")
 async def root(request):
     """根路径"""
-    return {"message": "AI Agents API 服务正在运行", "version": "1.0.0"}
+    return sanic_json({"message": "AI Agents API 服务正在运行", "version": "1.0.0"})
+
+# 多 worker 共用端口时每次抓取由任意一个 worker 响应，样本带 worker 标签以区分各 worker 的序列
+if WORKER_INDEX is not None:
+    metrics_registry.set_const_label("worker", str(WORKER_INDEX))
+
+@app.route("/metrics")
+async def metrics(request):
+    """Prometheus 指标（当前 worker，见 metrics.py 中多 worker 的说明）"""
+    LOG_QUEUE_SIZE.set(logging_stats()["queue_size"])
+    return text(metrics_registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
 if __name__ == "__main__":
     config = get_env_config()
-    app.run(
-        host="0.0.0.0",
-        port=8001,
-        debug=True,
-        auto_reload=True
-    )
+    if len(sys.argv) > 1 and sys.argv[1] == "init-db":
+        # 部署时执行一次：python app.py init-db，之后可用 FAST_START=1 启动
+        asyncio.run(prepare_database(generate_schemas=True, seed=True))
+        startup_timer.log_report("数据库初始化耗时")
+    elif config["APP_MODE"] == "production":
+        # 生产模式：多 worker，关闭调试、自动重载与访问日志
+        app.run(
+            host=config["HOST"],
+            port=config["PORT"],
+            workers=max(1, config["WORKERS"]),
+            debug=False,
+            auto_reload=False,
+            access_log=False
+        )
+    else:
+        app.run(
+            host=config["HOST"],
+            port=config["PORT"],
+            debug=True,
+            auto_reload=True
+        )
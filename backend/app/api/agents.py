@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from typing import List, Dict, Any
 from pydantic import BaseModel
@@ -23,13 +24,13 @@ class AgentUpdate(BaseModel):
     openai_config: Dict[str, Any] = None
 
 @router.get("/", response_model=List[Dict[str, Any]])
-async def list_agents(db: Session = Depends(get_db)):
+def list_agents(db: Session = Depends(get_db)):
     """获取所有 Agent"""
     agents = db.query(Agent).all()
     return [agent.to_dict() for agent in agents]
 
 @router.post("/", response_model=Dict[str, Any])
-async def create_agent(agent_data: AgentCreate, db: Session = Depends(get_db)):
+def create_agent(agent_data: AgentCreate, db: Session = Depends(get_db)):
     """创建新的 Agent"""
     agent = Agent(
         name=agent_data.name,
@@ -46,7 +47,7 @@ async def create_agent(agent_data: AgentCreate, db: Session = Depends(get_db)):
     return agent.to_dict()
 
 @router.get("/{agent_id}", response_model=Dict[str, Any])
-async def get_agent(agent_id: int, db: Session = Depends(get_db)):
+def get_agent(agent_id: int, db: Session = Depends(get_db)):
     """获取指定 Agent"""
     agent = db.query(Agent).filter(Agent.id == agent_id).first()
     if not agent:
@@ -55,7 +56,7 @@ async def get_agent(agent_id: int, db: Session = Depends(get_db)):
     return agent.to_dict()
 
 @router.put("/{agent_id}", response_model=Dict[str, Any])
-async def update_agent(
+def update_agent(
     agent_id: int,
     agent_data: AgentUpdate,
     db: Session = Depends(get_db)
@@ -75,7 +76,7 @@ async def update_agent(
     return agent.to_dict()
 
 @router.delete("/{agent_id}")
-async def delete_agent(agent_id: int, db: Session = Depends(get_db)):
+def delete_agent(agent_id: int, db: Session = Depends(get_db)):
     """删除 Agent"""
     agent = db.query(Agent).filter(Agent.id == agent_id).first()
     if not agent:
@@ -86,18 +87,23 @@ async def delete_agent(agent_id: int, db: Session = Depends(get_db)):
     
     return {"message": "Agent 删除成功"}
 
-@router.get("/{agent_id}/mcp-tools")
-async def get_agent_mcp_tools(agent_id: int, db: Session = Depends(get_db)):
-    """获取 Agent 的 MCP 工具列表"""
+def _load_agent_tools_config(agent_id: int, db: Session) -> Dict[str, Any]:
+    """读取 Agent 的 OpenAI 配置与已配置工具（同步数据库操作，在线程池中执行）"""
     agent = db.query(Agent).filter(Agent.id == agent_id).first()
     if not agent:
         raise HTTPException(status_code=404, detail="Agent 不存在")
+    return {"openai_config": agent.openai_config or {}, "mcp_tools": agent.mcp_tools or []}
+
+@router.get("/{agent_id}/mcp-tools")
+async def get_agent_mcp_tools(agent_id: int, db: Session = Depends(get_db)):
+    """获取 Agent 的 MCP 工具列表"""
+    agent = await run_in_threadpool(_load_agent_tools_config, agent_id, db)
     
     # 获取可用的 MCP 工具
-    available_tools = await mcp_service.list_available_tools(agent.openai_config or {})
+    available_tools = await mcp_service.list_available_tools(agent["openai_config"])
     
     return {
         "agent_id": agent_id,
-        "configured_tools": agent.mcp_tools or [],
+        "configured_tools": agent["mcp_tools"],
         "available_tools": available_tools
     }
@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from typing import List, Dict, Any
@@ -20,13 +21,13 @@ class SessionCreate(BaseModel):
     title: str = "新对话"
 
 @router.get("/sessions", response_model=List[Dict[str, Any]])
-async def list_sessions(db: Session = Depends(get_db)):
+def list_sessions(db: Session = Depends(get_db)):
     """获取所有聊天会话"""
     sessions = db.query(ChatSession).order_by(ChatSession.updated_at.desc()).all()
     return [session.to_dict() for session in sessions]
 
 @router.post("/sessions", response_model=Dict[str, Any])
-async def create_session(session_data: SessionCreate, db: Session = Depends(get_db)):
+def create_session(session_data: SessionCreate, db: Session = Depends(get_db)):
     """创建新的聊天会话"""
     # 验证 Agent 是否存在
     agent = db.query(Agent).filter(Agent.id == session_data.agent_id).first()
@@ -45,7 +46,7 @@ async def create_session(session_data: SessionCreate, db: Session = Depends(get_
     return session.to_dict()
 
 @router.get("/sessions/{session_id}/messages", response_model=List[Dict[str, Any]])
-async def get_session_messages(session_id: int, db: Session = Depends(get_db)):
+def get_session_messages(session_id: int, db: Session = Depends(get_db)):
     """获取会话的所有消息"""
     session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
     if not session:
@@ -57,9 +58,8 @@ async def get_session_messages(session_id: int, db: Session = Depends(get_db)):
     
     return [message.to_dict() for message in messages]
 
-@router.post("/send")
-async def send_message(chat_request: ChatRequest, db: Session = Depends(get_db)):
-    """发送消息并获取 Agent 回复"""
+def _prepare_turn(chat_request: ChatRequest, db: Session) -> Dict[str, Any]:
+    """校验 Agent、获取或创建会话、保存用户消息并构建 OpenAI 消息（同步数据库操作，在线程池中执行）"""
     # 验证 Agent
     agent = db.query(Agent).filter(Agent.id == chat_request.agent_id).first()
     if not agent:
@@ -101,35 +101,54 @@ async def send_message(chat_request: ChatRequest, db: Session = Depends(get_db))
             "content": msg.content
         })
     
+    # commit 后实例已过期，返回前在线程内读取所需字段，避免回到事件循环后触发刷新查询
+    return {
+        "session_id": session.id,
+        "user_message": user_message.to_dict(),
+        "messages": openai_messages,
+        "model": agent.openai_config.get("model", "gpt-3.5-turbo"),
+        "temperature": agent.openai_config.get("temperature", 0.7)
+    }
+
+def _save_reply(session_id: int, response: Dict[str, Any], db: Session) -> Dict[str, Any]:
+    """保存 Assistant 回复（同步数据库操作，在线程池中执行）"""
+    assistant_message = ChatMessage(
+        session_id=session_id,
+        role="assistant",
+        content=response["content"],
+        metadata={"usage": response.get("usage")}
+    )
+    db.add(assistant_message)
+    db.commit()
+    return assistant_message.to_dict()
+
+@router.post("/send")
+async def send_message(chat_request: ChatRequest, db: Session = Depends(get_db)):
+    """发送消息并获取 Agent 回复；数据库读写在线程池中执行，不阻塞事件循环"""
+    turn = await run_in_threadpool(_prepare_turn, chat_request, db)
+    
     try:
         # 调用 OpenAI API
         response = await openai_service.chat_completion(
-            messages=openai_messages,
-            model=agent.openai_config.get("model", "gpt-3.5-turbo"),
-            temperature=agent.openai_config.get("temperature", 0.7)
+            messages=turn["messages"],
+            model=turn["model"],
+            temperature=turn["temperature"]
         )
         
         # 保存 Assistant 回复
-        assistant_message = ChatMessage(
-            session_id=session.id,
-            role="assistant",
-            content=response["content"],
-            metadata={"usage": response.get("usage")}
-        )
-        db.add(assistant_message)
-        db.commit()
+        assistant_message = await run_in_threadpool(_save_reply, turn["session_id"], response, db)
         
         return {
-            "session_id": session.id,
-            "user_message": user_message.to_dict(),
-            "assistant_message": assistant_message.to_dict()
+            "session_id": turn["session_id"],
+            "user_message": turn["user_message"],
+            "assistant_message": assistant_message
         }
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"生成回复失败: {str(e)}")
 
 @router.delete("/sessions/{session_id}")
-async def delete_session(session_id: int, db: Session = Depends(get_db)):
+def delete_session(session_id: int, db: Session = Depends(get_db)):
     """删除聊天会话"""
     session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
     if not session:
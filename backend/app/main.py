@@ -6,6 +6,12 @@ import os
 from .models import init_db
 from .api import agents_router, chat_router
 
+try:
+    # 与 Sanic 后端共用的事件循环延迟监控（需从 backend 目录启动）
+    from loop_monitor import loop_monitor, loop_monitor_enabled
+except ImportError:
+    loop_monitor = None
+
 # 创建 FastAPI 应用
 app = FastAPI(
     title="AI Agents API",
@@ -30,6 +36,13 @@ app.include_router(chat_router)
 async def startup_event():
     """应用启动时初始化数据库"""
     init_db()
+    if loop_monitor is not None and loop_monitor_enabled():
+        loop_monitor.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if loop_monitor is not None:
+        await loop_monitor.stop()
 
 @app.get("/")
 async def root():
@@ -41,6 +54,13 @@ async def health_check():
     """健康检查"""
     return {"status": "healthy"}
 
+@app.get("/health/loop")
+async def loop_health():
+    """事件循环延迟分位数（未鉴权，不返回阻塞调用栈）"""
+    if loop_monitor is None:
+        return {"running": False}
+    return loop_monitor.snapshot(include_stacks=False)
+
 if __name__ == "__main__":
     uvicorn.run(
         "app.main:app",
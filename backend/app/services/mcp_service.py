@@ -89,12 +89,17 @@ class MCPService:
                 "error": str(e)
             }
     
+    @staticmethod
+    def _read_file(file_path: str) -> str:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return f.read()
+
     async def _mock_file_reader(self, parameters: Dict[str, Any]) -> Dict[str, Any]:
         """模拟文件读取工具"""
         file_path = parameters.get("file_path")
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            # 文件读取放到线程池，避免阻塞事件循环
+            content = await asyncio.to_thread(self._read_file, file_path)
             return {
                 "success": True,
                 "result": {
@@ -0,0 +1,187 @@
+"""
+MCP 服务器熔断器
+
+单个 MCP 服务器挂起时，工具目录与工具调用都会卡在传输层的默认超时上，拖慢所有
+Agent 的每一轮对话。每个服务器一个熔断器：
+
+- closed：正常放行，连续失败（异常或超时）达到 MCP_BREAKER_FAILURES 次后打开。
+- open：直接失败，不访问网络，并从工具目录中排除；MCP_BREAKER_RESET 秒后进入半开。
+- half_open：只放行一个探测请求，成功则关闭，失败则重新打开。
+
+工具返回 isError 或 JSON-RPC 协议错误（参数无效、未知工具等）属于业务错误，不计为服务器故障。
+"""
+
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+from metrics import MCP_BREAKER_STATE, MCP_BREAKER_TRANSITIONS_TOTAL
+from utils import logger
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def describe_error(error: BaseException) -> str:
+    """异常描述；anyio 任务组抛出的 ExceptionGroup 取第一个内部异常"""
+    while isinstance(error, BaseExceptionGroup) and error.exceptions:
+        error = error.exceptions[0]
+    return str(error) or type(error).__name__
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开时快速失败"""
+
+    def __init__(self, breaker: "CircuitBreaker"):
+        self.breaker = breaker
+        retry_in = breaker.retry_in()
+        if retry_in > 0:
+            message = f"MCP 服务器 {breaker.name} 暂不可用（已熔断，约 {retry_in:.0f} 秒后重试）"
+        else:
+            message = f"MCP 服务器 {breaker.name} 暂不可用（正在探测恢复）"
+        super().__init__(message)
+
+
+class CircuitBreaker:
+    """单个服务器的熔断状态机"""
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 on_change: Optional[Callable[[], None]] = None):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened_at_wall: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self._probing = False
+        self._on_change = on_change
+        MCP_BREAKER_STATE.labels(name).set(0)
+
+    def _transition(self, state: str) -> None:
+        if state == self.state:
+            return
+        logger.warning("MCP 服务器 %s 熔断状态 %s -> %s", self.name, self.state, state)
+        self.state = state
+        MCP_BREAKER_STATE.labels(self.name).set(_STATE_VALUES[state])
+        MCP_BREAKER_TRANSITIONS_TOTAL.labels(self.name, state).inc()
+        if self._on_change is not None:
+            self._on_change()
+
+    def retry_in(self) -> float:
+        """距离允许探测还有多少秒（仅 open 状态有意义）"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    @property
+    def available(self) -> bool:
+        """是否可能放行请求：用于决定工具目录是否包含该服务器"""
+        return self.state != OPEN or self.retry_in() <= 0
+
+    def allow(self) -> bool:
+        """请求前调用；half_open 时只放行一个探测"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if self.retry_in() > 0:
+                return False
+            self._transition(HALF_OPEN)
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        self._probing = False
+        self.failures = 0
+        self.last_error = None
+        self._transition(CLOSED)
+
+    def record_failure(self, error: Optional[BaseException] = None) -> None:
+        self._probing = False
+        self.failures += 1
+        if error is not None:
+            self.last_error = describe_error(error)
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self.opened_at_wall = time.time()
+            self._transition(OPEN)
+
+    def release(self) -> None:
+        """请求被取消、结果未知时释放探测名额"""
+        self._probing = False
+
+    async def call(self, fn: Callable[[], Awaitable[T]]) -> T:
+        """在熔断器保护下执行 fn，打开时抛出 CircuitOpenError"""
+        if not self.allow():
+            raise CircuitOpenError(self)
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            self.release()
+            raise
+        except Exception as e:
+            self.record_failure(e)
+            raise
+        self.record_success()
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "failure_threshold": self.failure_threshold,
+            "reset_timeout": self.reset_timeout,
+            "opened_at": self.opened_at_wall if self.state != CLOSED else None,
+            "last_error": self.last_error,
+        }
+
+
+class BreakerRegistry:
+    """按服务器名管理熔断器；version 在任一状态变化时递增，用于列表接口的缓存版本"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.version = 0
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def _bump(self) -> None:
+        self.version += 1
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = self._breakers[name] = CircuitBreaker(
+                name, self.failure_threshold, self.reset_timeout, on_change=self._bump
+            )
+        return breaker
+
+    def snapshot(self, name: str) -> Dict[str, Any]:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            return {"state": CLOSED, "failure_threshold": self.failure_threshold,
+                    "reset_timeout": self.reset_timeout, "opened_at": None, "last_error": None}
+        return breaker.snapshot()
+
+    def reset(self, *names: str) -> None:
+        """服务器配置变更后重置指定服务器的熔断器；不传名称时重置全部"""
+        targets = [n for n in (names or list(self._breakers)) if n in self._breakers]
+        for name in targets:
+            MCP_BREAKER_STATE.labels(name).set(0)
+            del self._breakers[name]
+        if targets:
+            self._bump()
+
+
+mcp_breakers = BreakerRegistry(
+    failure_threshold=int(os.getenv("MCP_BREAKER_FAILURES", "5")),
+    reset_timeout=float(os.getenv("MCP_BREAKER_RESET", "30")),
+)
@@ -3,25 +3,70 @@ import asyncio
 import json
 import os
 import re
-from typing import Dict, Any, List, AsyncGenerator
+import time
+import functools
+import math
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, AsyncGenerator, Awaitable, Callable, Optional, Set, Tuple
+from tortoise.exceptions import DoesNotExist
 from models import Agent, MCPServer
-from utils import logger, format_openai_messages
-
-# MCP imports
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
-# 优先导入 Streamable HTTP 客户端（HTTP 传输推荐）
-try:
-    from mcp.client.streamable_http import streamablehttp_client as http_stream_client  # type: ignore
-except Exception:
-    http_stream_client = None
-# 兼容：SSE 客户端（不推荐，保底）
-try:
-    from mcp.client.sse import sse_client  # type: ignore
-except Exception:
-    sse_client = None
-
-import mcp.types as mcp_types
+from utils import (
+    logger, format_openai_messages, json_dumps, parse_agent_id, agent_label, config_number, config_string_list,
+    OPENAI_CONFIG_LIMITS,
+)
+from tracing import span, start_trace
+from replay import session_recorder
+from log_pipeline import get_request_id
+from usage import UsageAccumulator, normalize_usage, empty_usage
+from tool_cache import tool_result_cache
+from tool_results import render_content, for_model, client_chunks
+from tool_schema import compile_schema, parse_arguments, validate_arguments, invalid_result, unknown_tool_result
+from tool_index import ToolIndex
+from jobs import Job, JobManager
+from llm_scheduler import upstream_scheduler, set_request_class, bind_agent, BATCH
+from circuit_breaker import mcp_breakers, CircuitOpenError, describe_error
+from stdio_pool import stdio_pools, parse_stdio_url, is_protocol_error, STDIO_SCHEME
+from metrics import (
+    AGENT_LOOKUP_SECONDS, TOOL_DISCOVERY_SECONDS, UPSTREAM_TTFT_SECONDS, UPSTREAM_INTER_TOKEN_SECONDS,
+    GENERATION_SECONDS, MCP_TOOL_CALL_SECONDS, TOKENS_STREAMED_TOTAL, CACHE_HITS_TOTAL, CACHE_MISSES_TOTAL,
+    ERRORS_TOTAL, AGENT_TOOL_STEPS, AGENT_LOOP_STOPS_TOTAL, MCP_TOOL_RESULT_TRUNCATED_TOTAL, MCP_TOOL_BATCH_SIZE,
+)
+
+# 流式输出中标记工具调用过程的 <mcp> 片段
+_MCP_MARKUP_RE = re.compile(r"<mcp>.*?</mcp>\s*", re.S)
+
+# MCP 客户端与各传输层在首次使用时才导入，缩短冷启动时间
+@functools.lru_cache(maxsize=None)
+def _mcp_client_session():
+    from mcp import ClientSession
+    return ClientSession
+
+
+@functools.lru_cache(maxsize=None)
+def _http_stream_client():
+    """Streamable HTTP 客户端（HTTP 传输推荐），不可用时返回 None"""
+    try:
+        from mcp.client.streamable_http import streamablehttp_client  # type: ignore
+        return streamablehttp_client
+    except Exception:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _sse_client():
+    """兼容：SSE 客户端（不推荐，保底），不可用时返回 None"""
+    try:
+        from mcp.client.sse import sse_client  # type: ignore
+        return sse_client
+    except Exception:
+        return None
+
+
+async def _propagate_request_id(request: httpx.Request) -> None:
+    """把当前请求 ID 透传给上游，便于跨服务排查"""
+    request_id = get_request_id()
+    if request_id:
+        request.headers["X-Request-Id"] = request_id
 
 
 class OpenAIHandler:
@@ -31,21 +76,46 @@ class OpenAIHandler:
         # 使用环境变量或默认的 OpenAI 兼容接口
         self.base_url = os.getenv("OPENAI_BASE_URL", "http://192.168.31.159:8088/api/v1/gpt/v1")
         self.api_key = os.getenv("OPENAI_API_KEY", "dummy-key")
+        # 流式请求附带 stream_options.include_usage，上游不支持时可关闭
+        self.stream_usage = os.getenv("OPENAI_STREAM_USAGE", "1").lower() not in ("0", "false", "no", "off")
+
+        limits = httpx.Limits(
+            max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("OPENAI_MAX_KEEPALIVE", "20")),
+        )
+        # 录制/回放模式下替换传输层（见 replay.py）
+        transport = None
+        if session_recorder.mode:
+            transport = session_recorder.wrap_transport(httpx.AsyncHTTPTransport(limits=limits))
 
         self.client = httpx.AsyncClient(
             timeout=120,
+            limits=limits,
+            transport=transport,
+            event_hooks={"request": [_propagate_request_id]},
             headers={
                 "Authorization": f"Bearer {self.api_key}",
                 "Content-Type": "application/json"
             }
         )
 
+    async def warmup(self) -> None:
+        """预热上游连接池：提前完成 TCP/TLS 握手，避免首个请求承担建连开销
+
+        上游不可达时抛出异常，由调用方把本次预热记为失败。
+        """
+        try:
+            await self.client.get(f"{self.base_url}/models", timeout=5)
+        except Exception as e:
+            raise RuntimeError(f"预热上游连接失败: {e}") from e
+
     async def chat_completion(
         self,
         messages: List[Dict[str, str]],
         model: str = "qwen3:32b",
         max_tokens: int = None,
-        stream: bool = False
+        stream: bool = False,
+        usage: Optional[UsageAccumulator] = None
     ) -> Dict[str, Any]:
         """调用 OpenAI Chat Completion API"""
         try:
@@ -58,10 +128,12 @@ class OpenAIHandler:
             if max_tokens:
                 payload["max_tokens"] = max_tokens
 
-            response = await self.client.post(
-                f"{self.base_url}/chat/completions",
-                json=payload
-            )
+            async with upstream_scheduler.slot(messages):
+                with span("llm.chat_completion", model=model, messages=len(messages)):
+                    response = await self.client.post(
+                        f"{self.base_url}/chat/completions",
+                        json=payload
+                    )
 
             if response.status_code != 200:
                 raise Exception(f"API 请求失败: {response.status_code} {response.text}")
@@ -75,88 +147,255 @@ class OpenAIHandler:
                 if "choices" in data and data["choices"]:
                     choice = data["choices"][0]
                     message = choice.get("message", {})
-                    return {
+                    result = {
                         "content": message.get("content", ""),
                         "role": message.get("role", "assistant"),
-                        "usage": data.get("usage", {"total_tokens": 50})
                     }
                 else:
-                    return {
+                    result = {
                         "content": str(data),
                         "role": "assistant",
-                        "usage": {"total_tokens": 50}
                     }
+                result["usage"] = normalize_usage(data.get("usage"), messages, result["content"] or "")
+                if usage is not None:
+                    usage.add(result["usage"])
+                return result
         except Exception as e:
-            logger.error(f"OpenAI API 调用失败: {str(e)}")
+            ERRORS_TOTAL.labels(component="upstream", model=model).inc()
+            logger.error("OpenAI API 调用失败: %s", e)
             # 返回模拟响应，避免因外部服务不可用导致整个系统无法使用
             return {
                 "content": f"API 调用失败",
                 "role": "assistant",
-                "usage": {"total_tokens": 50}
+                "usage": empty_usage()
             }
 
     async def chat_completion_stream(
         self,
         messages: List[Dict[str, str]],
         model: str = "qwen3:32b",
-        max_tokens: int = None
+        max_tokens: int = None,
+        usage: Optional[UsageAccumulator] = None
     ) -> AsyncGenerator[str, None]:
         """流式调用 OpenAI Chat Completion API"""
+        upstream_usage = None
+        parts: List[str] = []
         try:
             payload = {
                 "model": model,
                 "messages": messages,
                 "stream": True
             }
+            if self.stream_usage:
+                payload["stream_options"] = {"include_usage": True}
 
             if max_tokens:
                 payload["max_tokens"] = max_tokens
 
-            async with self.client.stream(
-                "POST",
-                f"{self.base_url}/chat/completions",
-                json=payload
-            ) as response:
-                if response.status_code != 200:
-                    raise Exception(f"API 请求失败: {response.status_code}")
+            last_token_at = None
+            chunks = 0
+            ttft = UPSTREAM_TTFT_SECONDS.labels(model)
+            inter_token = UPSTREAM_INTER_TOKEN_SECONDS.labels(model)
+            async with upstream_scheduler.slot(messages):
+                # 首 token 延迟从取得上游额度起算，排队时间见 llm_scheduler_wait_seconds
+                started = time.perf_counter()
+                with span("llm.stream", model=model, messages=len(messages)) as sp:
+                    async with self.client.stream(
+                        "POST",
+                        f"{self.base_url}/chat/completions",
+                        json=payload
+                    ) as response:
+                        if response.status_code != 200:
+                            raise Exception(f"API 请求失败: {response.status_code}")
+
+                        async for line in response.aiter_lines():
+                            if not line.strip():
+                                continue
+
+                            if line.startswith("data: "):
+                                data_str = line[6:]  # 去掉 "data: " 前缀
+
+                                if data_str.strip() == "[DONE]":
+                                    break
+
+                                try:
+                                    chunk_data = json.loads(data_str)
+                                    # include_usage 时最后一个块携带整次请求的 usage（choices 为空）
+                                    if chunk_data.get("usage"):
+                                        upstream_usage = chunk_data["usage"]
+                                    choices = chunk_data.get("choices", [])
+                                    if choices:
+                                        delta = choices[0].get("delta", {})
+                                        content = delta.get("content", "")
+                                        if content:
+                                            now = time.perf_counter()
+                                            if last_token_at is None:
+                                                ttft.observe(now - started)
+                                                sp.set("ttft_ms", round((now - started) * 1000, 2))
+                                            else:
+                                                inter_token.observe(now - last_token_at)
+                                            last_token_at = now
+                                            chunks += 1
+                                            sp.set("chunks", chunks)
+                                            parts.append(content)
+                                            yield content
+                                except json.JSONDecodeError:
+                                    # 如果不是 JSON，跳过这行
+                                    continue
 
-                async for line in response.aiter_lines():
-                    if not line.strip():
-                        continue
-
-                    if line.startswith("data: "):
-                        data_str = line[6:]  # 去掉 "data: " 前缀
+        except Exception as e:
+            ERRORS_TOTAL.labels(component="upstream", model=model).inc()
+            logger.error("OpenAI API 流式调用失败: %s", e)
+            # 返回模拟的流式响应
+            mock_response = f"API 调用失败"
+            for char in mock_response:
+                yield char
+        finally:
+            # 客户端中途断开时也记录已生成部分的用量
+            if usage is not None and (upstream_usage or parts):
+                usage.add(normalize_usage(upstream_usage, messages, "".join(parts)))
 
-                        if data_str.strip() == "[DONE]":
-                            break
+    async def chat_completion_stream_with_tools(
+        self,
+        messages: List[Dict[str, str]],
+        tools: List[Dict[str, Any]],
+        model: str = "qwen3:32b",
+        max_tokens: int = None,
+        usage: Optional[UsageAccumulator] = None
+    ) -> AsyncGenerator[Tuple[str, Any], None]:
+        """流式调用并支持工具调用：逐个产出 ("delta", 文本)，最后产出 ("response", 结果)
+
+        结果与 chat_completion_with_tools 相同（content / role / tool_calls / usage），
+        tool_calls 由各块的 delta.tool_calls 按 index 拼接而成。上游忽略 stream 参数
+        直接返回 JSON 时按非流式响应处理。
+        """
+        upstream_usage = None
+        parts: List[str] = []
+        # index -> 拼接中的工具调用
+        calls: Dict[int, Dict[str, Any]] = {}
+        result: Optional[Dict[str, Any]] = None
+        try:
+            payload = {
+                "model": model,
+                "messages": messages,
+                "tools": tools,
+                "tool_choice": "auto",
+                "stream": True
+            }
+            if self.stream_usage:
+                payload["stream_options"] = {"include_usage": True}
+            if max_tokens:
+                payload["max_tokens"] = max_tokens
 
-                        try:
-                            chunk_data = json.loads(data_str)
-                            choices = chunk_data.get("choices", [])
-                            if choices:
+            last_token_at = None
+            ttft = UPSTREAM_TTFT_SECONDS.labels(model)
+            inter_token = UPSTREAM_INTER_TOKEN_SECONDS.labels(model)
+            async with upstream_scheduler.slot(messages):
+                started = time.perf_counter()
+                with span("llm.stream_with_tools", model=model, messages=len(messages), tools=len(tools)) as sp:
+                    async with self.client.stream(
+                        "POST",
+                        f"{self.base_url}/chat/completions",
+                        json=payload
+                    ) as response:
+                        sp.set("status_code", response.status_code)
+                        if response.status_code != 200:
+                            body = await response.aread()
+                            raise Exception(f"API 请求失败: {response.status_code} {body.decode(errors='replace')}")
+
+                        if "json" in response.headers.get("content-type", ""):
+                            data = json.loads(await response.aread())
+                            message = (data.get("choices") or [{}])[0].get("message", {})
+                            upstream_usage = data.get("usage")
+                            if message.get("content"):
+                                parts.append(message["content"])
+                                yield "delta", message["content"]
+                            for index, tool_call in enumerate(message.get("tool_calls") or []):
+                                calls[index] = tool_call
+                        else:
+                            async for line in response.aiter_lines():
+                                if not line.startswith("data: "):
+                                    continue
+                                data_str = line[6:]
+                                if data_str.strip() == "[DONE]":
+                                    break
+                                try:
+                                    chunk_data = json.loads(data_str)
+                                except json.JSONDecodeError:
+                                    continue
+                                if chunk_data.get("usage"):
+                                    upstream_usage = chunk_data["usage"]
+                                choices = chunk_data.get("choices", [])
+                                if not choices:
+                                    continue
                                 delta = choices[0].get("delta", {})
+                                for part in delta.get("tool_calls") or []:
+                                    call = calls.setdefault(part.get("index", len(calls)), {
+                                        "id": "", "type": "function", "function": {"name": "", "arguments": ""},
+                                    })
+                                    if part.get("id"):
+                                        call["id"] = part["id"]
+                                    function = part.get("function") or {}
+                                    call["function"]["name"] += function.get("name") or ""
+                                    call["function"]["arguments"] += function.get("arguments") or ""
                                 content = delta.get("content", "")
                                 if content:
-                                    yield content
-                        except json.JSONDecodeError:
-                            # 如果不是 JSON，跳过这行
-                            continue
-
+                                    now = time.perf_counter()
+                                    if last_token_at is None:
+                                        ttft.observe(now - started)
+                                        sp.set("ttft_ms", round((now - started) * 1000, 2))
+                                    else:
+                                        inter_token.observe(now - last_token_at)
+                                    last_token_at = now
+                                    parts.append(content)
+                                    yield "delta", content
+                        sp.set("tool_calls", len(calls))
+
+            result = {"content": "".join(parts), "role": "assistant"}
+            if calls:
+                result["tool_calls"] = [calls[index] for index in sorted(calls)]
         except Exception as e:
-            logger.error(f"OpenAI API 流式调用失败: {str(e)}")
-            # 返回模拟的流式响应
-            mock_response = f"API 调用失败"
-            for char in mock_response:
-                yield char
+            ERRORS_TOTAL.labels(component="upstream", model=model).inc()
+            logger.error("OpenAI API 流式工具调用失败: %s", e)
+            if not parts:
+                parts.append("API 调用失败")
+                yield "delta", "API 调用失败"
+            result = {"content": "".join(parts), "role": "assistant"}
+        finally:
+            # 客户端中途断开时也记录已生成部分的用量
+            if upstream_usage or parts or calls:
+                step_usage = normalize_usage(
+                    upstream_usage, messages, "".join(parts), tools, (result or {}).get("tool_calls")
+                )
+                if result is not None:
+                    result["usage"] = step_usage
+                if usage is not None:
+                    usage.add(step_usage)
+        if result is not None:
+            result.setdefault("usage", empty_usage())
+            yield "response", result
 
     async def chat_completion_with_tools(
         self,
         messages: List[Dict[str, str]],
         tools: List[Dict[str, Any]],
         model: str = "qwen3:32b",
-        max_tokens: int = None
+        max_tokens: int = None,
+        usage: Optional[UsageAccumulator] = None
     ) -> Dict[str, Any]:
         """调用 OpenAI Chat Completion API 并支持工具调用"""
+        result = await self._chat_with_tools(messages, tools, model, max_tokens)
+        if usage is not None and result.get("usage"):
+            usage.add(result["usage"])
+        return result
+
+    async def _chat_with_tools(
+        self,
+        messages: List[Dict[str, str]],
+        tools: List[Dict[str, Any]],
+        model: str,
+        max_tokens: int
+    ) -> Dict[str, Any]:
         try:
             payload = {
                 "model": model,
@@ -168,10 +407,13 @@ class OpenAIHandler:
             if max_tokens:
                 payload["max_tokens"] = max_tokens
 
-            response = await self.client.post(
-                f"{self.base_url}/chat/completions",
-                json=payload
-            )
+            async with upstream_scheduler.slot(messages):
+                with span("llm.chat_completion_with_tools", model=model, messages=len(messages), tools=len(tools)) as sp:
+                    response = await self.client.post(
+                        f"{self.base_url}/chat/completions",
+                        json=payload
+                    )
+                    sp.set("status_code", response.status_code)
 
             if response.status_code != 200:
                 raise Exception(f"API 请求失败: {response.status_code} {response.text}")
@@ -180,9 +422,11 @@ class OpenAIHandler:
             try:
                 data = response.json()
             except Exception as json_error:
-                logger.error(f"JSON 解析失败: {json_error}, 原始响应: {response.text[:500]}")
+                logger.error("JSON 解析失败: %s, 原始响应: %.200s", json_error, response.text)
                 # 尝试从文本中提取工具调用信息
-                return self._parse_non_json_response(response.text, messages)
+                result = self._parse_non_json_response(response.text, messages)
+                result["usage"] = normalize_usage(None, messages, response.text, tools)
+                return result
 
             # 处理标准 OpenAI 格式
             if "choices" in data and data["choices"]:
@@ -191,25 +435,28 @@ class OpenAIHandler:
                 result = {
                     "content": message.get("content", ""),
                     "role": message.get("role", "assistant"),
-                    "usage": data.get("usage", {"total_tokens": 50})
                 }
 
                 # 检查是否有工具调用
                 if "tool_calls" in message and message["tool_calls"]:
                     result["tool_calls"] = message["tool_calls"]
-
-                return result
             else:
                 # 非标准格式，尝试解析
-                return self._parse_alternative_format(data, messages)
+                result = self._parse_alternative_format(data, messages)
+
+            result["usage"] = normalize_usage(
+                data.get("usage"), messages, result.get("content") or "", tools, result.get("tool_calls")
+            )
+            return result
 
         except Exception as e:
-            logger.error(f"OpenAI API 工具调用失败: {str(e)}")
+            ERRORS_TOTAL.labels(component="upstream", model=model).inc()
+            logger.error("OpenAI API 工具调用失败: %s", e)
             # 返回模拟响应，避免因外部服务不可用导致整个系统无法使用
             return {
                 "content": f"模拟AI回复（带工具支持）：{messages[-1]['content'] if messages else '你好'}",
                 "role": "assistant",
-                "usage": {"total_tokens": 50}
+                "usage": empty_usage()
             }
 
     def _parse_non_json_response(self, text: str, messages: List[Dict[str, str]]) -> Dict[str, Any]:
@@ -242,7 +489,6 @@ class OpenAIHandler:
         result = {
             "content": content,
             "role": "assistant",
-            "usage": {"total_tokens": 50}
         }
 
         if tool_calls:
@@ -285,12 +531,11 @@ class OpenAIHandler:
                                 }
                                 tool_calls.append(tool_call)
                 except Exception as e:
-                    logger.error(f"解析工具调用失败: {e}")
+                    logger.error("解析工具调用失败: %s", e)
 
         result = {
             "content": content,
             "role": "assistant",
-            "usage": {"total_tokens": 50}
         }
 
         if tool_calls:
@@ -307,26 +552,208 @@ class MCPClientHandler:
         self.project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         # 运行期从数据库动态加载服务器配置
         self.mcp_servers: Dict[str, Dict[str, Any]] = {}
+        # 服务器配置与工具目录的短期缓存，避免每次请求都查库、连 MCP 服务器
+        self.servers_cache_ttl = float(os.getenv("MCP_SERVERS_CACHE_TTL", "5"))
+        self.tools_cache_ttl = float(os.getenv("MCP_TOOLS_CACHE_TTL", "60"))
+        self._servers_loaded_at = 0.0
+        self._tools_cache: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+        # 与工具目录一同缓存的参数校验器：服务器名 -> {工具名: 校验器}
+        self._tool_validators: Dict[str, Dict[str, Any]] = {}
+        # 聚合工具目录的 BM25 索引及构建它的各服务器工具列表（列表对象不变则复用索引）
+        self.tool_index = ToolIndex([])
+        self._tool_index_sources: List[List[Dict[str, Any]]] = []
+        # 建连（含 initialize）与单次调用的超时，MCP_SERVER_TIMEOUTS 可按服务器覆盖：
+        # {"服务器名": {"connect": 秒, "call": 秒}}
+        self.connect_timeout = float(os.getenv("MCP_CONNECT_TIMEOUT", "5"))
+        self.call_timeout = float(os.getenv("MCP_CALL_TIMEOUT", "30"))
+        self.server_timeouts: Dict[str, Dict[str, float]] = {}
+        try:
+            self.server_timeouts = json.loads(os.getenv("MCP_SERVER_TIMEOUTS", "") or "{}")
+        except ValueError as e:
+            logger.warning("MCP_SERVER_TIMEOUTS 配置无效，已忽略: %s", e)
+        # 批量调用时单个会话上同时进行的请求数；MCP_SERIAL_SERVERS（逗号分隔）中的服务器
+        # 只能顺序处理请求，批量时在同一会话上逐个发送
+        self.batch_concurrency = max(1, int(os.getenv("MCP_BATCH_CONCURRENCY", "8")))
+        self.serial_servers = {n.strip() for n in os.getenv("MCP_SERIAL_SERVERS", "").split(",") if n.strip()}
+
+    def invalidate_cache(self, *server_names: str) -> None:
+        """MCP 服务器变更后清空服务器配置、工具目录与工具结果缓存，并重置变更服务器的熔断器"""
+        self._servers_loaded_at = 0.0
+        self._tools_cache.clear()
+        self._tool_validators.clear()
+        tool_result_cache.invalidate()
+        if server_names:
+            mcp_breakers.reset(*server_names)
+
+    async def warmup(self) -> None:
+        """预热：加载服务器配置并预取所有服务器的工具目录
+
+        服务器配置加载失败时抛出异常；单个服务器的工具目录获取失败不影响预热结果。
+        """
+        await self.load_servers(force=True, strict=True)
+        await asyncio.gather(
+            *(self.get_server_tools_dynamic(name) for name in self.mcp_servers),
+            return_exceptions=True,
+        )
 
-    async def load_servers(self) -> None:
-        """从数据库动态加载 MCP 服务器配置到内存映射"""
+    async def load_servers(self, force: bool = False, strict: bool = False) -> None:
+        """从数据库动态加载 MCP 服务器配置到内存映射；strict 为真时加载失败向上抛出"""
+        if not force and time.monotonic() - self._servers_loaded_at < self.servers_cache_ttl:
+            return
+        if session_recorder.replaying:
+            # 回放时不连接真实服务器，使用录制中出现过的服务器
+            self.mcp_servers = session_recorder.replay_servers()
+            self._servers_loaded_at = time.monotonic()
+            return
         try:
-            servers = await MCPServer.all()
+            with span("mcp.load_servers"):
+                servers = await MCPServer.all()
             mapping: Dict[str, Dict[str, Any]] = {}
             for s in servers:
                 url = (s.api_url or '').strip()
-                # 仅支持 http(s) 协议
                 if url.startswith("http://") or url.startswith("https://"):
                     mapping[s.name] = {
-                        "transport": "http" if http_stream_client is not None else "sse",
+                        # 连接时若未安装 Streamable HTTP 客户端会自动回退到 SSE
+                        "transport": "http",
+                        "url": url,
+                        "description": s.description,
+                    }
+                elif url.startswith(STDIO_SCHEME):
+                    try:
+                        command, args = parse_stdio_url(url)
+                    except ValueError as e:
+                        logger.warning("MCP 服务器 %s 的 stdio 地址无效: %s", s.name, e)
+                        continue
+                    mapping[s.name] = {
+                        "transport": "stdio",
+                        "name": s.name,
                         "url": url,
+                        "command": command,
+                        "args": args,
                         "description": s.description,
                     }
                 else:
-                    logger.warning(f"不支持的 MCP api_url 协议: {url}")
+                    logger.warning("不支持的 MCP api_url 协议: %s", url)
             self.mcp_servers = mapping
+            # 关闭已删除或地址变更的 stdio 进程池，并预热其余的
+            stdio_pools.retain({
+                name: config["url"] for name, config in mapping.items() if config["transport"] == "stdio"
+            })
+            for name, config in mapping.items():
+                if config["transport"] == "stdio":
+                    stdio_pools.get(name, config["url"], self._timeouts(name)[0])
+            self._servers_loaded_at = time.monotonic()
         except Exception as e:
-            logger.error(f"加载 MCP 服务器配置失败: {str(e)}")
+            if strict:
+                raise RuntimeError(f"加载 MCP 服务器配置失败: {e}") from e
+            logger.error("加载 MCP 服务器配置失败: %s", e)
+
+    def _timeouts(self, server_name: str) -> Tuple[float, float]:
+        """服务器的 (建连超时, 调用超时)"""
+        override = self.server_timeouts.get(server_name) or {}
+        return (
+            float(override.get("connect", self.connect_timeout)),
+            float(override.get("call", self.call_timeout)),
+        )
+
+    async def _with_session(
+        self,
+        server_name: str,
+        operation: Callable[[Any], Awaitable[Any]],
+        call_timeout: Optional[float] = None,
+    ) -> Any:
+        """在熔断器与超时保护下建立会话并执行 operation(session)
+
+        熔断打开时抛出 CircuitOpenError；建连或调用超时抛出 TimeoutError 并计为一次失败。
+        call_timeout 默认为服务器的单次调用超时。
+        """
+        connect_timeout, default_call_timeout = self._timeouts(server_name)
+        if call_timeout is None:
+            call_timeout = default_call_timeout
+        server_config = self.mcp_servers[server_name]
+
+        async def run():
+            async with self._open_session(server_config, connect_timeout) as session:
+                try:
+                    return await asyncio.wait_for(operation(session), call_timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"MCP 服务器 {server_name} 调用超时（{call_timeout:g} 秒）") from None
+
+        async def guarded():
+            # 外层总时限同时覆盖会话关闭，避免挂起的服务器卡住连接清理
+            try:
+                return await asyncio.wait_for(run(), connect_timeout + call_timeout)
+            except asyncio.TimeoutError as e:
+                if str(e):
+                    raise
+                raise TimeoutError(f"MCP 服务器 {server_name} 响应超时") from None
+
+        return await mcp_breakers.get(server_name).call(guarded)
+
+    @asynccontextmanager
+    async def _open_session(self, server_config: Dict[str, Any], connect_timeout: Optional[float] = None):
+        """根据 transport 建立 MCP 会话（Streamable HTTP / SSE / stdio）"""
+        ClientSession = _mcp_client_session()
+
+        async def initialize(session):
+            try:
+                await asyncio.wait_for(session.initialize(), connect_timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"MCP 服务器建连超时（{connect_timeout:g} 秒）") from None
+
+        transport = server_config.get("transport")
+        request_id = get_request_id()
+        headers = {"X-Request-Id": request_id} if request_id else None
+
+        if transport == "http":
+            http_stream_client = _http_stream_client()
+            if http_stream_client is not None:
+                async with http_stream_client(server_config["url"], headers=headers) as (read, write, _get_sid):  # type: ignore
+                    async with ClientSession(read, write) as session:
+                        await initialize(session)
+                        yield session
+                return
+            transport = "sse"
+
+        if transport == "sse":
+            sse_client = _sse_client()
+            if sse_client is None:
+                raise RuntimeError("后端未安装支持 HTTP MCP 的客户端，请升级 mcp 包")
+            async with sse_client(server_config["url"], headers=headers) as (read, write):  # type: ignore
+                async with ClientSession(read, write) as session:
+                    await initialize(session)
+                    yield session
+        else:
+            # stdio 服务器使用常驻进程池，借用已完成 initialize 的会话
+            pool = stdio_pools.get(server_config["name"], server_config["url"], connect_timeout)
+            async with pool.session() as session:
+                yield session
+
+    def _format_tool_result(self, result: Any, server_name: str = "", tool_name: str = "") -> Dict[str, Any]:
+        """将 MCP CallToolResult 转换为统一的结果字典
+
+        图片、音频与二进制资源只保留摘要（attachments），文本超过 MCP_RESULT_MAX_BYTES 时截断。
+        """
+        text, attachments, truncated = render_content(
+            result.content, getattr(result, "structuredContent", None)
+        )
+        if truncated:
+            MCP_TOOL_RESULT_TRUNCATED_TOTAL.labels(server_name, self.tool_label(server_name, tool_name), "ingest").inc()
+
+        if result.isError:
+            return {
+                "success": False,
+                "error": f"MCP 工具执行失败: {text}"
+            }
+        formatted: Dict[str, Any] = {
+            "success": True,
+            "result": text
+        }
+        if attachments:
+            formatted["attachments"] = attachments
+        if truncated:
+            formatted["truncated"] = True
+        return formatted
 
     async def call_mcp_tool(
         self,
@@ -344,76 +771,250 @@ class MCPClientHandler:
                     "error": f"MCP 服务器 {server_name} 不存在"
                 }
 
-            server_config = self.mcp_servers[server_name]
+            return await tool_result_cache.get_or_call(
+                server_name, tool_name, parameters, self._tool_annotations(server_name, tool_name),
+                lambda: self._call_tool_uncached(server_name, tool_name, parameters),
+                label=self.tool_label(server_name, tool_name),
+            )
+
+        except Exception as e:
+            ERRORS_TOTAL.labels(component="mcp", server=server_name).inc()
+            logger.error("MCP 服务器调用失败: %s", describe_error(e))
+            return {
+                "success": False,
+                "error": describe_error(e)
+            }
 
-            # 根据 transport 连接服务器（SSE 或 stdio）
-            if server_config.get("transport") == "http":
-                if http_stream_client is None:
-                    return {"success": False, "error": "后端未安装支持 HTTP MCP 的 http 客户端，请升级 mcp 包"}
-                async with http_stream_client(server_config["url"]) as (read, write, _get_sid):  # type: ignore
-                    async with ClientSession(read, write) as session:
-                        await session.initialize()
-                        result = await session.call_tool(tool_name, arguments=parameters)
-            elif server_config.get("transport") == "sse":
-                if sse_client is None:
-                    return {"success": False, "error": "后端未安装支持 HTTP(S) MCP 的 sse 客户端，请升级 mcp 包或改用 stdio 服务器"}
-                async with sse_client(server_config["url"]) as (read, write):  # type: ignore
-                    async with ClientSession(read, write) as session:
-                        await session.initialize()
-                        result = await session.call_tool(tool_name, arguments=parameters)
-            else:
-                server_params = StdioServerParameters(command=server_config["command"], args=server_config["args"])
-                async with stdio_client(server_params) as (read, write):
-                    async with ClientSession(read, write) as session:
-                        await session.initialize()
-                        result = await session.call_tool(tool_name, arguments=parameters)
-
-                    # 处理结果
-                    if result.isError:
-                        error_content = ""
-                        for content in result.content:
-                            if isinstance(content, mcp_types.TextContent):
-                                error_content += content.text
-                        return {
-                            "success": False,
-                            "error": f"MCP 工具执行失败: {error_content}"
-                        }
-                    else:
-                        # 提取结果内容
-                        result_content = ""
-                        for content in result.content:
-                            if isinstance(content, mcp_types.TextContent):
-                                result_content += content.text
-
-                        return {
-                            "success": True,
-                            "result": result_content
-                        }
+    async def call_mcp_tools(
+        self,
+        server_name: str,
+        calls: List[Tuple[str, Dict[str, Any]]]
+    ) -> List[Dict[str, Any]]:
+        """批量调用同一服务器上的多个工具 [(工具名, 参数)]，结果与 calls 顺序一致
+
+        缓存命中的直接返回，其余请求在同一个会话上并发发送，由 JSON-RPC id 区分响应，
+        N 次建连与握手合并为一次。stdio 服务器（由进程池分发）与回放模式逐个调用；
+        批量会话出现超时与熔断以外的失败时，未完成的调用中尚未发出的、或工具声明了
+        readOnlyHint / idempotentHint 的回退为逐个调用，其余可能已在服务器上执行，
+        不再重发，直接返回错误。
+        """
+        if not calls:
+            return []
+        await self.load_servers()
+        if server_name not in self.mcp_servers:
+            return [{"success": False, "error": f"MCP 服务器 {server_name} 不存在"} for _ in calls]
+
+        if (len(calls) == 1 or session_recorder.replaying
+                or self.mcp_servers[server_name]["transport"] == "stdio"):
+            return list(await asyncio.gather(
+                *(self.call_mcp_tool(server_name, tool_name, parameters) for tool_name, parameters in calls)
+            ))
+
+        results: List[Optional[Dict[str, Any]]] = [
+            tool_result_cache.peek(server_name, tool_name, parameters, self._tool_annotations(server_name, tool_name),
+                                   label=self.tool_label(server_name, tool_name))
+            for tool_name, parameters in calls
+        ]
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending:
+            return results  # type: ignore[return-value]
+
+        concurrency = 1 if server_name in self.serial_servers else min(self.batch_concurrency, len(pending))
+        semaphore = asyncio.Semaphore(concurrency)
+        MCP_TOOL_BATCH_SIZE.labels(server_name).observe(len(pending))
+
+        # 已发往服务器的调用
+        sent: Set[int] = set()
+
+        async def dispatch(session):
+            async def one(index: int) -> None:
+                tool_name, parameters = calls[index]
+
+                async def send() -> Dict[str, Any]:
+                    sent.add(index)
+                    return await self._call_on_session(session, server_name, tool_name, parameters)
+
+                async with semaphore:
+                    results[index] = await tool_result_cache.get_or_call(
+                        server_name, tool_name, parameters, self._tool_annotations(server_name, tool_name), send,
+                        label=self.tool_label(server_name, tool_name),
+                    )
 
+            async with asyncio.TaskGroup() as group:
+                for index in pending:
+                    group.create_task(one(index))
+
+        # 顺序发送时总时长按轮数放宽
+        call_timeout = self._timeouts(server_name)[1] * math.ceil(len(pending) / concurrency)
+        try:
+            with span("mcp.call_tools", server=server_name, calls=len(pending), concurrency=concurrency):
+                await self._with_session(server_name, dispatch, call_timeout)
+        except (CircuitOpenError, TimeoutError) as e:
+            if not isinstance(e, CircuitOpenError):
+                ERRORS_TOTAL.labels(component="mcp", server=server_name).inc()
+                logger.error("MCP 服务器批量调用失败: %s", e)
+            for index in pending:
+                if results[index] is None:
+                    results[index] = {"success": False, "error": str(e)}
+        except Exception as e:
+            missing = [i for i in pending if results[i] is None]
+            retry = [i for i in missing if i not in sent or self._safe_to_retry(server_name, calls[i][0])]
+            logger.warning("MCP 服务器 %s 批量调用失败，%d 个调用回退为逐个调用，%d 个已发出的调用不再重发: %s",
+                           server_name, len(retry), len(missing) - len(retry), describe_error(e))
+            for index in missing:
+                if index not in retry:
+                    results[index] = {"success": False, "error": f"调用已发出但未收到结果: {describe_error(e)}"}
+            fallback = await asyncio.gather(*(self.call_mcp_tool(server_name, *calls[i]) for i in retry))
+            for index, result in zip(retry, fallback):
+                results[index] = result
+        return results  # type: ignore[return-value]
+
+    async def _call_on_session(
+        self,
+        session: Any,
+        server_name: str,
+        tool_name: str,
+        parameters: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """在已建立的会话上调用单个工具；协议层错误只作为该调用的结果，不影响同批其他调用"""
+        started = time.perf_counter()
+        try:
+            with span("mcp.call_tool", server=server_name, tool=tool_name, batched=True) as sp, \
+                    MCP_TOOL_CALL_SECONDS.labels(server_name, self.tool_label(server_name, tool_name)).time():
+                result = await session.call_tool(tool_name, arguments=parameters)
+                sp.set("is_error", bool(result.isError))
         except Exception as e:
-            logger.error(f"MCP 服务器调用失败: {str(e)}")
+            if not is_protocol_error(e):
+                raise
+            ERRORS_TOTAL.labels(component="mcp", server=server_name).inc()
+            logger.error("MCP 服务器调用失败: %s", e)
+            return {
+                "success": False,
+                "error": str(e)
+            }
+        formatted = self._format_tool_result(result, server_name, tool_name)
+        session_recorder.record_mcp("call_tool", server_name, tool_name, parameters,
+                                    time.perf_counter() - started, formatted)
+        return formatted
+
+    def check_tool_arguments(
+        self,
+        server_name: str,
+        tool_name: str,
+        raw_arguments: Any
+    ) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+        """解析并按 inputSchema 校验模型给出的参数，返回 (参数, 错误结果)
+
+        错误结果不为空时不应发出调用，直接作为工具结果返回给模型。
+        服务器已有工具目录而其中没有该工具时返回未知工具错误；目录尚未获取或
+        该工具没有校验器（schema 无效）时只做解析。
+        """
+        server_label = server_name if server_name in self.mcp_servers else "unknown"
+        arguments, error = parse_arguments(raw_arguments)
+        catalog = self._tool_validators.get(server_name)
+        if catalog is not None and tool_name not in catalog:
+            logger.info("工具 %s_%s 不在工具目录中，未发出调用", server_name, tool_name)
+            return arguments, unknown_tool_result(server_label, tool_name)
+        if error:
+            logger.error("解析工具参数失败: %s, 原始参数: %.200s", error, raw_arguments)
+            return arguments, invalid_result(server_label, tool_name, "parse", error,
+                                             tool_label=self.tool_label(server_name, tool_name))
+        errors = validate_arguments(catalog.get(tool_name) if catalog else None, arguments)
+        if errors:
+            message = "; ".join(f"{e['path']}: {e['message']}" for e in errors)
+            logger.info("工具 %s_%s 参数未通过校验: %s", server_name, tool_name, message)
+            return arguments, invalid_result(server_label, tool_name, "schema", "不符合 inputSchema", errors)
+        return arguments, None
+
+    def tool_label(self, server_name: str, tool_name: str) -> str:
+        """指标的 tool 标签值：不在服务器工具目录中的名称（模型臆造）记为 unknown，避免标签无限增长"""
+        return tool_name if tool_name in self._tool_validators.get(server_name, {}) else "unknown"
+
+    def _tool_annotations(self, server_name: str, tool_name: str) -> Dict[str, Any]:
+        """从工具目录缓存中查找工具注解（目录过期也可使用）"""
+        cached = self._tools_cache.get(server_name)
+        for tool in (cached[1] if cached else []):
+            if tool["name"] == tool_name:
+                return tool.get("annotations") or {}
+        return {}
+
+    def _safe_to_retry(self, server_name: str, tool_name: str) -> bool:
+        """工具是否声明了重复调用无副作用（readOnlyHint 或 idempotentHint）"""
+        annotations = self._tool_annotations(server_name, tool_name)
+        return annotations.get("readOnlyHint") is True or annotations.get("idempotentHint") is True
+
+    async def _call_tool_uncached(
+        self,
+        server_name: str,
+        tool_name: str,
+        parameters: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        try:
+            if session_recorder.replaying:
+                hit, recorded = await session_recorder.replay_mcp("call_tool", server_name, tool_name, parameters)
+                return recorded if hit else {"success": False, "error": "回放未找到匹配的 MCP 调用录制"}
+
+            async def call(session):
+                # 协议层错误（参数无效、未知工具等）说明服务器正常响应，作为结果返回，不计入熔断失败
+                try:
+                    return await session.call_tool(tool_name, arguments=parameters)
+                except Exception as e:
+                    if not is_protocol_error(e):
+                        raise
+                    return e
+
+            started = time.perf_counter()
+            with span("mcp.call_tool", server=server_name, tool=tool_name) as sp, \
+                    MCP_TOOL_CALL_SECONDS.labels(server_name, self.tool_label(server_name, tool_name)).time():
+                result = await self._with_session(server_name, call)
+                if isinstance(result, Exception):
+                    raise result
+                sp.set("is_error", bool(result.isError))
+            formatted = self._format_tool_result(result, server_name, tool_name)
+            session_recorder.record_mcp("call_tool", server_name, tool_name, parameters,
+                                        time.perf_counter() - started, formatted)
+            return formatted
+
+        except CircuitOpenError as e:
+            # 熔断中快速失败，作为工具错误返回给模型
             return {
                 "success": False,
                 "error": str(e)
             }
+        except Exception as e:
+            ERRORS_TOTAL.labels(component="mcp", server=server_name).inc()
+            logger.error("MCP 服务器调用失败: %s", describe_error(e))
+            return {
+                "success": False,
+                "error": describe_error(e)
+            }
 
     async def get_available_tools(self) -> List[Dict[str, Any]]:
         """聚合所有活动 MCP 服务器的工具（动态）"""
         # 确保加载最新服务器列表
         await self.load_servers()
         tools: List[Dict[str, Any]] = []
-        for server_name in self.mcp_servers.keys():
-            # 动态查询每个服务器可用工具
-            dynamic_tools = await self.get_server_tools_dynamic(server_name)
-            for t in dynamic_tools:
-                tools.append({
-                    "type": "function",
-                    "function": {
-                        "name": f"{server_name}_{t['name']}",
-                        "description": f"{t.get('description', '')}",
-                        "parameters": t.get('parameters', {}) or {}
-                    }
-                })
+        with span("mcp.list_tools_fanout", servers=len(self.mcp_servers)) as sp:
+            # 并发查询各服务器的工具，单个慢服务器只占用自己的超时
+            server_names = list(self.mcp_servers.keys())
+            results = await asyncio.gather(*(self.get_server_tools_dynamic(name) for name in server_names))
+            for server_name, dynamic_tools in zip(server_names, results):
+                for t in dynamic_tools:
+                    tools.append({
+                        "type": "function",
+                        "function": {
+                            "name": f"{server_name}_{t['name']}",
+                            "description": f"{t.get('description', '')}",
+                            "parameters": t.get('parameters', {}) or {}
+                        }
+                    })
+            sp.set("tools", len(tools))
+            sources = [dynamic_tools for dynamic_tools in results if dynamic_tools]
+            if len(sources) != len(self._tool_index_sources) or any(
+                a is not b for a, b in zip(sources, self._tool_index_sources)
+            ):
+                self.tool_index = ToolIndex(tools)
+                self._tool_index_sources = sources
         return tools
 
     def get_mcp_servers_info(self) -> Dict[str, Any]:
@@ -436,39 +1037,50 @@ class MCPClientHandler:
             await self.load_servers()
             if server_name not in self.mcp_servers:
                 return []
+            # 熔断打开的服务器不出现在工具目录中，等到可以探测时再重新获取
+            if not mcp_breakers.get(server_name).available:
+                return []
 
-            server_config = self.mcp_servers[server_name]
+            cached = self._tools_cache.get(server_name)
+            if cached and cached[0] > time.monotonic():
+                CACHE_HITS_TOTAL.labels("mcp_tools").inc()
+                return cached[1]
+            CACHE_MISSES_TOTAL.labels("mcp_tools").inc()
 
-            # 根据传输方式连接到 MCP 服务器获取工具列表
-            if server_config.get("transport") == "http" and http_stream_client is not None:
-                async with http_stream_client(server_config["url"]) as (read, write, _get_sid):  # type: ignore
-                    async with ClientSession(read, write) as session:
-                        await session.initialize()
-                        tools_response = await session.list_tools()
-            elif server_config.get("transport") == "sse" and sse_client is not None:
-                async with sse_client(server_config["url"]) as (read, write):  # type: ignore
-                    async with ClientSession(read, write) as session:
-                        await session.initialize()
-                        tools_response = await session.list_tools()
+            if session_recorder.replaying:
+                hit, tools = await session_recorder.replay_mcp("list_tools", server_name)
+                if not hit:
+                    return []
             else:
-                server_params = StdioServerParameters(command=server_config["command"], args=server_config["args"])
-                async with stdio_client(server_params) as (read, write):
-                    async with ClientSession(read, write) as session:
-                        await session.initialize()
-                        tools_response = await session.list_tools()
-
-            tools = []
-            for tool in tools_response.tools:
-                tools.append({
-                    "name": tool.name,
-                    "description": tool.description,
-                    "parameters": tool.inputSchema if hasattr(tool, 'inputSchema') else {}
-                })
+                started = time.perf_counter()
+                with span("mcp.list_tools", server=server_name):
+                    tools_response = await self._with_session(server_name, lambda session: session.list_tools())
+
+                tools = []
+                for tool in tools_response.tools:
+                    annotations = getattr(tool, "annotations", None)
+                    tools.append({
+                        "name": tool.name,
+                        "description": tool.description,
+                        "parameters": tool.inputSchema if hasattr(tool, 'inputSchema') else {},
+                        "annotations": annotations.model_dump(exclude_none=True) if annotations else {}
+                    })
+                session_recorder.record_mcp("list_tools", server_name, "", None,
+                                            time.perf_counter() - started, tools)
 
+            # 仅缓存成功的结果，失败时下次请求重新获取
+            self._tools_cache[server_name] = (time.monotonic() + self.tools_cache_ttl, tools)
+            self._tool_validators[server_name] = {
+                tool["name"]: compile_schema(tool.get("parameters")) for tool in tools
+            }
             return tools
 
+        except CircuitOpenError as e:
+            logger.info("跳过熔断中的 MCP 服务器: %s", e)
+            return []
         except Exception as e:
-            logger.error(f"获取 MCP 服务器 {server_name} 工具列表失败: {str(e)}")
+            ERRORS_TOTAL.labels(component="mcp_list_tools", server=server_name).inc()
+            logger.error("获取 MCP 服务器 %s 工具列表失败: %s", server_name, describe_error(e))
             # 失败时返回空
             return []
 
@@ -479,16 +1091,102 @@ class AgentHandler:
     def __init__(self):
         self.openai_handler = OpenAIHandler()
         self.mcp_handler = MCPClientHandler()
+        # Agent 配置缓存：agent_id（整数）-> (过期时间, Agent)。缓存按 worker 分别保存，
+        # 修改或删除 Agent 只清除处理该请求的 worker 的缓存，其他 worker 最多在
+        # AGENT_CACHE_TTL 秒内仍使用旧配置；需要立即生效时把它设为 0 关闭缓存
+        self.agent_cache_ttl = float(os.getenv("AGENT_CACHE_TTL", "10"))
+        self._agent_cache: Dict[int, Tuple[float, Agent]] = {}
+        # 工具调用循环的默认上限，可被 Agent 的 openai_config 覆盖
+        self.max_tool_steps = int(os.getenv("AGENT_MAX_TOOL_STEPS", "5"))
+        self.tool_deadline = float(os.getenv("AGENT_TOOL_DEADLINE", "120"))
+        self.token_budget = int(os.getenv("AGENT_TOKEN_BUDGET", "0"))
+        # 每次请求最多发送的工具数（按相关度选取），0 表示不限；可被 openai_config.tool_top_k 覆盖
+        self.tool_top_k = int(os.getenv("AGENT_TOOL_TOP_K", "0"))
+        # 后台执行的异步任务（见 jobs.py）
+        self.jobs = JobManager(
+            self._run_job,
+            workers=int(os.getenv("AGENT_JOB_WORKERS", "4")),
+            max_queued=int(os.getenv("AGENT_JOB_QUEUE_SIZE", "1000")),
+            default_deadline=float(os.getenv("AGENT_JOB_DEADLINE", "600")),
+            ttl=float(os.getenv("AGENT_JOB_TTL", "3600")),
+            max_events=int(os.getenv("AGENT_JOB_MAX_EVENTS", "5000")),
+            max_bytes=int(os.getenv("AGENT_JOB_MAX_BYTES", str(2 * 1024 * 1024))),
+        )
+
+    async def get_agent(self, agent_id: int) -> Agent:
+        """获取 Agent 配置（带短期缓存），不存在或 agent_id 不是整数时抛出 DoesNotExist"""
+        key = parse_agent_id(agent_id)
+        if key is None:
+            raise DoesNotExist(f"Agent {agent_id!r} 不存在")
+        agent_id = key
+        started = time.perf_counter()
+        found = True
+        with span("agent.get", agent_id=agent_id) as sp:
+            try:
+                cached = self._agent_cache.get(agent_id)
+                hit = bool(cached and cached[0] > time.monotonic())
+                sp.set("cache_hit", hit)
+                if hit:
+                    CACHE_HITS_TOTAL.labels("agent").inc()
+                    return cached[1]
+                CACHE_MISSES_TOTAL.labels("agent").inc()
+                agent = await Agent.get(id=agent_id)
+                self._agent_cache[agent_id] = (time.monotonic() + self.agent_cache_ttl, agent)
+                return agent
+            except DoesNotExist:
+                found = False
+                raise
+            finally:
+                AGENT_LOOKUP_SECONDS.labels(agent_label(agent_id, found)).observe(time.perf_counter() - started)
+
+    def invalidate_agent(self, agent_id: Optional[int] = None) -> None:
+        """Agent 变更后清除缓存，agent_id 为空时清空全部"""
+        if agent_id is None:
+            self._agent_cache.clear()
+        else:
+            self._agent_cache.pop(parse_agent_id(agent_id), None)
+
+    async def warmup(self) -> None:
+        """Worker 预热：建立上游连接、预取 Agent 配置与 MCP 工具目录
+
+        各步骤并行执行；任一步骤失败时抛出 RuntimeError，就绪检查保持 503 并由重试循环再次预热。
+        """
+        async def prefetch_agents():
+            expires_at = time.monotonic() + self.agent_cache_ttl
+            for agent in await Agent.all():
+                self._agent_cache[agent.id] = (expires_at, agent)
+
+        results = await asyncio.gather(
+            self.openai_handler.warmup(),
+            self.mcp_handler.warmup(),
+            prefetch_agents(),
+            return_exceptions=True,
+        )
+        errors = [str(result) for result in results if isinstance(result, Exception)]
+        for error in errors:
+            logger.warning("预热步骤失败: %s", error)
+        if errors:
+            raise RuntimeError("; ".join(errors))
 
     async def process_message(
         self,
         agent_id: int,
         messages: List[Dict[str, str]],
-        stream: bool = False
+        stream: bool = False,
+        session_id: Optional[str] = None,
+        agent: Optional[Agent] = None,
+        available_tools: Optional[List[Dict[str, Any]]] = None
     ) -> Dict[str, Any]:
-        """处理消息并生成回复 - 支持 MCP 工具调用"""
+        """处理消息并生成回复 - 支持 MCP 工具调用，返回的 usage 为各轮上游调用之和
+
+        agent / available_tools 可由调用方预先查询后传入（批量处理时各条目共用）。
+        """
+        started = time.perf_counter()
+        model = ""
+        usage = UsageAccumulator(agent_id, session_id=session_id)
         try:
-            agent = await Agent.get(id=agent_id)
+            if agent is None:
+                agent = await self.get_agent(agent_id)
 
             # 格式化消息
             formatted_messages = format_openai_messages(agent.prompt, messages)
@@ -497,27 +1195,28 @@ class AgentHandler:
             openai_config = agent.openai_config or {}
             model = openai_config.get("model", "qwen3:32b")
             max_tokens = openai_config.get("max_tokens")
+            usage.model = model
+            bind_agent(agent.id, openai_config)
 
             # 检查 Agent 是否配置了 MCP 工具
             agent_tools = agent.mcp_tools or []
 
             if agent_tools and not stream:  # 工具调用暂不支持流式
-                # 获取可用工具
-                available_tools = await self.mcp_handler.get_available_tools()
-
-                # 过滤 Agent 配置的工具
-                filtered_tools = [
-                    tool for tool in available_tools
-                    if any(mcp_tool in tool["function"]["name"] for mcp_tool in agent_tools)
-                ]
+                # 获取可用工具并过滤 Agent 配置的工具
+                filtered_tools = await self._select_tools(agent, formatted_messages, available_tools)
 
                 if filtered_tools:
-                    return await self._process_with_tools(
+                    response = await self._process_with_tools(
                         formatted_messages,
                         filtered_tools,
                         model,
-                        max_tokens
+                        max_tokens,
+                        usage,
+                        self._loop_limits(agent)
                     )
+                    if response.get("success", True):
+                        response["usage"] = usage.total()
+                    return response
 
             # 没有工具或使用流式时，直接调用 OpenAI
             if stream:
@@ -527,32 +1226,49 @@ class AgentHandler:
                     max_tokens=max_tokens
                 )
             else:
-                return await self.openai_handler.chat_completion(
+                response = await self.openai_handler.chat_completion(
                     messages=formatted_messages,
                     model=model,
-                    max_tokens=max_tokens
+                    max_tokens=max_tokens,
+                    usage=usage
                 )
+                response["usage"] = usage.total()
+                return response
 
-        except Agent.DoesNotExist:
+        except DoesNotExist:
             return {
                 "success": False,
                 "error": "Agent 不存在"
             }
         except Exception as e:
-            logger.error(f"处理消息失败: {str(e)}")
+            ERRORS_TOTAL.labels(component="agent", agent=agent_label(agent_id, agent is not None), model=model).inc()
+            logger.error("处理消息失败: %s", e)
             return {
                 "success": False,
                 "error": str(e)
             }
+        finally:
+            usage.finish()
+            GENERATION_SECONDS.labels(agent_label(agent_id, agent is not None), model).observe(
+                time.perf_counter() - started)
 
     async def process_message_stream(
         self,
         agent_id: int,
         messages: List[Dict[str, str]],
+        usage: Optional[UsageAccumulator] = None,
     ) -> AsyncGenerator[str, None]:
-        """处理消息并以流式方式返回回复，先进行 MCP 工具调用（如需要），再流式输出最终回复"""
+        """处理消息并以流式方式返回回复，先进行 MCP 工具调用（如需要），再流式输出最终回复
+
+        传入 usage 时各轮上游调用的用量累加到其中，供调用方在流结束后读取。
+        """
+        started = time.perf_counter()
+        model = ""
+        if usage is None:
+            usage = UsageAccumulator(agent_id)
+        agent = None
         try:
-            agent = await Agent.get(id=agent_id)
+            agent = await self.get_agent(agent_id)
 
             # 格式化消息
             formatted_messages = format_openai_messages(agent.prompt, messages)
@@ -561,176 +1277,489 @@ class AgentHandler:
             openai_config = agent.openai_config or {}
             model = openai_config.get("model", "qwen3:32b")
             max_tokens = openai_config.get("max_tokens")
+            usage.model = model
+            bind_agent(agent.id, openai_config)
 
             agent_tools = agent.mcp_tools or []
 
             if agent_tools:
-                available_tools = await self.mcp_handler.get_available_tools()
-                filtered_tools = [
-                    tool for tool in available_tools
-                    if any(mcp_tool in tool["function"]["name"] for mcp_tool in agent_tools)
-                ]
+                filtered_tools = await self._select_tools(agent, formatted_messages)
                 if filtered_tools:
                     # 输出工具准备信息
                     yield f"<mcp>🔧 准备调用 MCP 工具：{', '.join([tool['function']['name'] for tool in filtered_tools])}</mcp>\n\n"
 
-                    # 第一次调用，获取工具调用
-                    first = await self.openai_handler.chat_completion_with_tools(
-                        messages=formatted_messages,
-                        tools=filtered_tools,
-                        model=model,
-                        max_tokens=max_tokens,
-                    )
-                    if first.get("tool_calls"):
-                        yield f"<mcp>🎯 AI 决定调用 {len(first['tool_calls'])} 个工具</mcp>\n\n"
-
-                        # 将工具调用与结果加入消息
-                        messages_with_tools = list(formatted_messages)
-                        messages_with_tools.append({
-                            "role": "assistant",
-                            "content": first.get("content") or "",
-                            "tool_calls": first["tool_calls"],
-                        })
-                        for tool_call in first["tool_calls"]:
-                            function_name = tool_call["function"]["name"]
-
-                            # 安全解析 JSON 参数
-                            try:
-                                args_str = tool_call["function"]["arguments"]
-                                if args_str and args_str.strip():
-                                    function_args = json.loads(args_str)
-                                else:
-                                    function_args = {}
-                            except (json.JSONDecodeError, KeyError) as e:
-                                logger.error(f"解析工具参数失败: {e}, 原始参数: {tool_call.get('function', {}).get('arguments', 'N/A')}")
-                                function_args = {}
-
-                            # 输出工具调用详情
-                            yield f"<mcp>📞 调用工具: {function_name}</mcp>\n"
-                            yield f"<mcp>📝 参数: {json.dumps(function_args, ensure_ascii=False)}</mcp>\n\n"
-
-                            # 解析服务器名和工具名
-                            if function_name.startswith("time_http_"):
-                                server_name = "time_http"
-                                tool_name = function_name[10:]  # 移除 "time_http_" 前缀
-                            elif "_" in function_name:
-                                server_name, tool_name = function_name.split("_", 1)
-                            else:
-                                server_name = "time_http"  # 默认使用 time_http 服务器
-                                tool_name = function_name
-                            tool_result = await self.mcp_handler.call_mcp_tool(
-                                server_name, tool_name, function_args
-                            )
-
-                            # 输出工具结果
-                            yield f"<mcp>✅ 工具返回: {json.dumps(tool_result, ensure_ascii=False)}</mcp>\n\n"
-
-                            messages_with_tools.append({
-                                "role": "tool",
-                                "tool_call_id": tool_call["id"],
-                                "content": json.dumps(tool_result),
-                            })
-                        # 输出最终回复提示
-                        yield f"<mcp>🤖 基于工具结果生成最终回复...</mcp>\n\n"
-
-                        # 最终流式输出
-                        async for chunk in self.openai_handler.chat_completion_stream(
-                            messages=messages_with_tools,
-                            model=model,
-                            max_tokens=max_tokens,
-                        ):
-                            yield chunk
-                        return
+                    limits = self._loop_limits(agent)
+                    tokens = TOKENS_STREAMED_TOTAL.labels(agent.id, model)
+                    async for event, payload in self._tool_loop(
+                        formatted_messages, filtered_tools, model, max_tokens, usage, limits, stream=True
+                    ):
+                        if event == "delta":
+                            # 模型输出边生成边转发：不调用工具的轮次即最终回复
+                            tokens.inc()
+                            yield payload["content"]
+                        elif event == "round":
+                            yield f"<mcp>🎯 第 {payload['step']} 轮：AI 决定调用 {len(payload['tool_calls'])} 个工具</mcp>\n\n"
+                        elif event == "tool_call":
+                            yield f"<mcp>📞 调用工具: {payload['name']}</mcp>\n"
+                            yield f"<mcp>📝 参数: {json_dumps(payload['arguments'])}</mcp>\n\n"
+                        elif event == "tool_result":
+                            for piece in client_chunks(payload["result"], payload["server"], payload["tool"]):
+                                yield piece
+                        elif event == "stop":
+                            reason = payload["reason"]
+                            if reason == "completed":
+                                # 模型已不再调用工具，最终回复已随 delta 流式输出
+                                return
+                            yield f"<mcp>⏹️ {self._stop_notice(reason, limits)}</mcp>\n\n"
+                            if reason == "max_steps":
+                                # 轮数用尽但仍有时间与预算，不带工具让模型基于已有结果作答
+                                yield "<mcp>🤖 基于工具结果生成最终回复...</mcp>\n\n"
+                                async for chunk in self._stream_completion(
+                                    agent, formatted_messages, model, max_tokens, usage
+                                ):
+                                    yield chunk
+                            return
 
             # 无工具或无工具调用，直接流式输出
-            async for chunk in self.openai_handler.chat_completion_stream(
-                messages=formatted_messages,
-                model=model,
-                max_tokens=max_tokens,
-            ):
+            async for chunk in self._stream_completion(agent, formatted_messages, model, max_tokens, usage):
                 yield chunk
         except Exception as e:
-            logger.error(f"流式处理消息失败: {str(e)}")
+            ERRORS_TOTAL.labels(component="agent_stream", agent=agent_label(agent_id, agent is not None),
+                                model=model).inc()
+            logger.error("流式处理消息失败: %s", e)
             # 去掉兜底的模拟返回，直接抛出错误，便于上层捕获并返回真实错误
             raise
+        finally:
+            usage.finish()
+            GENERATION_SECONDS.labels(agent_label(agent_id, agent is not None), model).observe(
+                time.perf_counter() - started)
 
-    async def _process_with_tools(
+    async def process_batch(
         self,
-        messages: List[Dict[str, str]],
-        tools: List[Dict[str, Any]],
-        model: str,
-        max_tokens: int
+        items: List[Dict[str, Any]],
+        concurrency: int
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """以有界并发处理多条对话 {agent_id, messages, session_id?, id?}，按完成顺序逐条产出结果
+
+        同一批次的 Agent 配置与工具目录只查询一次，各条目共用；单条失败只体现在该条结果中。
+        结果中 index 为条目在请求中的位置，id 原样返回调用方传入的条目标识。
+        """
+        agent_ids = {self._batch_agent_id(item) for item in items} - {None}
+        # agent_id -> Agent，查询失败时为错误信息
+        agents: Dict[int, Any] = {}
+
+        async def lookup(agent_id: int) -> None:
+            try:
+                agents[agent_id] = await self.get_agent(agent_id)
+            except DoesNotExist:
+                agents[agent_id] = "Agent 不存在"
+            except Exception as e:
+                agents[agent_id] = f"获取 Agent 失败: {e}"
+
+        await asyncio.gather(*(lookup(agent_id) for agent_id in agent_ids))
+        available_tools = None
+        if any(isinstance(agent, Agent) and agent.mcp_tools for agent in agents.values()):
+            available_tools = await self.mcp_handler.get_available_tools()
+
+        results: asyncio.Queue = asyncio.Queue()
+        pending = iter(enumerate(items))
+
+        async def worker() -> None:
+            for index, item in pending:
+                await results.put(await self._batch_item(index, item, agents, available_tools))
+
+        workers = [asyncio.create_task(worker()) for _ in range(max(1, min(concurrency, len(items))))]
+        try:
+            for _ in range(len(items)):
+                yield await results.get()
+        finally:
+            # 客户端断开时停止剩余条目
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    @staticmethod
+    def _batch_agent_id(item: Any) -> Optional[int]:
+        if not isinstance(item, dict):
+            return None
+        return parse_agent_id(item.get("agent_id"))
+
+    async def _batch_item(
+        self,
+        index: int,
+        item: Any,
+        agents: Dict[int, Any],
+        available_tools: Optional[List[Dict[str, Any]]]
     ) -> Dict[str, Any]:
-        """使用工具处理消息"""
+        """处理批量中的单条对话，错误作为该条结果返回"""
+        result: Dict[str, Any] = {"index": index, "id": item.get("id") if isinstance(item, dict) else None}
+        agent_id = self._batch_agent_id(item)
+        if agent_id is None or not item.get("messages"):
+            return {**result, "success": False, "error": "缺少 agent_id 或 messages 参数"}
+        agent = agents.get(agent_id)
+        if not isinstance(agent, Agent):
+            return {**result, "success": False, "error": agent or "Agent 不存在"}
+        session_id = item.get("session_id")
         try:
-            # 第一次调用 OpenAI，可能会返回工具调用
-            response = await self.openai_handler.chat_completion_with_tools(
-                messages=messages,
-                tools=tools,
-                model=model,
-                max_tokens=max_tokens
-            )
-
-            # 检查是否需要调用工具
-            if response.get("tool_calls"):
-                # 处理工具调用
-                messages.append({
-                    "role": "assistant",
-                    "content": response.get("content") or "",
-                    "tool_calls": response["tool_calls"]
-                })
+            with start_trace("chat.batch_item", agent_id=agent_id, index=index):
+                response = await self.process_message(
+                    agent_id, item["messages"], session_id=str(session_id)[:128] if session_id else None,
+                    agent=agent, available_tools=available_tools,
+                )
+        except Exception as e:
+            response = {"success": False, "error": str(e)}
+        if not response.get("success", True):
+            return {**result, "success": False, "error": response.get("error", "处理消息失败")}
+        return {**result, "success": True, "data": response}
+
+    async def _run_job(self, job: Job) -> Dict[str, Any]:
+        """执行异步任务：流式处理消息，片段写入任务供实时订阅，结束后汇总为结果"""
+        set_request_class(job.priority_class, default=BATCH)
+        usage = UsageAccumulator(job.agent_id, session_id=job.session_id)
+        # job.chunks 有保留上限，结果按完整输出汇总
+        parts: List[str] = []
+        async for chunk in self.process_message_stream(job.agent_id, job.messages, usage=usage):
+            parts.append(chunk)
+            job.emit(chunk)
+        # 结果只保留回复正文，工具调用过程（<mcp> 标记）可从实时流中查看
+        content = _MCP_MARKUP_RE.sub("", "".join(parts)).strip()
+        return {"content": content, "role": "assistant", "usage": usage.total()}
+
+    async def _select_tools(
+        self,
+        agent: Agent,
+        messages: Optional[List[Dict[str, Any]]] = None,
+        available_tools: Optional[List[Dict[str, Any]]] = None
+    ) -> List[Dict[str, Any]]:
+        """获取可用工具（或使用传入的工具目录）并按 Agent 的 mcp_tools 过滤
+
+        配置了 tool_top_k 时，只保留与最新用户消息最相关的 k 个工具，
+        以及 always_include_tools 匹配的工具；没有任何工具相关时不做裁剪。
+        """
+        agent_tools = agent.mcp_tools or []
+        openai_config = agent.openai_config or {}
+        with span("tools.select", agent_id=agent.id) as sp, TOOL_DISCOVERY_SECONDS.labels(agent.id).time():
+            if available_tools is None:
+                available_tools = await self.mcp_handler.get_available_tools()
+            selected = [
+                tool for tool in available_tools
+                if any(mcp_tool in tool["function"]["name"] for mcp_tool in agent_tools)
+            ]
+            sp.set("available", len(available_tools))
 
-                # 执行工具调用
-                for tool_call in response["tool_calls"]:
-                    function_name = tool_call["function"]["name"]
+            try:
+                top_k = config_number(openai_config, "tool_top_k", self.tool_top_k, integer=True)
+                always = config_string_list(openai_config, "always_include_tools")
+            except ValueError as e:
+                # 校验之前写入的配置：不裁剪工具，不让该 Agent 的每次对话都失败
+                logger.warning("Agent %s 的 %s，不按相关度裁剪工具", agent.id, e)
+                top_k, always = 0, []
+            if top_k > 0 and len(selected) > top_k:
+                names = {tool["function"]["name"] for tool in selected}
+                relevant = set(self.mcp_handler.tool_index.top_k(self._latest_user_text(messages), top_k, names))
+                if relevant:
+                    # 保持目录原有顺序，便于上游复用 prompt 前缀缓存
+                    selected = [
+                        tool for tool in selected
+                        if tool["function"]["name"] in relevant
+                        or any(pattern in tool["function"]["name"] for pattern in always)
+                    ]
+                sp.set("top_k", top_k)
+            sp.set("selected", len(selected))
+            return selected
+
+    @staticmethod
+    def _latest_user_text(messages: Optional[List[Dict[str, Any]]]) -> str:
+        """最新一条用户消息的文本（兼容多段 content）"""
+        for message in reversed(messages or []):
+            if message.get("role") != "user":
+                continue
+            content = message.get("content")
+            if isinstance(content, list):
+                return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+            return content or ""
+        return ""
+
+    async def _stream_completion(
+        self,
+        agent: Agent,
+        messages: List[Dict[str, Any]],
+        model: str,
+        max_tokens: int,
+        usage: Optional[UsageAccumulator] = None
+    ) -> AsyncGenerator[str, None]:
+        """流式调用上游并统计输出的 token 片段数"""
+        tokens = TOKENS_STREAMED_TOTAL.labels(agent.id, model)
+        async for chunk in self.openai_handler.chat_completion_stream(
+            messages=messages,
+            model=model,
+            max_tokens=max_tokens,
+            usage=usage,
+        ):
+            tokens.inc()
+            yield chunk
+
+    def _loop_limits(self, agent: Agent) -> Dict[str, Any]:
+        """工具调用循环的上限：最大轮数、总时长（秒）与累计 token 预算（0 表示不限）"""
+        openai_config = agent.openai_config or {}
+        defaults = {
+            "max_tool_steps": max(1, self.max_tool_steps),
+            "tool_deadline_seconds": self.tool_deadline,
+            "token_budget": self.token_budget,
+        }
+        values = {}
+        for key, integer, minimum, exclusive in OPENAI_CONFIG_LIMITS:
+            if key not in defaults:
+                continue
+            try:
+                values[key] = config_number(openai_config, key, defaults[key], integer, minimum, exclusive)
+            except ValueError as e:
+                # 校验之前写入的配置：使用默认值，不让该 Agent 的每次对话都失败
+                logger.warning("Agent %s 的 %s，使用默认值 %s", agent.id, e, defaults[key])
+                values[key] = defaults[key]
+        return {
+            "max_steps": values["max_tool_steps"],
+            "deadline": values["tool_deadline_seconds"],
+            "token_budget": values["token_budget"],
+        }
 
-                    # 安全解析 JSON 参数
+    @staticmethod
+    def _stop_notice(reason: str, limits: Dict[str, Any]) -> str:
+        if reason == "max_steps":
+            return f"已达到最大工具调用轮数（{limits['max_steps']}），停止调用工具"
+        if reason == "deadline":
+            return f"工具调用超过时限（{limits['deadline']:g} 秒），已停止"
+        return f"已用完 token 预算（{limits['token_budget']}），已停止"
+
+    def _split_tool_name(self, function_name: str) -> Tuple[str, str]:
+        """将 `服务器名_工具名` 拆分为 (服务器名, 工具名)，服务器名本身可能包含下划线"""
+        for server_name in sorted(set(self.mcp_handler.mcp_servers) | {"time_http"}, key=len, reverse=True):
+            if function_name.startswith(server_name + "_"):
+                return server_name, function_name[len(server_name) + 1:]
+        if "_" in function_name:
+            server_name, tool_name = function_name.split("_", 1)
+            return server_name, tool_name
+        return "time_http", function_name  # 默认使用 time_http 服务器
+
+    async def _tool_loop(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: List[Dict[str, Any]],
+        model: str,
+        max_tokens: int,
+        usage: UsageAccumulator,
+        limits: Dict[str, Any],
+        stream: bool = False,
+    ) -> AsyncGenerator[Tuple[str, Dict[str, Any]], None]:
+        """有界的工具调用循环，直到模型不再调用工具或达到任一上限
+
+        逐步产出 (事件, 数据)：round / tool_call / tool_result 用于展示进度，
+        最后一个事件为 stop，reason 为 completed、max_steps、deadline 或 token_budget；
+        completed 时 content 为模型的最终回复。工具调用与结果会追加到 messages 中。
+        stream 为 True 时每轮以流式请求上游，模型输出的文本以 delta 事件逐段产出。
+        """
+        deadline_at = time.monotonic() + limits["deadline"]
+        steps = 0
+        content = ""
+        reason = "completed"
+        with span("agent.tool_loop", max_steps=limits["max_steps"]) as sp:
+            try:
+                while True:
+                    remaining = deadline_at - time.monotonic()
+                    if remaining <= 0:
+                        reason = "deadline"
+                        break
+                    response: Dict[str, Any] = {}
                     try:
-                        args_str = tool_call["function"]["arguments"]
-                        if args_str and args_str.strip():
-                            function_args = json.loads(args_str)
-                        else:
-                            function_args = {}
-                    except (json.JSONDecodeError, KeyError) as e:
-                        logger.error(f"解析工具参数失败: {e}, 原始参数: {tool_call.get('function', {}).get('arguments', 'N/A')}")
-                        function_args = {}
-
-                    # 解析服务器名和工具名
-                    if function_name.startswith("time_http_"):
-                        server_name = "time_http"
-                        tool_name = function_name[10:]  # 移除 "time_http_" 前缀
-                    elif "_" in function_name:
-                        server_name, tool_name = function_name.split("_", 1)
-                    else:
-                        server_name = "time_http"  # 默认使用 time_http 服务器
-                        tool_name = function_name
-
-                    # 调用 MCP 工具
-                    tool_result = await self.mcp_handler.call_mcp_tool(
-                        server_name, tool_name, function_args
-                    )
+                        async for kind, data in self._tool_round(
+                            messages, tools, model, max_tokens, usage, remaining, stream
+                        ):
+                            if kind == "delta":
+                                yield "delta", {"content": data}
+                            else:
+                                response = data
+                    except asyncio.TimeoutError:
+                        reason = "deadline"
+                        break
 
-                    # 添加工具结果到消息历史
+                    content = response.get("content") or ""
+                    if not response.get("tool_calls"):
+                        break
+
+                    steps += 1
+                    yield "round", {"step": steps, "tool_calls": response["tool_calls"]}
                     messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call["id"],
-                        "content": json.dumps(tool_result)
+                        "role": "assistant",
+                        "content": content,
+                        "tool_calls": response["tool_calls"],
                     })
+                    calls = []
+                    tool_results: List[Optional[Dict[str, Any]]] = []
+                    for tool_call in response["tool_calls"]:
+                        function_name = tool_call["function"]["name"]
+                        server_name, tool_name = self._split_tool_name(function_name)
+                        # 参数不合法的调用不发出，错误直接作为结果返回给模型
+                        function_args, invalid = self.mcp_handler.check_tool_arguments(
+                            server_name, tool_name, tool_call["function"].get("arguments")
+                        )
+                        yield "tool_call", {"name": function_name, "arguments": function_args}
+                        calls.append((tool_call, function_name, server_name, tool_name, function_args))
+                        tool_results.append(invalid)
+
+                    # 本轮的工具调用一起发出：同一服务器的批量共用会话，不同服务器并发
+                    valid = [i for i, result in enumerate(tool_results) if result is None]
+                    if valid:
+                        dispatched, timed_out = await self._dispatch_tool_calls(
+                            [calls[i][2:] for i in valid], deadline_at - time.monotonic(),
+                        )
+                        if timed_out:
+                            reason = "deadline"
+                        for index, result in zip(valid, dispatched):
+                            tool_results[index] = result
+                    for (tool_call, function_name, server_name, tool_name, _), tool_result in zip(calls, tool_results):
+                        yield "tool_result", {
+                            "name": function_name, "server": server_name, "tool": tool_name,
+                            "result": tool_result,
+                        }
+
+                        # 模型只看到按工具预算截断后的副本
+                        messages.append({
+                            "role": "tool",
+                            "tool_call_id": tool_call["id"],
+                            "content": json_dumps(for_model(tool_result, server_name, tool_name)),
+                        })
+
+                    if reason == "deadline":
+                        break
+                    if limits["token_budget"] and usage.total()["total_tokens"] >= limits["token_budget"]:
+                        reason = "token_budget"
+                        break
+                    if steps >= limits["max_steps"]:
+                        reason = "max_steps"
+                        break
+            finally:
+                sp.set("steps", steps)
+                sp.set("stop_reason", reason)
+                AGENT_TOOL_STEPS.labels(agent_label(usage.agent_id)).observe(steps)
+                AGENT_LOOP_STOPS_TOTAL.labels(agent_label(usage.agent_id), reason).inc()
+
+        yield "stop", {"reason": reason, "steps": steps, "content": content}
+
+    async def _tool_round(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: List[Dict[str, Any]],
+        model: str,
+        max_tokens: int,
+        usage: UsageAccumulator,
+        timeout: float,
+        stream: bool,
+    ) -> AsyncGenerator[Tuple[str, Any], None]:
+        """一轮带工具的上游调用：产出 ("delta", 文本)（仅流式）与最后的 ("response", 结果)，超时抛出 TimeoutError"""
+        if not stream:
+            yield "response", await asyncio.wait_for(
+                self.openai_handler.chat_completion_with_tools(
+                    messages=messages, tools=tools, model=model, max_tokens=max_tokens, usage=usage,
+                ),
+                timeout,
+            )
+            return
+        deadline_at = time.monotonic() + timeout
+        events = self.openai_handler.chat_completion_stream_with_tools(
+            messages=messages, tools=tools, model=model, max_tokens=max_tokens, usage=usage,
+        )
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.__anext__(), deadline_at - time.monotonic())
+                except StopAsyncIteration:
+                    return
+                yield event
+        finally:
+            await events.aclose()
+
+    async def _dispatch_tool_calls(
+        self,
+        calls: List[Tuple[str, str, Dict[str, Any]]],
+        timeout: float,
+    ) -> Tuple[List[Dict[str, Any]], bool]:
+        """按服务器分组批量调用 [(服务器, 工具, 参数)]，返回 (按原顺序的结果, 是否超过 timeout)
+
+        超时的服务器其调用结果记为“工具调用超时”，已完成的服务器结果保留。
+        """
+        groups: Dict[str, List[int]] = {}
+        for index, (server_name, _, _) in enumerate(calls):
+            groups.setdefault(server_name, []).append(index)
+
+        results: List[Dict[str, Any]] = [{"success": False, "error": "工具调用超时"} for _ in calls]
+        if timeout <= 0:
+            return results, True
+        tasks = {
+            asyncio.ensure_future(self.mcp_handler.call_mcp_tools(
+                server_name, [(calls[i][1], calls[i][2]) for i in indexes]
+            )): indexes
+            for server_name, indexes in groups.items()
+        }
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=timeout)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        for task in done:
+            if task.exception() is not None:
+                error = {"success": False, "error": str(task.exception())}
+                for index in tasks[task]:
+                    results[index] = error
+                continue
+            for index, result in zip(tasks[task], task.result()):
+                results[index] = result
+        return results, bool(pending)
 
-                # 再次调用 OpenAI 获取最终回复
-                final_response = await self.openai_handler.chat_completion(
+    async def _process_with_tools(
+        self,
+        messages: List[Dict[str, str]],
+        tools: List[Dict[str, Any]],
+        model: str,
+        max_tokens: int,
+        usage: Optional[UsageAccumulator] = None,
+        limits: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """使用工具处理消息：多轮工具调用直到模型给出最终回复或达到上限"""
+        if usage is None:
+            usage = UsageAccumulator(tracker=None)
+        if limits is None:
+            limits = {"max_steps": self.max_tool_steps, "deadline": self.tool_deadline, "token_budget": self.token_budget}
+        try:
+            stop: Dict[str, Any] = {}
+            async for event, payload in self._tool_loop(messages, tools, model, max_tokens, usage, limits):
+                if event == "stop":
+                    stop = payload
+
+            reason = stop["reason"]
+            if reason == "completed":
+                response = {"content": stop["content"], "role": "assistant"}
+            elif reason == "max_steps":
+                # 轮数用尽但仍有时间与预算，不带工具让模型基于已有结果作答
+                response = await self.openai_handler.chat_completion(
                     messages=messages,
                     model=model,
-                    max_tokens=max_tokens
+                    max_tokens=max_tokens,
+                    usage=usage
                 )
-
-                return final_response
             else:
-                # 没有工具调用，直接返回回复
-                return response
+                notice = self._stop_notice(reason, limits)
+                content = stop["content"]
+                response = {
+                    "content": f"{content}\n\n（{notice}）" if content else f"（{notice}）",
+                    "role": "assistant",
+                }
+            response["tool_steps"] = stop["steps"]
+            response["stop_reason"] = reason
+            return response
 
         except Exception as e:
-            logger.error(f"工具处理失败: {str(e)}")
+            logger.error("工具处理失败: %s", e)
             return {
                 "success": False,
                 "error": str(e)
@@ -753,13 +1782,13 @@ class AgentHandler:
                     "updated_at": agent.updated_at.isoformat()
                 }
             }
-        except Agent.DoesNotExist:
+        except DoesNotExist:
             return {
                 "success": False,
                 "error": "Agent 不存在"
             }
         except Exception as e:
-            logger.error(f"获取 Agent 信息失败: {str(e)}")
+            logger.error("获取 Agent 信息失败: %s", e)
             return {
                 "success": False,
                 "error": str(e)
@@ -784,7 +1813,7 @@ class AgentHandler:
                 ]
             }
         except Exception as e:
-            logger.error(f"获取 Agent 列表失败: {str(e)}")
+            logger.error("获取 Agent 列表失败: %s", e)
             return {
                 "success": False,
                 "error": str(e)
@@ -0,0 +1,278 @@
+"""
+异步对话任务（Job）
+
+多轮工具调用的对话可能持续数分钟，一直挂着 /api/chat/send 会占住连接，连接断开
+则前功尽弃。任务接口把一次对话放到后台执行，客户端提交后轮询状态、获取结果或
+随时附加到实时输出：
+
+- 队列：按 priority 从高到低执行（同优先级先进先出），由 AGENT_JOB_WORKERS 个
+  worker 协程执行；排队中的任务超过 AGENT_JOB_QUEUE_SIZE 时拒绝提交。
+- 期限：deadline_seconds（默认 AGENT_JOB_DEADLINE）从提交时起算，排队期间到期的任务
+  不再执行，执行中到期的任务被取消，状态均为 expired。
+- 取消：排队中的任务直接标记为 cancelled，执行中的任务取消其协程。
+- 输出：执行过程中的流式片段保存在任务中，附加到实时流时先回放已有片段再继续跟随。
+  每个任务最多保留 AGENT_JOB_MAX_EVENTS 个片段、AGENT_JOB_MAX_BYTES 字节，超出时丢弃
+  最早的片段；附加时需要的片段已被丢弃，则先输出一条省略提示，再从保留的最早片段继续。
+- 保留：结束的任务在 AGENT_JOB_TTL 秒后清除。
+- 调度：任务的上游调用默认按 batch 类别排队（见 llm_scheduler.py），不挤占交互对话。
+
+每个任务以提交请求的 X-Request-Id 作为执行时的请求 ID 与 Trace ID，日志与上游请求
+可以和提交请求关联。任务只保存在执行它的 worker 进程内，任务 ID 带有该 worker 的序号，
+多 worker 时查询、附加与取消请求经内部端口转交给所属 worker（见 worker_route.py）。
+"""
+
+import asyncio
+import contextvars
+import itertools
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional
+
+from log_pipeline import set_request_id
+from metrics import JOBS_TOTAL, JOB_QUEUE_DEPTH, JOB_QUEUE_WAIT_SECONDS
+from tracing import start_trace
+from worker_route import new_id
+from utils import logger
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+EXPIRED = "expired"
+FINISHED = {SUCCEEDED, FAILED, CANCELLED, EXPIRED}
+
+
+class JobQueueFull(Exception):
+    """排队中的任务已达上限"""
+
+
+class Job:
+    """一次后台执行的对话"""
+
+    def __init__(self, agent_id: int, messages: List[Dict[str, Any]], session_id: Optional[str],
+                 priority: int, deadline: float, request_id: Optional[str], priority_class: Optional[str] = None,
+                 max_events: int = 5000, max_bytes: int = 2 * 1024 * 1024):
+        self.id = new_id()
+        self.agent_id = agent_id
+        self.messages = messages
+        self.session_id = session_id
+        self.priority = priority
+        # 上游调度类别（见 llm_scheduler.py），为空时按 Agent 配置或默认 batch
+        self.priority_class = priority_class
+        self.deadline = deadline
+        self.request_id = request_id or self.id
+        self.status = QUEUED
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        # 保留的输出片段；chunk_offset 为已丢弃的最早片段数，片段的全局序号 = chunk_offset + 下标
+        self.chunks: Deque[str] = deque()
+        self.chunk_offset = 0
+        self.max_events = max(1, max_events)
+        self.max_bytes = max_bytes
+        self._chunk_bytes = 0
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.deadline_at = time.monotonic() + deadline
+        self.expires_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED
+
+    def _notify(self) -> None:
+        """唤醒所有等待新片段或状态变化的订阅者"""
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def emit(self, chunk: str) -> None:
+        """追加一个输出片段，超出保留上限时丢弃最早的片段"""
+        self.chunks.append(chunk)
+        self._chunk_bytes += len(chunk)
+        while len(self.chunks) > 1 and (len(self.chunks) > self.max_events or self._chunk_bytes > self.max_bytes):
+            self._chunk_bytes -= len(self.chunks.popleft())
+            self.chunk_offset += 1
+        self._notify()
+
+    async def wait(self, timeout: float) -> None:
+        """等待任务结束，最多 timeout 秒"""
+        end = time.monotonic() + timeout
+        while not self.finished:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+    async def follow(self) -> AsyncIterator[str]:
+        """从头回放输出片段，并跟随后续片段直到任务结束
+
+        需要的片段已超出保留窗口被丢弃时，先产出一条省略提示，再从保留的最早片段继续。
+        """
+        index = 0
+        while True:
+            changed = self._changed
+            if index < self.chunk_offset:
+                yield f"<mcp>⚠️ 已省略最早的 {self.chunk_offset - index} 个输出片段（超出任务输出保留上限）</mcp>\n\n"
+                index = self.chunk_offset
+            # 先取快照：产出片段期间 emit 可能修改 chunks
+            pending = list(itertools.islice(self.chunks, index - self.chunk_offset, None))
+            for chunk in pending:
+                yield chunk
+            index += len(pending)
+            if self.finished and index >= self.chunk_offset + len(self.chunks):
+                return
+            if index >= self.chunk_offset + len(self.chunks):
+                await changed.wait()
+
+    def to_dict(self, include_result: bool = True) -> Dict[str, Any]:
+        data: Dict[str, Any] = {
+            "id": self.id,
+            "status": self.status,
+            "agent_id": self.agent_id,
+            "session_id": self.session_id,
+            "priority": self.priority,
+            "priority_class": self.priority_class,
+            "deadline_seconds": self.deadline,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "events": self.chunk_offset + len(self.chunks),
+            "events_dropped": self.chunk_offset,
+            "error": self.error,
+        }
+        if include_result:
+            data["result"] = self.result
+        return data
+
+
+class JobManager:
+    """有界的优先级任务队列与 worker 池"""
+
+    def __init__(self, runner: Callable[[Job], Awaitable[Dict[str, Any]]], workers: int = 4,
+                 max_queued: int = 1000, default_deadline: float = 600.0, ttl: float = 3600.0,
+                 max_events: int = 5000, max_bytes: int = 2 * 1024 * 1024):
+        self._runner = runner
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self.default_deadline = default_deadline
+        self.ttl = ttl
+        self._jobs: Dict[str, Job] = {}
+        self._queue: "asyncio.PriorityQueue" = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._queued = 0
+        self._worker_tasks: List[asyncio.Task] = []
+
+    def _ensure_workers(self) -> None:
+        self._worker_tasks = [t for t in self._worker_tasks if not t.done()]
+        while len(self._worker_tasks) < self.workers:
+            # worker 在干净的上下文中运行，不继承首个提交请求的请求 ID 与 Trace
+            self._worker_tasks.append(asyncio.create_task(
+                self._worker(), name="agent-job-worker", context=contextvars.Context()
+            ))
+
+    def _sweep(self) -> None:
+        now = time.monotonic()
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.expires_at <= now]:
+            del self._jobs[job_id]
+
+    def submit(self, agent_id: int, messages: List[Dict[str, Any]], session_id: Optional[str] = None,
+               priority: int = 0, deadline: Optional[float] = None, request_id: Optional[str] = None,
+               priority_class: Optional[str] = None) -> Job:
+        """提交任务，排队数已满时抛出 JobQueueFull"""
+        self._sweep()
+        if self._queued >= self.max_queued:
+            raise JobQueueFull(f"排队中的任务已达上限（{self.max_queued}）")
+        job = Job(agent_id, messages, session_id, priority,
+                  deadline if deadline is not None else self.default_deadline, request_id, priority_class,
+                  self.max_events, self.max_bytes)
+        self._jobs[job.id] = job
+        self._queued += 1
+        JOB_QUEUE_DEPTH.set(self._queued)
+        self._queue.put_nowait((-priority, next(self._seq), job))
+        self._ensure_workers()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._sweep()
+        return self._jobs.get(job_id)
+
+    def remove(self, job_id: str) -> None:
+        self._jobs.pop(job_id, None)
+
+    def _finish(self, job: Job, status: str, error: Optional[str] = None) -> None:
+        if job.status == QUEUED:
+            self._queued -= 1
+            JOB_QUEUE_DEPTH.set(self._queued)
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        job.expires_at = time.monotonic() + self.ttl
+        JOBS_TOTAL.labels(status).inc()
+        job._notify()
+
+    async def cancel(self, job: Job, timeout: float = 5.0) -> None:
+        """取消排队中或执行中的任务，执行中的任务最多等待 timeout 秒完成清理"""
+        if job.status == QUEUED:
+            self._finish(job, CANCELLED, "任务已取消")
+        elif job.status == RUNNING and job._task is not None:
+            job._task.cancel()
+            await asyncio.wait({job._task}, timeout=timeout)
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, job = await self._queue.get()
+            if job.status != QUEUED:
+                continue
+            if job.deadline_at <= time.monotonic():
+                self._finish(job, EXPIRED, "任务在队列中等待超过期限，未执行")
+                continue
+            self._queued -= 1
+            JOB_QUEUE_DEPTH.set(self._queued)
+            JOB_QUEUE_WAIT_SECONDS.observe(time.time() - job.created_at)
+            job.status = RUNNING
+            job.started_at = time.time()
+            job._notify()
+            job._task = asyncio.create_task(self._execute(job), name=f"agent-job-{job.id}")
+            await asyncio.wait({job._task})
+
+    async def _execute(self, job: Job) -> None:
+        set_request_id(job.request_id)
+        status, error = SUCCEEDED, None
+        with start_trace("chat.job", trace_id=job.request_id, agent_id=job.agent_id,
+                         job_id=job.id, priority=job.priority) as trace:
+            try:
+                job.result = await asyncio.wait_for(self._runner(job), job.deadline_at - time.monotonic())
+            except asyncio.CancelledError:
+                status, error = CANCELLED, "任务已取消"
+                trace.root.status = "cancelled"
+            except Exception as e:
+                if job.deadline_at <= time.monotonic():
+                    status, error = EXPIRED, f"任务执行超过期限（{job.deadline:g} 秒）"
+                else:
+                    status, error = FAILED, str(e) or type(e).__name__
+                    logger.error("任务 %s 执行失败: %s", job.id, error)
+                trace.root.status = "error"
+                trace.root.set("error", error)
+        self._finish(job, status, error)
+
+    async def close(self) -> None:
+        """停止 worker 并取消执行中的任务"""
+        running = [j._task for j in self._jobs.values() if j.status == RUNNING and j._task is not None]
+        for task in running + self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*running, *self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    def stats(self) -> Dict[str, Any]:
+        counts: Dict[str, int] = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {"workers": self.workers, "queued": self._queued, "jobs": counts}
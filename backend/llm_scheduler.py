@@ -0,0 +1,258 @@
+"""
+上游 LLM 请求的优先级调度
+
+交互式的 /api/chat/stream 与批量、后台任务共用同一上游容量，批量任务一多就会拉高
+交互请求的首 token 延迟。OpenAIHandler 的每次上游调用先在这里取得并发额度
+（LLM_MAX_CONCURRENCY，0 表示不限制、不排队），额度用完时按以下规则排队：
+
+- 优先级类别：interactive（交互对话）、tool_followup（交互对话中工具结果返回后的
+  后续轮次）、batch（/api/chat/batch 与异步任务）。类别之间按权重
+  （LLM_CLASS_WEIGHTS，默认 interactive=8,tool_followup=4,batch=1）做加权公平排队，
+  低优先级类别仍按权重获得份额，不会被完全挤占。
+- 同一类别内按 Agent 做加权公平排队，权重取 openai_config.scheduler_weight
+  （默认 1），同一 Agent 的请求先进先出。
+- 防饿死：队首请求等待超过 LLM_SCHEDULER_MAX_WAIT 秒时不再比较权重，按到达顺序
+  优先调度。
+
+类别的确定：请求体 priority_class > Agent 的 openai_config.priority_class >
+接口默认值（对话接口为 interactive，批量与异步任务为 batch）。interactive 请求的
+后续轮次（最后一条消息为工具结果）自动归入 tool_followup。
+流式调用在整个流结束前一直占用额度。
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from metrics import (
+    LLM_SCHEDULER_WAIT_SECONDS, LLM_SCHEDULER_QUEUED, LLM_SCHEDULER_ACTIVE, LLM_SCHEDULER_STARVATION_TOTAL,
+)
+from tracing import span
+from utils import logger
+
+INTERACTIVE = "interactive"
+TOOL_FOLLOWUP = "tool_followup"
+BATCH = "batch"
+CLASSES = (INTERACTIVE, TOOL_FOLLOWUP, BATCH)
+
+# 接口设置的类别：(类别, 是否由请求显式指定)
+_requested: contextvars.ContextVar[Optional[Tuple[str, bool]]] = contextvars.ContextVar(
+    "llm_priority_requested", default=None
+)
+# 绑定 Agent 后的调度流：(类别, Agent 标识, 权重)
+_flow: contextvars.ContextVar[Optional[Tuple[str, str, float]]] = contextvars.ContextVar(
+    "llm_priority_flow", default=None
+)
+
+
+def normalize_class(value: Any) -> Optional[str]:
+    """规范化类别名，无效时返回 None"""
+    if isinstance(value, str) and value.strip().lower() in CLASSES:
+        return value.strip().lower()
+    return None
+
+
+def set_request_class(value: Any, default: str = INTERACTIVE) -> None:
+    """接口处理请求前调用：value 为请求体中的 priority_class，缺省时使用接口默认类别"""
+    cls = normalize_class(value)
+    _requested.set((cls, True) if cls else (default, False))
+
+
+def bind_agent(agent_id: int, openai_config: Optional[Dict[str, Any]]) -> None:
+    """确定 Agent 后调用：结合 Agent 配置得出本次请求的类别与权重
+
+    agent_id 须为查询到的 Agent.id，而不是请求中的原始值，否则 "7" 与 "07" 会成为不同的调度流。
+    """
+    openai_config = openai_config or {}
+    cls, explicit = _requested.get() or (INTERACTIVE, False)
+    if not explicit:
+        cls = normalize_class(openai_config.get("priority_class")) or cls
+    try:
+        weight = max(0.01, float(openai_config.get("scheduler_weight", 1)))
+    except (TypeError, ValueError):
+        weight = 1.0
+    _flow.set((cls, str(agent_id), weight))
+
+
+def parse_weights(text: str) -> Dict[str, float]:
+    """解析 "interactive=8,tool_followup=4,batch=1"，未列出的类别权重为 1"""
+    weights = {cls: 1.0 for cls in CLASSES}
+    for part in (text or "").split(","):
+        name, sep, value = part.partition("=")
+        cls = normalize_class(name)
+        if not sep or cls is None:
+            continue
+        try:
+            weights[cls] = max(0.01, float(value))
+        except ValueError:
+            logger.warning("LLM_CLASS_WEIGHTS 中的权重无效: %s", part)
+    return weights
+
+
+class _Waiter:
+    __slots__ = ("future", "cls", "enqueued_at", "queued")
+
+    def __init__(self, future: asyncio.Future, cls: str):
+        self.future = future
+        self.cls = cls
+        self.enqueued_at = time.monotonic()
+        self.queued = True
+
+
+class _Flow:
+    """一个 Agent 在某类别中的等待队列，tag 为其虚拟开始时间"""
+
+    def __init__(self, tag: float, weight: float):
+        self.tag = tag
+        self.weight = weight
+        self.waiters: Deque[_Waiter] = deque()
+
+
+class _ClassQueue:
+    """一个类别的等待队列：tag 为类别间的虚拟开始时间，vtime 为类别内的虚拟时间"""
+
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.tag = 0.0
+        self.vtime = 0.0
+        self.flows: Dict[str, _Flow] = {}
+
+
+class UpstreamScheduler:
+    """上游并发额度的分配：类别间、Agent 间两级开始时间公平排队（SFQ）"""
+
+    def __init__(self, max_concurrency: int = 32, weights: Optional[Dict[str, float]] = None,
+                 max_wait: float = 30.0):
+        self.max_concurrency = max_concurrency
+        self.max_wait = max_wait
+        self._classes = {cls: _ClassQueue(w) for cls, w in (weights or parse_weights("")).items()}
+        self._vtime = 0.0
+        self._active = 0
+        self._waiting = 0
+
+    def _resolve(self, messages: Optional[List[Dict[str, Any]]]) -> Tuple[str, str, float]:
+        flow = _flow.get()
+        if flow is None:
+            requested = _requested.get()
+            flow = (requested[0] if requested else INTERACTIVE, "", 1.0)
+        cls, agent, weight = flow
+        if cls == INTERACTIVE and messages and messages[-1].get("role") == "tool":
+            cls = TOOL_FOLLOWUP
+        return cls, agent, weight
+
+    def _enqueue(self, cls: str, agent: str, weight: float) -> _Waiter:
+        queue = self._classes[cls]
+        if not queue.flows:
+            # 空闲后重新排队的类别从当前虚拟时间开始，不积累空闲期间的份额
+            queue.tag = max(queue.tag, self._vtime)
+        flow = queue.flows.get(agent)
+        if flow is None:
+            flow = queue.flows[agent] = _Flow(queue.vtime, weight)
+        flow.weight = weight
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), cls)
+        flow.waiters.append(waiter)
+        self._waiting += 1
+        LLM_SCHEDULER_QUEUED.labels(cls).set(self._queued(cls))
+        return waiter
+
+    def _queued(self, cls: str) -> int:
+        return sum(len(flow.waiters) for flow in self._classes[cls].flows.values())
+
+    def _remove(self, waiter: _Waiter) -> None:
+        for agent, flow in list(self._classes[waiter.cls].flows.items()):
+            if waiter in flow.waiters:
+                flow.waiters.remove(waiter)
+                if not flow.waiters:
+                    del self._classes[waiter.cls].flows[agent]
+                break
+        waiter.queued = False
+        self._waiting -= 1
+        LLM_SCHEDULER_QUEUED.labels(waiter.cls).set(self._queued(waiter.cls))
+
+    def _next(self) -> _Waiter:
+        """选出下一个获得额度的请求并更新虚拟时间"""
+        oldest: Optional[Tuple[_ClassQueue, str, _Flow]] = None
+        for queue in self._classes.values():
+            for agent, flow in queue.flows.items():
+                if oldest is None or flow.waiters[0].enqueued_at < oldest[2].waiters[0].enqueued_at:
+                    oldest = (queue, agent, flow)
+        assert oldest is not None
+        if time.monotonic() - oldest[2].waiters[0].enqueued_at >= self.max_wait:
+            queue, agent, flow = oldest
+            LLM_SCHEDULER_STARVATION_TOTAL.labels(flow.waiters[0].cls).inc()
+        else:
+            queue = min((q for q in self._classes.values() if q.flows), key=lambda q: q.tag)
+            agent, flow = min(queue.flows.items(), key=lambda item: item[1].tag)
+
+        self._vtime = max(self._vtime, queue.tag)
+        queue.tag = max(queue.tag, self._vtime) + 1 / queue.weight
+        queue.vtime = max(queue.vtime, flow.tag)
+        flow.tag = max(flow.tag, queue.vtime) + 1 / flow.weight
+        waiter = flow.waiters.popleft()
+        if not flow.waiters:
+            del queue.flows[agent]
+        waiter.queued = False
+        self._waiting -= 1
+        LLM_SCHEDULER_QUEUED.labels(waiter.cls).set(self._queued(waiter.cls))
+        return waiter
+
+    def _dispatch(self) -> None:
+        while self._waiting and self._active < self.max_concurrency:
+            waiter = self._next()
+            if waiter.future.done():
+                # 等待方已被取消
+                continue
+            self._active += 1
+            waiter.future.set_result(None)
+        LLM_SCHEDULER_ACTIVE.set(self._active)
+
+    def _release(self) -> None:
+        self._active -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, messages: Optional[List[Dict[str, Any]]] = None):
+        """占用一个上游并发额度，额度用完时按类别与 Agent 排队"""
+        if self.max_concurrency <= 0:
+            yield
+            return
+        cls, agent, weight = self._resolve(messages)
+        started = time.monotonic()
+        if self._active < self.max_concurrency and not self._waiting:
+            self._active += 1
+            LLM_SCHEDULER_ACTIVE.set(self._active)
+        else:
+            waiter = self._enqueue(cls, agent, weight)
+            with span("llm.queue", priority_class=cls, agent=agent):
+                try:
+                    await waiter.future
+                except asyncio.CancelledError:
+                    if waiter.queued:
+                        self._remove(waiter)
+                    elif waiter.future.done() and not waiter.future.cancelled():
+                        # 已获得额度但随即被取消：归还
+                        self._release()
+                    raise
+        LLM_SCHEDULER_WAIT_SECONDS.labels(cls).observe(time.monotonic() - started)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self._active,
+            "queued": {cls: self._queued(cls) for cls in self._classes},
+        }
+
+
+upstream_scheduler = UpstreamScheduler(
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "32")),
+    weights=parse_weights(os.getenv("LLM_CLASS_WEIGHTS", "interactive=8,tool_followup=4,batch=1")),
+    max_wait=float(os.getenv("LLM_SCHEDULER_MAX_WAIT", "30")),
+)
@@ -0,0 +1,221 @@
+"""
+非阻塞结构化日志
+
+- 队列化：根 logger 只挂一个 QueueHandler，入队是一次 put_nowait；格式化与写 stdout
+  都在 QueueListener 线程中完成，事件循环不会被慢终端或日志洪峰阻塞。队列满时直接丢弃并计入
+  log_records_dropped_total{reason=queue_full}（限流丢弃计入 reason=rate_limited）。
+- 延迟格式化：入队时不拼接消息，%-参数留到监听线程里再展开，调用方应使用
+  logger.info("... %s", value) 而不是 f-string。
+- 结构化输出：LOG_FORMAT=json（默认）每条日志一行 JSON，text 为便于本地阅读的单行文本。
+- 限流与采样：按调用点（文件 + 行号）做令牌桶限流，超出速率后按 LOG_OVERFLOW_SAMPLE
+  比例采样放行，其余丢弃；下一条放行的日志带上 suppressed 字段说明丢了多少条。
+- 请求 ID：通过 contextvars 传播，日志自动带上 request_id。
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional, Tuple
+
+from metrics import LOG_RECORDS_DROPPED
+
+_request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{1,64}$")
+
+# LogRecord 自带的属性，其余属性视为 extra 字段输出
+_RESERVED_ATTRS = frozenset(vars(logging.makeLogRecord({})).keys()) | {"message", "asctime", "request_id", "suppressed", "sampled"}
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex
+
+
+def normalize_request_id(value: Optional[str]) -> str:
+    """客户端传入的请求 ID 合法时沿用，否则生成新的"""
+    if value and _REQUEST_ID_PATTERN.match(value):
+        return value
+    return new_request_id()
+
+
+def get_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+def set_request_id(request_id: Optional[str]):
+    """设置当前上下文的请求 ID，返回可用于 reset 的 token"""
+    return _request_id.set(request_id)
+
+
+class RequestIdFilter(logging.Filter):
+    """入队前把当前请求 ID 写入日志记录（contextvars 在监听线程中不可见）"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get()
+        return True
+
+
+class CallSiteRateLimitFilter(logging.Filter):
+    """按调用点令牌桶限流，超限部分按比例采样"""
+
+    def __init__(self, rate: float, burst: float, overflow_sample: float, exempt_level: int = logging.CRITICAL):
+        super().__init__()
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.overflow_sample = overflow_sample
+        self.exempt_level = exempt_level
+        # (pathname, lineno) -> [tokens, last_refill, suppressed]
+        self._buckets: Dict[Tuple[str, int], list] = {}
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0 or record.levelno >= self.exempt_level:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now, 0]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+        elif self.overflow_sample > 0 and random.random() < self.overflow_sample:
+            record.sampled = self.overflow_sample
+        else:
+            bucket[2] += 1
+            self.dropped += 1
+            LOG_RECORDS_DROPPED.labels("rate_limited").inc()
+            return False
+
+        if bucket[2]:
+            record.suppressed = bucket[2]
+            bucket[2] = 0
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """入队不格式化、队列满时丢弃的 QueueHandler"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 进程内队列无需序列化，保留 msg/args/exc_info，格式化延迟到监听线程
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            LOG_RECORDS_DROPPED.labels("queue_full").inc()
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data: Dict[str, Any] = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process,
+            "site": f"{record.module}:{record.lineno}",
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            data["request_id"] = request_id
+        suppressed = getattr(record, "suppressed", None)
+        if suppressed:
+            data["suppressed"] = suppressed
+        sampled = getattr(record, "sampled", None)
+        if sampled:
+            data["sampled"] = sampled
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """本地开发用的单行文本格式"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        if not hasattr(record, "request_id"):
+            record.request_id = None
+        line = super().format(record)
+        suppressed = getattr(record, "suppressed", None)
+        if suppressed:
+            line += f" (此前 {suppressed} 条同位置日志被限流)"
+        return line
+
+
+_listener: Optional[QueueListener] = None
+queue_handler: Optional[NonBlockingQueueHandler] = None
+rate_limit_filter: Optional[CallSiteRateLimitFilter] = None
+
+
+def setup_logging() -> None:
+    """配置根 logger（进程内只执行一次）"""
+    global _listener, queue_handler, rate_limit_filter
+    if _listener is not None:
+        return
+
+    level = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(TextFormatter() if os.getenv("LOG_FORMAT", "json").lower() == "text" else JsonFormatter())
+
+    log_queue: queue.Queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    rate_limit_filter = CallSiteRateLimitFilter(
+        rate=float(os.getenv("LOG_RATE_LIMIT", "20")),
+        burst=float(os.getenv("LOG_RATE_BURST", "50")),
+        overflow_sample=float(os.getenv("LOG_OVERFLOW_SAMPLE", "0.01")),
+    )
+    queue_handler.addFilter(rate_limit_filter)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """停止监听线程并写出队列中剩余的日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def logging_stats() -> Dict[str, int]:
+    return {
+        "queue_dropped": queue_handler.dropped if queue_handler else 0,
+        "rate_limited": rate_limit_filter.dropped if rate_limit_filter else 0,
+        "queue_size": queue_handler.queue.qsize() if queue_handler else 0,
+    }
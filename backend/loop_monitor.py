@@ -0,0 +1,165 @@
+"""
+事件循环延迟监控
+
+每个 worker 只有一个事件循环，任何同步阻塞调用（同步数据库会话、阻塞文件读写、
+大对象 JSON 序列化等）都会让所有连接同时卡住。这里用两部分定位这类问题：
+
+- 探测协程：每隔 interval 秒 sleep 一次，实际唤醒时间与预期之差即调度延迟，
+  写入直方图与最近窗口的分位数（p50/p95/p99/max）。
+- 看门狗线程：探测协程超过 threshold 秒没有心跳时，说明循环正被某个回调阻塞，
+  立即抓取事件循环线程的调用栈，阻塞结束后补记总时长。
+
+不依赖 Sanic，可同时用于 FastAPI 旧版应用。
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from metrics import EVENT_LOOP_LAG_SECONDS, EVENT_LOOP_LAG_QUANTILE_SECONDS, EVENT_LOOP_BLOCKED_TOTAL, nearest_rank
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class LoopLagMonitor:
+    """事件循环延迟探测与阻塞栈快照"""
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.1, window: int = 600,
+                 max_snapshots: int = 20, stack_depth: int = 30):
+        self.interval = interval
+        self.threshold = threshold
+        self.stack_depth = stack_depth
+        self._lags: Deque[float] = deque(maxlen=window)
+        self.snapshots: Deque[Dict[str, Any]] = deque(maxlen=max_snapshots)
+        self.blocked_events = 0
+        self.max_lag = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._heartbeat = 0.0
+        # 当前这次阻塞是否已抓取快照（每次阻塞只抓一次）
+        self._pending: Optional[Dict[str, Any]] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        """在事件循环线程中调用，启动探测协程与看门狗线程"""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = self._loop.create_task(self._probe())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _probe(self) -> None:
+        lag_histogram = EVENT_LOOP_LAG_SECONDS.labels()
+        ticks = 0
+        while True:
+            # uvloop 的 loop.time() 只有毫秒精度，这里用 perf_counter
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - expected)
+            self._heartbeat = time.monotonic()
+            lag_histogram.observe(lag)
+            self._lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+            pending = self._pending
+            if pending is not None:
+                # 阻塞已结束，补记总时长
+                pending["blocked_ms"] = round(lag * 1000, 2)
+                self._pending = None
+                logger.warning(
+                    "事件循环阻塞 %.1fms，阻塞时调用栈:\n%s", lag * 1000, "".join(pending["stack"])
+                )
+
+            ticks += 1
+            if ticks % 10 == 0:
+                for q, value in self.percentiles().items():
+                    EVENT_LOOP_LAG_QUANTILE_SECONDS.labels(q).set(value)
+
+    def _watch(self) -> None:
+        """看门狗线程：心跳超时即认为循环被阻塞，抓取循环线程当前调用栈"""
+        check = max(0.005, self.threshold / 4)
+        while not self._stopped.wait(check):
+            stalled = time.monotonic() - self._heartbeat - self.interval
+            if stalled < self.threshold or self._pending is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.format_stack(frame, limit=self.stack_depth)
+            del frame
+            snapshot = {
+                "at": time.time(),
+                "detected_after_ms": round(stalled * 1000, 2),
+                "blocked_ms": None,
+                "stack": stack,
+            }
+            self._pending = snapshot
+            self.snapshots.append(snapshot)
+            self.blocked_events += 1
+            EVENT_LOOP_BLOCKED_TOTAL.inc()
+
+    def percentiles(self) -> Dict[str, float]:
+        if not self._lags:
+            return {}
+        ordered = sorted(self._lags)
+        result = {str(q): nearest_rank(ordered, q) for q in QUANTILES}
+        result["1.0"] = ordered[-1]
+        return result
+
+    def snapshot(self, include_stacks: bool = True) -> Dict[str, Any]:
+        """当前统计：窗口内延迟分位数、阻塞次数与最近的阻塞栈"""
+        lag_ms = {
+            {"0.5": "p50", "0.95": "p95", "0.99": "p99", "1.0": "max"}[q]: round(v * 1000, 3)
+            for q, v in self.percentiles().items()
+        }
+        data: Dict[str, Any] = {
+            "running": self.running,
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            "samples": len(self._lags),
+            "lag_ms": lag_ms,
+            "max_lag_ms": round(self.max_lag * 1000, 3),
+            "blocked_events": self.blocked_events,
+        }
+        if include_stacks:
+            data["blocked"] = [dict(s) for s in reversed(self.snapshots)]
+        return data
+
+
+loop_monitor = LoopLagMonitor(
+    interval=float(os.getenv("LOOP_LAG_INTERVAL", "0.1")),
+    threshold=float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.1")),
+    window=int(os.getenv("LOOP_LAG_WINDOW", "600")),
+)
+
+
+def loop_monitor_enabled() -> bool:
+    return os.getenv("LOOP_MONITOR", "1").lower() not in ("0", "false", "no", "off")
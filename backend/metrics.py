@@ -0,0 +1,306 @@
+"""
+轻量级 Prometheus 风格指标
+
+不依赖 prometheus_client：每个指标按标签值缓存子项，observe/inc 仅是几次
+字典查找与加法，可以在生产环境常开。指标按 worker 进程独立统计：多 worker 共用
+一个端口时，每次抓取 /metrics 由任意一个 worker 响应，只包含该 worker 的计数。
+因此多 worker 时所有样本带 worker 标签（Registry.set_const_label），不同 worker 的
+计数器是不同的序列，不会被误判为重置；汇总时按 worker 以外的标签 sum(rate(...))。
+子项不会淘汰，标签值必须有界：来自请求或模型输出的值（agent_id、工具名）在使用前
+映射为已知值，未知的记为 unknown。
+"""
+
+import math
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Tuple, Sequence
+
+# 默认延迟分桶（秒），覆盖毫秒级 SSE 写入到分钟级的生成耗时
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def nearest_rank(ordered: Sequence[float], q: float) -> float:
+    """最近秩法分位数：ordered 为升序非空序列，q 取 0~1，返回第 ceil(q * n) 个值"""
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], *extra: str) -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    parts.extend(e for e in extra if e)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str, **kwargs: str):
+        """按标签值获取子项，子项会被缓存复用"""
+        if kwargs:
+            values = tuple(str(kwargs.get(n, "")) for n in self.labelnames)
+        else:
+            values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def render(self, const: str = "") -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """单调递增计数器"""
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def render(self, const: str = "") -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, values, const)} {child.value}"
+            for values, child in self._children.items()
+        ]
+
+
+class Gauge(_Metric):
+    """可任意设置的瞬时值"""
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def render(self, const: str = "") -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, values, const)} {child.value}"
+            for values, child in self._children.items()
+        ]
+
+
+class Histogram(_Metric):
+    """累积分桶直方图"""
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def render(self, const: str = "") -> List[str]:
+        lines = []
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, const, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, values, const)
+            lines.append(f"{self.name}_sum{labels} {child.sum}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Registry:
+    """指标注册表，负责输出 Prometheus 文本格式"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        # 附加到所有样本的常量标签
+        self._const = ""
+
+    def set_const_label(self, name: str, value: str) -> None:
+        label = f'{name}="{_escape(value)}"'
+        self._const = f"{self._const},{label}" if self._const else label
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.extend(metric.render(self._const))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# 热路径延迟
+AGENT_LOOKUP_SECONDS = registry.histogram(
+    "agent_lookup_seconds", "Agent 配置查询耗时", ["agent"])
+TOOL_DISCOVERY_SECONDS = registry.histogram(
+    "tool_discovery_seconds", "MCP 工具目录获取与过滤耗时", ["agent"])
+UPSTREAM_TTFT_SECONDS = registry.histogram(
+    "upstream_ttft_seconds", "上游 LLM 首个 token 延迟", ["model"])
+UPSTREAM_INTER_TOKEN_SECONDS = registry.histogram(
+    "upstream_inter_token_seconds", "上游 LLM 相邻 token 间隔", ["model"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+GENERATION_SECONDS = registry.histogram(
+    "generation_seconds", "单次对话请求总生成耗时（含工具调用）", ["agent", "model"])
+AGENT_TOOL_STEPS = registry.histogram(
+    "agent_tool_steps", "单次对话请求的工具调用轮数", ["agent"],
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20))
+MCP_TOOL_CALL_SECONDS = registry.histogram(
+    "mcp_tool_call_seconds", "MCP 工具调用耗时", ["server", "tool"])
+MCP_TOOL_RESULT_CHARS = registry.histogram(
+    "mcp_tool_result_chars", "MCP 工具返回文本的字符数", ["server", "tool"],
+    buckets=(100, 1000, 4000, 16000, 64000, 256000, 1000000, 4000000))
+SSE_WRITE_SECONDS = registry.histogram(
+    "sse_write_seconds", "SSE 事件写入耗时", [],
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0))
+
+# 计数器
+TOKENS_STREAMED_TOTAL = registry.counter(
+    "tokens_streamed_total", "流式输出的 token（增量片段）数", ["agent", "model"])
+TOKENS_USED_TOTAL = registry.counter(
+    "tokens_used_total", "上游 token 用量（source=upstream 为上游返回，estimated 为本地估算）",
+    ["agent", "model", "kind", "source"])
+AGENT_LOOP_STOPS_TOTAL = registry.counter(
+    "agent_loop_stops_total", "工具调用循环结束次数（completed / max_steps / deadline / token_budget）",
+    ["agent", "reason"])
+MCP_TOOL_ARGS_INVALID_TOTAL = registry.counter(
+    "mcp_tool_args_invalid_total", "参数未通过本地校验或工具不存在、未发出的 MCP 工具调用次数（reason=parse/schema/unknown_tool）",
+    ["server", "tool", "reason"])
+MCP_TOOL_BATCH_SIZE = registry.histogram(
+    "mcp_tool_batch_size", "同一会话上批量发送的 MCP 工具调用数", ["server"],
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 32))
+MCP_TOOL_RESULT_TRUNCATED_TOTAL = registry.counter(
+    "mcp_tool_result_truncated_total", "MCP 工具结果被截断的次数（target=model 发给模型 / client 发给客户端 / ingest 接收时）",
+    ["server", "tool", "target"])
+MCP_TOOL_CACHE_TOTAL = registry.counter(
+    "mcp_tool_cache_total", "MCP 工具结果缓存查询（hit 命中 / miss 未命中 / coalesced 合并到进行中的调用 / bypass 不可缓存）",
+    ["server", "tool", "result"])
+CACHE_HITS_TOTAL = registry.counter(
+    "cache_hits_total", "进程内缓存命中次数", ["cache"])
+CACHE_MISSES_TOTAL = registry.counter(
+    "cache_misses_total", "进程内缓存未命中次数", ["cache"])
+ERRORS_TOTAL = registry.counter(
+    "errors_total", "错误次数", ["component", "agent", "model", "server"])
+
+MCP_BREAKER_STATE = registry.gauge(
+    "mcp_breaker_state", "MCP 服务器熔断状态（0 closed / 1 half_open / 2 open）", ["server"])
+MCP_BREAKER_TRANSITIONS_TOTAL = registry.counter(
+    "mcp_breaker_transitions_total", "MCP 熔断器状态切换次数", ["server", "state"])
+MCP_STDIO_PROCESSES = registry.gauge(
+    "mcp_stdio_processes", "stdio MCP 服务器进程池中的进程数", ["server"])
+MCP_STDIO_RESTARTS_TOTAL = registry.counter(
+    "mcp_stdio_restarts_total", "stdio MCP 进程替换次数（crash / max_uses / error / spawn_failed）",
+    ["server", "reason"])
+MCP_TOOL_CACHE_ENTRIES = registry.gauge(
+    "mcp_tool_cache_entries", "MCP 工具结果缓存条目数")
+
+JOBS_TOTAL = registry.counter(
+    "jobs_total", "结束的异步任务数（succeeded / failed / cancelled / expired）", ["status"])
+JOB_QUEUE_DEPTH = registry.gauge(
+    "job_queue_depth", "排队中的异步任务数")
+JOB_QUEUE_WAIT_SECONDS = registry.histogram(
+    "job_queue_wait_seconds", "异步任务从提交到开始执行的等待时间", [],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0))
+
+LLM_SCHEDULER_WAIT_SECONDS = registry.histogram(
+    "llm_scheduler_wait_seconds", "上游请求在调度队列中的等待时间", ["priority_class"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+LLM_SCHEDULER_QUEUED = registry.gauge(
+    "llm_scheduler_queued", "排队等待上游并发额度的请求数", ["priority_class"])
+LLM_SCHEDULER_ACTIVE = registry.gauge(
+    "llm_scheduler_active", "占用上游并发额度的请求数")
+LLM_SCHEDULER_STARVATION_TOTAL = registry.counter(
+    "llm_scheduler_starvation_total", "等待超过 LLM_SCHEDULER_MAX_WAIT 而被优先调度的请求数", ["priority_class"])
+
+CHAT_WS_CONNECTIONS = registry.gauge(
+    "chat_ws_connections", "打开中的对话 WebSocket 连接数")
+CHAT_WS_STREAMS = registry.gauge(
+    "chat_ws_streams", "WebSocket 上进行中的对话流数")
+
+# 事件循环健康度
+EVENT_LOOP_LAG_SECONDS = registry.histogram(
+    "event_loop_lag_seconds", "事件循环调度延迟（定时器实际唤醒时间与预期之差）", [],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+EVENT_LOOP_LAG_QUANTILE_SECONDS = registry.gauge(
+    "event_loop_lag_quantile_seconds", "最近窗口内事件循环延迟分位数", ["quantile"])
+EVENT_LOOP_BLOCKED_TOTAL = registry.counter(
+    "event_loop_blocked_total", "事件循环被单个回调阻塞超过阈值的次数")
+
+# 日志管道
+LOG_RECORDS_DROPPED = registry.counter(
+    "log_records_dropped_total", "被丢弃的日志条数（queue_full 队列已满 / rate_limited 调用点限流）", ["reason"])
+LOG_QUEUE_SIZE = registry.gauge(
+    "log_queue_size", "日志队列中待写出的条数")
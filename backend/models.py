@@ -1,8 +1,23 @@
 from tortoise.models import Model
 from tortoise import fields
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Iterable, Optional
+from datetime import datetime
 import json
 
+
+def _serialize_fields(instance: Model, field_names: Iterable[str], empty_defaults: Dict[str, Any]) -> Dict[str, Any]:
+    """按字段名序列化模型实例，支持只加载部分字段（.only()）的实例"""
+    data: Dict[str, Any] = {}
+    for name in field_names:
+        value = getattr(instance, name, None)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif value is None and name in empty_defaults:
+            value = empty_defaults[name]()
+        data[name] = value
+    return data
+
+
 class Agent(Model):
     """Agent 模型 - 仅存储配置信息"""
     id = fields.IntField(pk=True)
@@ -13,22 +28,20 @@ class Agent(Model):
     openai_config = fields.JSONField(default=dict)  # OpenAI 配置
     created_at = fields.DatetimeField(auto_now_add=True)
     updated_at = fields.DatetimeField(auto_now=True)
+
+    # 可通过 fields= 参数投影输出的字段
+    SERIALIZABLE_FIELDS = ("id", "name", "description", "prompt", "mcp_tools", "openai_config", "created_at", "updated_at")
     
     class Meta:
         table = "agents"
     
-    def to_dict(self) -> Dict[str, Any]:
-        """转换为字典"""
-        return {
-            "id": self.id,
-            "name": self.name,
-            "description": self.description,
-            "prompt": self.prompt,
-            "mcp_tools": self.mcp_tools or [],
-            "openai_config": self.openai_config or {},
-            "created_at": self.created_at.isoformat() if self.created_at else None,
-            "updated_at": self.updated_at.isoformat() if self.updated_at else None
-        }
+    def to_dict(self, fields: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """转换为字典，fields 为空时输出全部字段"""
+        return _serialize_fields(
+            self,
+            fields or self.SERIALIZABLE_FIELDS,
+            {"mcp_tools": list, "openai_config": dict},
+        )
 
 class MCPServer(Model):
     """MCP 服务器模型"""
@@ -40,17 +53,12 @@ class MCPServer(Model):
     created_at = fields.DatetimeField(auto_now_add=True)
     updated_at = fields.DatetimeField(auto_now=True)
 
+    # 可通过 fields= 参数投影输出的字段
+    SERIALIZABLE_FIELDS = ("id", "name", "description", "api_url", "is_active", "created_at", "updated_at")
+
     class Meta:
         table = "mcp_servers"
 
-    def to_dict(self) -> Dict[str, Any]:
-        """转换为字典"""
-        return {
-            "id": self.id,
-            "name": self.name,
-            "description": self.description,
-            "api_url": self.api_url,
-            "is_active": self.is_active,
-            "created_at": self.created_at.isoformat() if self.created_at else None,
-            "updated_at": self.updated_at.isoformat() if self.updated_at else None
-        }
+    def to_dict(self, fields: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """转换为字典，fields 为空时输出全部字段"""
+        return _serialize_fields(self, fields or self.SERIALIZABLE_FIELDS, {})
@@ -0,0 +1,178 @@
+"""
+运行期性能剖析
+
+- 统计采样：后台线程按固定间隔读取事件循环线程的调用栈（sys._current_frames），
+  聚合为 collapsed stacks（flamegraph.pl / speedscope 可直接读取），开销与请求量无关。
+- cProfile：在事件循环线程上开启确定性剖析若干秒，输出 pstats 文本或原始 dump。
+- 单请求剖析：采样线程同时读取事件循环当前运行的 Task，只统计属于目标请求的样本，
+  结果挂到该请求的 Trace 上。
+"""
+
+import asyncio
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from tracing import current_trace
+
+DEFAULT_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+# pstats 文本的可选排序字段
+SORT_KEYS = tuple(key.value for key in pstats.SortKey)
+
+
+class ProfilerBusy(Exception):
+    """同一进程已有剖析在进行"""
+
+
+def _frame_label(code, cache: Dict[Any, str]) -> str:
+    label = cache.get(code)
+    if label is None:
+        label = cache[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return label
+
+
+def collapse_stack(frame, cache: Dict[Any, str]) -> str:
+    """将调用栈折叠为 root;...;leaf 形式"""
+    labels: List[str] = []
+    while frame is not None:
+        labels.append(_frame_label(frame.f_code, cache))
+        frame = frame.f_back
+    labels.reverse()
+    return ";".join(labels)
+
+
+def format_collapsed(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class StackSampler(threading.Thread):
+    """采样线程：周期性抓取目标线程的调用栈
+
+    指定 task 时只统计该 Task 正在事件循环上运行时的样本。
+    """
+
+    def __init__(self, thread_id: int, interval: float = DEFAULT_INTERVAL,
+                 loop: Optional[asyncio.AbstractEventLoop] = None, task: Optional[asyncio.Task] = None):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = max(0.001, interval)
+        self.loop = loop
+        self.task = task
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.idle = 0
+        self._stop_event = threading.Event()
+        self._labels: Dict[Any, str] = {}
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            if self.task is not None:
+                try:
+                    running = asyncio.current_task(self.loop)
+                except RuntimeError:
+                    running = None
+                if running is not self.task:
+                    self.idle += 1
+                    continue
+            self.stacks[collapse_stack(frame, self._labels)] += 1
+            self.samples += 1
+            del frame
+
+    def stop(self) -> Counter:
+        self._stop_event.set()
+        self.join()
+        return self.stacks
+
+    def summary(self, limit: int = 50) -> Dict[str, Any]:
+        return {
+            "interval_ms": round(self.interval * 1000, 3),
+            "samples": self.samples,
+            "idle_samples": self.idle,
+            "stacks": [{"stack": s, "count": c} for s, c in self.stacks.most_common(limit)],
+        }
+
+
+class ProcessProfiler:
+    """进程级剖析入口，同一时间只允许一个整进程剖析"""
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+
+    def _acquire(self) -> None:
+        if self._lock.locked():
+            raise ProfilerBusy("已有剖析正在进行")
+
+    async def sample(self, seconds: float, interval: float = DEFAULT_INTERVAL) -> StackSampler:
+        """对事件循环线程做统计采样"""
+        self._acquire()
+        async with self._lock:
+            sampler = StackSampler(threading.get_ident(), interval)
+            sampler.start()
+            try:
+                await asyncio.sleep(min(seconds, MAX_SECONDS))
+            finally:
+                sampler.stop()
+            return sampler
+
+    async def cprofile(self, seconds: float) -> cProfile.Profile:
+        """在事件循环线程上开启 cProfile"""
+        self._acquire()
+        async with self._lock:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                await asyncio.sleep(min(seconds, MAX_SECONDS))
+            finally:
+                profile.disable()
+            return profile
+
+
+process_profiler = ProcessProfiler()
+
+
+def pstats_text(profile: cProfile.Profile, sort: str = "cumulative", limit: int = 50) -> str:
+    """sort 须为 SORT_KEYS 之一，否则抛出 ValueError"""
+    stream = io.StringIO()
+    stats = pstats.Stats(profile, stream=stream)
+    stats.sort_stats(pstats.SortKey(sort)).print_stats(limit)
+    return stream.getvalue()
+
+
+def pstats_dump(profile: cProfile.Profile) -> bytes:
+    """与 Profile.dump_stats 相同的二进制格式，可用 pstats / snakeviz 打开"""
+    profile.create_stats()
+    return marshal.dumps(profile.stats)
+
+
+@contextmanager
+def profile_request(interval: float = DEFAULT_INTERVAL):
+    """剖析当前请求：只采样当前 Task，结束后写入当前 Trace 的 profile 字段"""
+    task = asyncio.current_task()
+    if task is None:
+        yield None
+        return
+    sampler = StackSampler(threading.get_ident(), interval, loop=asyncio.get_running_loop(), task=task)
+    started = time.perf_counter()
+    sampler.start()
+    try:
+        yield sampler
+    finally:
+        sampler.stop()
+        trace = current_trace()
+        if trace is not None:
+            profile = sampler.summary()
+            profile["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            profile["collapsed"] = format_collapsed(sampler.stacks)
+            trace.profile = profile
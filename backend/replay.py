@@ -0,0 +1,316 @@
+"""
+上游流量录制与回放
+
+RECORD_MODE=record 时，OpenAIHandler 发往上游的每个 HTTP 请求（含流式响应的逐块
+时间）、MCPClientHandler 的工具目录与工具调用结果、以及进入 /api/chat/* 的请求体，
+都按发生顺序写入 RECORD_DIR 下的 JSONL 文件（每个 worker 进程一个文件）。记录在调用方
+序列化后放入队列，由后台线程写文件，事件循环上不做文件 IO。
+
+RECORD_MODE=replay 时不再访问网络：上游请求按「方法 + 路径 + 规范化请求体」匹配
+录制内容，以原始时间回放响应；MCP 调用直接返回录制结果。REPLAY_TIME_SCALE 控制
+回放时间倍率（1 为原始时间，0.5 为加速一倍，0 为不等待）。录制文件在 worker 启动时
+于线程中加载为索引，不占用首个请求的延迟。配合
+bench/replay_session.py 重放录制的入站请求，即可离线对比不同版本的延迟与 CPU。
+"""
+
+import asyncio
+import atexit
+import codecs
+import glob
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import httpx
+
+from utils import logger, json_dumps
+
+RECORD = "record"
+REPLAY = "replay"
+
+
+def _request_key(method: str, path: str, body: bytes) -> str:
+    """请求匹配键：JSON 请求体按键排序后再哈希，字段顺序不同也能匹配"""
+    try:
+        canonical = json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    except Exception:
+        canonical = body.decode("utf-8", "replace")
+    digest = hashlib.sha1(f"{method} {path}\n{canonical}".encode("utf-8")).hexdigest()
+    return digest[:20]
+
+
+def _mcp_key(op: str, server: str, tool: str = "", arguments: Optional[Dict[str, Any]] = None) -> str:
+    args = json.dumps(arguments or {}, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return f"{op}:{server}:{tool}:{args}"
+
+
+class SessionRecorder:
+    """录制文件的写入与回放索引"""
+
+    def __init__(self, mode: str = "", directory: str = "recordings", time_scale: float = 1.0):
+        self.mode = mode if mode in (RECORD, REPLAY) else ""
+        self.directory = directory
+        self.time_scale = max(0.0, time_scale)
+        # 待写入的记录行，None 表示停止写入线程
+        self._queue: "queue.SimpleQueue[Optional[str]]" = queue.SimpleQueue()
+        self._writer: Optional[threading.Thread] = None
+        self._started = time.perf_counter()
+        self._index: Optional[Dict[str, Deque[Dict[str, Any]]]] = None
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == RECORD
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == REPLAY
+
+    # ---- 录制 ----
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        """追加一条录制记录（紧凑 JSON 单行），由写入线程落盘"""
+        if not self.recording:
+            return
+        try:
+            entry["t"] = round((time.perf_counter() - self._started) * 1000, 2)
+            line = json_dumps(entry) + "\n"
+        except Exception as e:
+            logger.warning("序列化录制记录失败: %s", e)
+            return
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, name="session-recorder", daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+        self._queue.put(line)
+
+    def _write_loop(self) -> None:
+        """写入线程：队列暂时取空时才 flush，录制洪峰时合并写入"""
+        path = os.path.join(self.directory, f"session-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.jsonl")
+        file = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            file = open(path, "a", encoding="utf-8")
+            logger.info("录制上游流量到 %s", path)
+        except Exception as e:
+            # 打不开文件时继续取出记录并丢弃，队列不会无限增长
+            logger.warning("打开录制文件失败: %s", e)
+        try:
+            while True:
+                line = self._queue.get()
+                if line is None:
+                    return
+                if file is None:
+                    continue
+                try:
+                    file.write(line)
+                    if self._queue.empty():
+                        file.flush()
+                except Exception as e:
+                    logger.warning("写入录制记录失败: %s", e)
+        finally:
+            if file is not None:
+                file.close()
+
+    def close(self) -> None:
+        """写出队列中剩余的记录并停止写入线程"""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join(timeout=5)
+            self._writer = None
+
+    def record_inbound(self, endpoint: str, body: Dict[str, Any]) -> None:
+        """录制进入 /api/chat/* 的请求，供 bench/replay_session.py 重放"""
+        if self.recording:
+            self.record({"kind": "inbound", "endpoint": endpoint, "body": body})
+
+    def record_mcp(self, op: str, server: str, tool: str, arguments: Optional[Dict[str, Any]],
+                   duration: float, result: Any) -> None:
+        if self.recording:
+            self.record({
+                "kind": "mcp",
+                "op": op,
+                "server": server,
+                "tool": tool,
+                "arguments": arguments or {},
+                "duration_ms": round(duration * 1000, 2),
+                "result": result,
+            })
+
+    # ---- 回放 ----
+
+    async def load(self) -> None:
+        """在线程中预先加载回放索引，避免首个回放请求在事件循环上读取、解析录制文件"""
+        if self.replaying and self._index is None:
+            await asyncio.to_thread(self._load)
+
+    def _load(self) -> Dict[str, Deque[Dict[str, Any]]]:
+        """加载 RECORD_DIR 下所有录制文件，按匹配键建立先进先出队列（启动时由 load 在线程中调用）"""
+        if self._index is not None:
+            return self._index
+        index: Dict[str, Deque[Dict[str, Any]]] = {}
+        files = sorted(glob.glob(os.path.join(self.directory, "*.jsonl")))
+        for path in files:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    if entry.get("kind") == "http":
+                        key = entry["key"]
+                    elif entry.get("kind") == "mcp":
+                        key = _mcp_key(entry["op"], entry["server"], entry.get("tool", ""), entry.get("arguments"))
+                    else:
+                        continue
+                    index.setdefault(key, deque()).append(entry)
+        logger.info("已加载 %d 个录制文件，共 %d 条记录", len(files), sum(len(entries) for entries in index.values()))
+        self._index = index
+        return index
+
+    def _take(self, key: str) -> Optional[Dict[str, Any]]:
+        """按录制顺序取出匹配记录，最后一条保留复用，便于多次重放"""
+        entries = self._load().get(key)
+        if not entries:
+            return None
+        return entries.popleft() if len(entries) > 1 else entries[0]
+
+    async def sleep(self, milliseconds: float) -> None:
+        if milliseconds > 0 and self.time_scale > 0:
+            await asyncio.sleep(milliseconds / 1000 * self.time_scale)
+
+    def replay_servers(self) -> Dict[str, Dict[str, Any]]:
+        """录制中出现过的 MCP 服务器，回放时代替数据库中的配置"""
+        servers: Dict[str, Dict[str, Any]] = {}
+        for entries in self._load().values():
+            entry = entries[0]
+            if entry.get("kind") == "mcp":
+                servers[entry["server"]] = {"transport": REPLAY, "url": "", "description": ""}
+        return servers
+
+    async def replay_mcp(self, op: str, server: str, tool: str = "",
+                         arguments: Optional[Dict[str, Any]] = None) -> Tuple[bool, Any]:
+        """回放 MCP 操作，返回 (是否命中, 录制结果)"""
+        entry = self._take(_mcp_key(op, server, tool, arguments))
+        if entry is None:
+            logger.warning("回放未命中 MCP 录制: %s %s %s", op, server, tool)
+            return False, None
+        await self.sleep(entry.get("duration_ms", 0))
+        return True, entry["result"]
+
+    # ---- httpx 传输层 ----
+
+    def wrap_transport(self, transport: httpx.AsyncBaseTransport) -> httpx.AsyncBaseTransport:
+        """根据模式包装上游传输层，未启用时原样返回"""
+        if self.recording:
+            return _RecordingTransport(transport, self)
+        if self.replaying:
+            return _ReplayTransport(self)
+        return transport
+
+
+class _RecordingStream(httpx.AsyncByteStream):
+    """透传响应体，同时记录每个数据块相对请求开始的时间"""
+
+    def __init__(self, inner: httpx.AsyncByteStream, entry: Dict[str, Any], started: float, recorder: SessionRecorder):
+        self._inner = inner
+        self._entry = entry
+        self._started = started
+        self._recorder = recorder
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._chunks: List[Tuple[float, str]] = []
+
+    async def __aiter__(self):
+        async for chunk in self._inner:
+            text = self._decoder.decode(chunk)
+            if text:
+                self._chunks.append((round((time.perf_counter() - self._started) * 1000, 2), text))
+            yield chunk
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+        tail = self._decoder.decode(b"", final=True)
+        if tail:
+            self._chunks.append((round((time.perf_counter() - self._started) * 1000, 2), tail))
+        self._entry["chunks"] = self._chunks
+        self._recorder.record(self._entry)
+
+
+class _RecordingTransport(httpx.AsyncBaseTransport):
+    def __init__(self, inner: httpx.AsyncBaseTransport, recorder: SessionRecorder):
+        self._inner = inner
+        self._recorder = recorder
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        # 录制时不接受压缩，保证数据块是可读文本且时间对应真实到达的内容
+        request.headers["Accept-Encoding"] = "identity"
+        started = time.perf_counter()
+        response = await self._inner.handle_async_request(request)
+        entry = {
+            "kind": "http",
+            "key": _request_key(request.method, request.url.path, body),
+            "method": request.method,
+            "path": request.url.path,
+            "status": response.status_code,
+            "content_type": response.headers.get("content-type", ""),
+            "ttfb_ms": round((time.perf_counter() - started) * 1000, 2),
+        }
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_RecordingStream(response.stream, entry, started, self._recorder),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+class _ReplayStream(httpx.AsyncByteStream):
+    """按录制的时间间隔逐块吐出响应体"""
+
+    def __init__(self, entry: Dict[str, Any], recorder: SessionRecorder):
+        self._entry = entry
+        self._recorder = recorder
+
+    async def __aiter__(self):
+        elapsed = self._entry.get("ttfb_ms", 0)
+        for offset, text in self._entry.get("chunks", []):
+            await self._recorder.sleep(offset - elapsed)
+            elapsed = offset
+            yield text.encode("utf-8")
+
+
+class _ReplayTransport(httpx.AsyncBaseTransport):
+    def __init__(self, recorder: SessionRecorder):
+        self._recorder = recorder
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        entry = self._recorder._take(_request_key(request.method, request.url.path, body))
+        if entry is None:
+            logger.warning("回放未命中上游录制: %s %s", request.method, request.url.path)
+            return httpx.Response(
+                status_code=599,
+                json={"error": {"message": "replay: 未找到匹配的录制请求"}},
+                request=request,
+            )
+        await self._recorder.sleep(entry.get("ttfb_ms", 0))
+        headers = {"content-type": entry["content_type"]} if entry.get("content_type") else {}
+        return httpx.Response(
+            status_code=entry["status"],
+            headers=headers,
+            stream=_ReplayStream(entry, self._recorder),
+            request=request,
+        )
+
+
+session_recorder = SessionRecorder(
+    mode=os.getenv("RECORD_MODE", "").lower(),
+    directory=os.getenv("RECORD_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings")),
+    time_scale=float(os.getenv("REPLAY_TIME_SCALE", "1.0")),
+)
@@ -0,0 +1,320 @@
+"""
+stdio MCP 服务器进程池
+
+api_url 形如 `stdio://python mcp_example/time_server.py stdio` 的 MCP 服务器以子进程方式
+运行。每次调用都新起进程要付出进程创建与解释器启动的几百毫秒，这里为每个服务器维护
+一组预先启动、长期存活的会话：
+
+- 预热：服务器加载后即启动 MCP_STDIO_POOL_SIZE 个进程并完成 initialize。
+- 并发：每个进程同时处理的请求数不超过 MCP_STDIO_MAX_CONCURRENCY，全部占满时排队等待。
+- 回收：进程累计处理 MCP_STDIO_MAX_USES 次请求后退役，处理完手上的请求再退出，
+  同时补起新进程；调用出现传输层异常或超时的进程也按同样方式替换。
+- 崩溃重启：进程意外退出时自动补起；尚未就绪就退出的视为启动失败，不自动重试，
+  由下一次请求重新尝试并把错误返回给调用方（交给熔断器处理）。
+
+会话的 anyio 任务组必须在创建它的任务中退出，所以每个进程由独立的任务持有，
+调用方只借用 ClientSession 发送请求。
+"""
+
+import asyncio
+import os
+import shlex
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from circuit_breaker import describe_error
+from metrics import MCP_STDIO_PROCESSES, MCP_STDIO_RESTARTS_TOTAL
+from utils import logger
+
+STDIO_SCHEME = "stdio://"
+
+# 相对路径的脚本按项目根目录解析
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_stdio_url(url: str) -> Tuple[str, List[str]]:
+    """解析 stdio:// 地址为 (命令, 参数列表)，命令为空时抛出 ValueError"""
+    try:
+        parts = shlex.split(url[len(STDIO_SCHEME):])
+    except ValueError as e:
+        raise ValueError(f"stdio:// 地址格式错误: {e}") from None
+    if not parts:
+        raise ValueError("stdio:// 地址缺少启动命令")
+    command, args = parts[0], parts[1:]
+    if command in ("python", "python3"):
+        # 与后端使用同一个解释器，保证能导入 mcp 等依赖
+        command = sys.executable
+    return command, args
+
+
+class _WatchedStream:
+    """包装 MCP 读取流：子进程 stdout 关闭（进程退出）时回调通知"""
+
+    def __init__(self, inner: Any, on_close):
+        self._inner = inner
+        self._on_close = on_close
+
+    async def __aenter__(self):
+        await self._inner.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return await self._inner.__aexit__(*exc_info)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._inner.__anext__()
+        except StopAsyncIteration:
+            self._on_close()
+            raise
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+class _StdioProcess:
+    """池中的单个子进程及其 MCP 会话"""
+
+    def __init__(self, pool: "StdioPool"):
+        self.pool = pool
+        self.session: Any = None
+        self.ready = False
+        self.was_ready = False
+        self.retiring = False
+        self.inflight = 0
+        self.uses = 0
+        self.error: Optional[BaseException] = None
+        self.started_at = time.time()
+        self._stop = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name=f"mcp-stdio-{pool.name}")
+
+    @property
+    def alive(self) -> bool:
+        return not self._task.done()
+
+    async def _run(self) -> None:
+        from mcp import ClientSession, StdioServerParameters
+        from mcp.client.stdio import stdio_client
+
+        params = StdioServerParameters(command=self.pool.command, args=self.pool.args, cwd=PROJECT_ROOT)
+        try:
+            async with stdio_client(params) as (read, write):
+                async with ClientSession(_WatchedStream(read, self._stop.set), write) as session:
+                    await asyncio.wait_for(session.initialize(), self.pool.connect_timeout)
+                    self.session = session
+                    self.ready = self.was_ready = True
+                    self.pool._notify()
+                    await self._stop.wait()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            self.ready = False
+            self.session = None
+            self.pool._exited(self)
+
+    def stop(self) -> None:
+        """通知进程退出（等当前请求完成后由池调用）"""
+        self.retiring = True
+        self._stop.set()
+
+    async def close(self, timeout: float = 5.0) -> None:
+        self.stop()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self._task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "retiring": self.retiring,
+            "inflight": self.inflight,
+            "uses": self.uses,
+            "started_at": self.started_at,
+        }
+
+
+class StdioPool:
+    """单个 stdio MCP 服务器的进程池"""
+
+    def __init__(self, name: str, url: str, size: int = 2, max_uses: int = 500,
+                 max_concurrency: int = 4, connect_timeout: float = 10.0):
+        self.name = name
+        self.url = url
+        self.command, self.args = parse_stdio_url(url)
+        self.size = max(1, size)
+        self.max_uses = max(1, max_uses)
+        self.max_concurrency = max(1, max_concurrency)
+        self.connect_timeout = connect_timeout
+        self.closed = False
+        self._procs: List[_StdioProcess] = []
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        """唤醒所有等待可用进程的请求"""
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _live(self) -> List[_StdioProcess]:
+        return [p for p in self._procs if not p.retiring]
+
+    def _spawn(self) -> _StdioProcess:
+        proc = _StdioProcess(self)
+        self._procs.append(proc)
+        MCP_STDIO_PROCESSES.labels(self.name).set(len(self._procs))
+        return proc
+
+    def warm(self) -> None:
+        """补足进程数到 size"""
+        while not self.closed and len(self._live()) < self.size:
+            self._spawn()
+
+    def _exited(self, proc: _StdioProcess) -> None:
+        if proc in self._procs:
+            self._procs.remove(proc)
+        MCP_STDIO_PROCESSES.labels(self.name).set(len(self._procs))
+        if not self.closed and not proc.retiring:
+            if proc.was_ready:
+                MCP_STDIO_RESTARTS_TOTAL.labels(self.name, "crash").inc()
+                logger.warning("stdio MCP 服务器 %s 进程意外退出，重新启动", self.name)
+                self.warm()
+            else:
+                MCP_STDIO_RESTARTS_TOTAL.labels(self.name, "spawn_failed").inc()
+                logger.error("stdio MCP 服务器 %s 启动失败: %s", self.name,
+                             describe_error(proc.error) if proc.error else "进程已退出")
+        self._notify()
+
+    def _retire(self, proc: _StdioProcess, reason: str) -> None:
+        proc.retiring = True
+        MCP_STDIO_RESTARTS_TOTAL.labels(self.name, reason).inc()
+        self.warm()
+
+    async def _acquire(self) -> _StdioProcess:
+        spawned: Optional[_StdioProcess] = None
+        while True:
+            if self.closed:
+                raise RuntimeError(f"stdio MCP 服务器 {self.name} 的进程池已关闭")
+            candidates = [
+                p for p in self._procs
+                if p.ready and not p.retiring and p.inflight < self.max_concurrency
+            ]
+            if candidates:
+                proc = min(candidates, key=lambda p: p.inflight)
+                proc.inflight += 1
+                return proc
+            if spawned is not None and not spawned.alive and not spawned.was_ready:
+                cause = describe_error(spawned.error) if spawned.error else "进程已退出"
+                raise RuntimeError(f"stdio MCP 服务器 {self.name} 启动失败: {cause}")
+            if spawned is None and len(self._live()) < self.size:
+                spawned = self._spawn()
+            await self._changed.wait()
+
+    def _release(self, proc: _StdioProcess, failed: bool) -> None:
+        proc.inflight -= 1
+        proc.uses += 1
+        if not proc.retiring:
+            if failed:
+                self._retire(proc, "error")
+            elif proc.uses >= self.max_uses:
+                self._retire(proc, "max_uses")
+        if proc.retiring and proc.inflight == 0:
+            proc.stop()
+        self._notify()
+
+    @asynccontextmanager
+    async def session(self):
+        """借用一个就绪进程的 ClientSession"""
+        proc = await self._acquire()
+        failed = False
+        try:
+            yield proc.session
+        except BaseException as e:
+            # 传输层异常或超时取消后进程状态不可信，替换掉；协议层错误（如工具不存在）除外
+            failed = not is_protocol_error(e)
+            raise
+        finally:
+            self._release(proc, failed)
+
+    async def close(self) -> None:
+        self.closed = True
+        await asyncio.gather(*(p.close() for p in list(self._procs)), return_exceptions=True)
+        self._notify()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "size": self.size,
+            "max_uses": self.max_uses,
+            "max_concurrency": self.max_concurrency,
+            "processes": [p.stats() for p in self._procs],
+        }
+
+
+def is_protocol_error(error: BaseException) -> bool:
+    """是否为 MCP 协议层错误（服务器正常返回的 JSON-RPC 错误），这类错误不说明连接已损坏"""
+    try:
+        from mcp.shared.exceptions import McpError
+        from mcp.types import CONNECTION_CLOSED
+    except Exception:
+        return False
+    return isinstance(error, McpError) and error.error.code != CONNECTION_CLOSED
+
+
+class StdioPoolManager:
+    """按服务器名管理进程池，地址变化或服务器删除时关闭旧池"""
+
+    def __init__(self, size: int = 2, max_uses: int = 500, max_concurrency: int = 4):
+        self.size = size
+        self.max_uses = max_uses
+        self.max_concurrency = max_concurrency
+        self._pools: Dict[str, StdioPool] = {}
+        self._closing: Set[asyncio.Task] = set()
+
+    def get(self, name: str, url: str, connect_timeout: Optional[float] = None) -> StdioPool:
+        """获取（必要时创建并预热）服务器的进程池"""
+        pool = self._pools.get(name)
+        if pool is not None and pool.url != url:
+            self._close_later(self._pools.pop(name))
+            pool = None
+        if pool is None:
+            pool = self._pools[name] = StdioPool(
+                name, url, self.size, self.max_uses, self.max_concurrency,
+                connect_timeout if connect_timeout is not None else 10.0,
+            )
+        elif connect_timeout is not None:
+            pool.connect_timeout = connect_timeout
+        pool.warm()
+        return pool
+
+    def retain(self, servers: Dict[str, str]) -> None:
+        """只保留 {服务器名: 地址} 中仍然存在且地址未变的进程池"""
+        for name in list(self._pools):
+            if servers.get(name) != self._pools[name].url:
+                self._close_later(self._pools.pop(name))
+
+    def _close_later(self, pool: StdioPool) -> None:
+        task = asyncio.create_task(pool.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def close_all(self) -> None:
+        pools = list(self._pools.values())
+        self._pools.clear()
+        await asyncio.gather(*(p.close() for p in pools), *self._closing, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {name: pool.stats() for name, pool in self._pools.items()}
+
+
+stdio_pools = StdioPoolManager(
+    size=int(os.getenv("MCP_STDIO_POOL_SIZE", "2")),
+    max_uses=int(os.getenv("MCP_STDIO_MAX_USES", "500")),
+    max_concurrency=int(os.getenv("MCP_STDIO_MAX_CONCURRENCY", "4")),
+)
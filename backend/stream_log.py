@@ -0,0 +1,182 @@
+"""
+可续传的 SSE 流
+
+/api/chat/stream 的生成过程与 HTTP 连接解耦：生成在后台任务中进行，事件按序编号写入
+有界的内存日志，响应只是日志的一个订阅者。连接中途断开后，客户端带上
+Last-Event-ID（`流 ID:序号`）重新请求即可从下一个事件继续，正在生成的流继续跟随，
+已结束的流回放缓冲的尾部，不会再次调用上游。
+
+- 编号：每个事件前加 `id: 流ID:序号` 行，序号从 1 开始。
+- 缓冲：每个流最多保留 STREAM_REPLAY_MAX_EVENTS 个事件、STREAM_REPLAY_MAX_BYTES 字节，
+  超出时丢弃最早的事件；续传点已被丢弃时无法续传。
+- 保留：流结束后保留 STREAM_REPLAY_TTL 秒。
+- 断开：没有订阅者的流在 STREAM_RESUME_GRACE 秒内无人续传则取消生成。
+
+流只保存在创建它的 worker 进程内，流 ID 带有该 worker 的序号；多 worker 时续传请求经内部
+端口转交给所属 worker（见 worker_route.py）。该路由只覆盖单机，多台机器部署需要负载均衡
+保持会话（sticky），否则落到其他实例的续传按流不存在（410）处理。
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, Optional, Tuple
+
+from utils import logger
+from worker_route import new_id
+
+
+class StreamLog:
+    """单个流的事件日志"""
+
+    def __init__(self, stream_id: str, max_events: int, max_bytes: int, grace: float):
+        self.id = stream_id
+        self.max_events = max(1, max_events)
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self.finished = False
+        self.expires_at = 0.0
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        # 生成方的 Trace，订阅方结束后补充写入耗时
+        self.trace: Any = None
+        self._events: Deque[Tuple[int, str]] = deque()
+        self._bytes = 0
+        self._next_seq = 1
+        self._changed = asyncio.Event()
+        self._orphan_timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def last_seq(self) -> int:
+        return self._next_seq - 1
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def append(self, payload: str) -> int:
+        """追加一个 SSE 事件（不含 id 行，以空行结尾），返回其序号"""
+        seq = self._next_seq
+        self._next_seq += 1
+        event = f"id: {self.id}:{seq}\n{payload}"
+        self._events.append((seq, event))
+        self._bytes += len(event)
+        while len(self._events) > 1 and (len(self._events) > self.max_events or self._bytes > self.max_bytes):
+            _, dropped = self._events.popleft()
+            self._bytes -= len(dropped)
+        self._notify()
+        return seq
+
+    def finish(self, ttl: float) -> None:
+        self.finished = True
+        self.expires_at = time.monotonic() + ttl
+        self._notify()
+
+    def can_resume(self, after_seq: int) -> bool:
+        """after_seq 之后的事件是否都还在缓冲中"""
+        if after_seq > self.last_seq:
+            return False
+        oldest = self._events[0][0] if self._events else self._next_seq
+        return after_seq + 1 >= oldest
+
+    async def follow(self, after_seq: int = 0) -> AsyncIterator[str]:
+        """产出 after_seq 之后的事件（已带 id 行），跟随到流结束；订阅期间计为一个订阅者"""
+        self._attach()
+        try:
+            next_seq = after_seq + 1
+            while True:
+                changed = self._changed
+                oldest = self._events[0][0] if self._events else self._next_seq
+                if next_seq < oldest:
+                    # 订阅方落后太多，需要的事件已被丢弃
+                    yield f"id: {self.id}:{self.last_seq}\ndata: [ERROR] 续传缓冲区已溢出，请重新发送\n\n"
+                    return
+                for seq, event in list(self._events):
+                    if seq >= next_seq:
+                        yield event
+                        next_seq = seq + 1
+                if self.finished and next_seq > self.last_seq:
+                    return
+                await changed.wait()
+        finally:
+            self._detach()
+
+    def _attach(self) -> None:
+        self.subscribers += 1
+        if self._orphan_timer is not None:
+            self._orphan_timer.cancel()
+            self._orphan_timer = None
+
+    def _detach(self) -> None:
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.finished and self.task is not None:
+            self._orphan_timer = asyncio.get_running_loop().call_later(self.grace, self._cancel_orphan)
+
+    def _cancel_orphan(self) -> None:
+        self._orphan_timer = None
+        if self.subscribers == 0 and not self.finished and self.task is not None:
+            logger.info("流 %s 在 %g 秒内无人续传，停止生成", self.id, self.grace)
+            self.task.cancel()
+
+
+class StreamRegistry:
+    """按流 ID 管理事件日志，结束超过 TTL 的流在访问时清除"""
+
+    def __init__(self, ttl: float = 60.0, max_events: int = 5000, max_bytes: int = 2 * 1024 * 1024,
+                 grace: float = 30.0):
+        self.ttl = ttl
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self._logs: Dict[str, StreamLog] = {}
+
+    def _sweep(self) -> None:
+        now = time.monotonic()
+        for stream_id in [s.id for s in self._logs.values() if s.finished and s.expires_at <= now]:
+            del self._logs[stream_id]
+
+    def create(self) -> StreamLog:
+        self._sweep()
+        log = StreamLog(new_id(), self.max_events, self.max_bytes, self.grace)
+        self._logs[log.id] = log
+        return log
+
+    def get(self, stream_id: str) -> Optional[StreamLog]:
+        self._sweep()
+        return self._logs.get(stream_id)
+
+    def finish(self, log: StreamLog) -> None:
+        log.finish(self.ttl)
+
+    async def close(self) -> None:
+        """取消仍在生成的流"""
+        running = [s.task for s in self._logs.values() if not s.finished and s.task is not None]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "streams": len(self._logs),
+            "active": sum(1 for s in self._logs.values() if not s.finished),
+        }
+
+
+def parse_last_event_id(value: Optional[str]) -> Tuple[Optional[str], int]:
+    """解析 Last-Event-ID（`流ID:序号`），格式不对时返回 (None, 0)"""
+    stream_id, sep, seq = (value or "").strip().rpartition(":")
+    if not sep or not stream_id:
+        return None, 0
+    try:
+        return stream_id, max(0, int(seq))
+    except ValueError:
+        return None, 0
+
+
+stream_logs = StreamRegistry(
+    ttl=float(os.getenv("STREAM_REPLAY_TTL", "60")),
+    max_events=int(os.getenv("STREAM_REPLAY_MAX_EVENTS", "5000")),
+    max_bytes=int(os.getenv("STREAM_REPLAY_MAX_BYTES", str(2 * 1024 * 1024))),
+    grace=float(os.getenv("STREAM_RESUME_GRACE", "30")),
+)
@@ -0,0 +1,185 @@
+"""
+MCP 工具结果缓存
+
+许多 MCP 工具在短时间内是纯查询，模型又常在同一会话、或不同用户之间用相同参数
+反复调用同一个工具。这里按 (服务器, 工具, 规范化参数) 缓存成功的调用结果：
+
+- 是否可缓存：只有声明了 readOnlyHint: true 的工具默认使用 MCP_TOOL_CACHE_TTL。
+  idempotentHint 只说明重复调用不会产生额外影响，不代表结果不变；未声明注解时按 MCP
+  规范视为可能有破坏性（destructiveHint 默认为 true），因此其他工具都不缓存，需要时在
+  MCP_TOOL_CACHE_TTLS 中显式配置：键为 `服务器名_工具名` 或工具名，值为秒数，
+  0 表示不缓存（显式配置优先于注解）。
+- 内存有界：按条目数（MCP_TOOL_CACHE_SIZE）与结果总字节数（MCP_TOOL_CACHE_MAX_BYTES）
+  做 LRU 淘汰。
+- 并发合并：相同键的调用正在进行时，后到的请求等待同一个结果，不重复访问网络。
+- 指标：mcp_tool_cache_total{server, tool, result=hit/miss/coalesced/bypass}，tool 标签由
+  调用方传入（不在工具目录中的名称记为 unknown）。
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from metrics import MCP_TOOL_CACHE_TOTAL, MCP_TOOL_CACHE_ENTRIES
+from utils import logger, json_dumps
+
+CacheKey = Tuple[str, str, str]
+
+
+def canonical_arguments(arguments: Optional[Dict[str, Any]]) -> str:
+    """参数规范化：键排序、紧凑分隔符，字段顺序不同的相同参数得到同一个键"""
+    try:
+        return json.dumps(arguments or {}, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    except (TypeError, ValueError):
+        return repr(arguments)
+
+
+def _load_ttl_overrides(raw: str) -> Dict[str, float]:
+    if not raw:
+        return {}
+    try:
+        return {str(k): float(v) for k, v in json.loads(raw).items()}
+    except Exception as e:
+        logger.warning("MCP_TOOL_CACHE_TTLS 配置无效，已忽略: %s", e)
+        return {}
+
+
+class ToolResultCache:
+    """有界 LRU 工具结果缓存，带 TTL 与并发合并"""
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 8 * 1024 * 1024,
+                 default_ttl: float = 30.0, ttl_overrides: Optional[Dict[str, float]] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.ttl_overrides = ttl_overrides or {}
+        # key -> (过期时间, 结果, 字节数)
+        self._entries: "OrderedDict[CacheKey, Tuple[float, Dict[str, Any], int]]" = OrderedDict()
+        self._bytes = 0
+        self._inflight: Dict[CacheKey, asyncio.Future] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def ttl_for(self, server: str, tool: str, annotations: Optional[Dict[str, Any]]) -> float:
+        """工具的缓存 TTL（秒），0 表示不缓存"""
+        for name in (f"{server}_{tool}", tool):
+            if name in self.ttl_overrides:
+                return max(0.0, self.ttl_overrides[name])
+        if (annotations or {}).get("readOnlyHint") is True:
+            return self.default_ttl
+        return 0.0
+
+    def _get(self, key: CacheKey) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _remove(self, key: CacheKey) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def _put(self, key: CacheKey, result: Dict[str, Any], ttl: float) -> None:
+        size = len(json_dumps(result))
+        if size > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, result, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self._bytes -= evicted
+        MCP_TOOL_CACHE_ENTRIES.set(len(self._entries))
+
+    def peek(
+        self,
+        server: str,
+        tool: str,
+        arguments: Optional[Dict[str, Any]],
+        annotations: Optional[Dict[str, Any]],
+        label: Optional[str] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """只查缓存不调用：命中返回结果并计为 hit，否则返回 None（不计 miss）；label 为指标的 tool 标签值"""
+        if not self.enabled or self.ttl_for(server, tool, annotations) <= 0:
+            return None
+        cached = self._get((server, tool, canonical_arguments(arguments)))
+        if cached is not None:
+            MCP_TOOL_CACHE_TOTAL.labels(server, label or tool, "hit").inc()
+        return cached
+
+    async def get_or_call(
+        self,
+        server: str,
+        tool: str,
+        arguments: Optional[Dict[str, Any]],
+        annotations: Optional[Dict[str, Any]],
+        call: Callable[[], Awaitable[Dict[str, Any]]],
+        label: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """命中缓存直接返回，否则调用 call 并缓存成功的结果；label 为指标的 tool 标签值，默认为 tool"""
+        ttl = self.ttl_for(server, tool, annotations) if self.enabled else 0.0
+        if ttl <= 0:
+            MCP_TOOL_CACHE_TOTAL.labels(server, label or tool, "bypass").inc()
+            return await call()
+
+        key = (server, tool, canonical_arguments(arguments))
+        cached = self._get(key)
+        if cached is not None:
+            MCP_TOOL_CACHE_TOTAL.labels(server, label or tool, "hit").inc()
+            return cached
+
+        task = self._inflight.get(key)
+        if task is not None:
+            MCP_TOOL_CACHE_TOTAL.labels(server, label or tool, "coalesced").inc()
+        else:
+            MCP_TOOL_CACHE_TOTAL.labels(server, label or tool, "miss").inc()
+            # 调用放在独立任务中，发起方被取消时其他等待方仍能拿到结果
+            task = asyncio.ensure_future(call())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, ttl, t))
+        return await asyncio.shield(task)
+
+    def _finish(self, key: CacheKey, ttl: float, task: asyncio.Future) -> None:
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        result = task.result()
+        if isinstance(result, dict) and result.get("success"):
+            self._put(key, result, ttl)
+
+    def invalidate(self, server: Optional[str] = None) -> None:
+        """清除缓存，server 为空时清空全部"""
+        if server is None:
+            self._entries.clear()
+            self._bytes = 0
+        else:
+            for key in [k for k in self._entries if k[0] == server]:
+                self._remove(key)
+        MCP_TOOL_CACHE_ENTRIES.set(len(self._entries))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "inflight": len(self._inflight),
+        }
+
+
+tool_result_cache = ToolResultCache(
+    max_entries=int(os.getenv("MCP_TOOL_CACHE_SIZE", "1024")),
+    max_bytes=int(os.getenv("MCP_TOOL_CACHE_MAX_BYTES", str(8 * 1024 * 1024))),
+    default_ttl=float(os.getenv("MCP_TOOL_CACHE_TTL", "30")),
+    ttl_overrides=_load_ttl_overrides(os.getenv("MCP_TOOL_CACHE_TTLS", "")),
+)
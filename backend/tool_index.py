@@ -0,0 +1,89 @@
+"""
+工具目录的本地 BM25 检索
+
+服务器多时，Agent 的 mcp_tools 匹配到的工具定义本身就可能占用上千 prompt token。
+开启 top-k 选择后（openai_config.tool_top_k 或 AGENT_TOOL_TOP_K），每次请求按最新
+一条用户消息在工具名、描述与参数名上做 BM25 检索，只发送最相关的 k 个工具，
+openai_config.always_include_tools 中匹配的工具始终保留。
+
+索引随工具目录构建：目录未刷新时复用同一个索引。中文没有空格分词，按单字与相邻
+两字切分；英文按非字母数字字符、下划线与驼峰切分并转小写。
+"""
+
+import math
+import re
+from collections import Counter
+from typing import Any, Collection, Dict, List, Optional, Sequence, Tuple
+
+_WORD_RE = re.compile(r"[A-Z]+(?![a-z])|[A-Za-z][a-z]*|\d+|[一-鿿]+")
+_CJK_RE = re.compile(r"[一-鿿]")
+
+
+def tokenize(text: str) -> List[str]:
+    """切分为检索词：英文单词/数字小写，中文单字加相邻两字"""
+    tokens: List[str] = []
+    for word in _WORD_RE.findall(text or ""):
+        if _CJK_RE.match(word):
+            tokens.extend(word)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word.lower())
+    return tokens
+
+
+def _tool_text(tool: Dict[str, Any]) -> str:
+    function = tool.get("function", {})
+    parameters = function.get("parameters") or {}
+    properties = parameters.get("properties") if isinstance(parameters, dict) else None
+    names = " ".join(properties) if isinstance(properties, dict) else ""
+    # 工具名权重更高：重复一次
+    return " ".join((function.get("name", ""), function.get("name", ""), function.get("description") or "", names))
+
+
+class ToolIndex:
+    """工具列表上的 BM25 倒排索引，文档下标与 tools 的顺序一致"""
+
+    def __init__(self, tools: Sequence[Dict[str, Any]], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.names = [tool.get("function", {}).get("name", "") for tool in tools]
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        lengths: List[int] = []
+        for doc, tool in enumerate(tools):
+            terms = tokenize(_tool_text(tool))
+            lengths.append(len(terms))
+            for term, freq in Counter(terms).items():
+                self._postings.setdefault(term, []).append((doc, freq))
+        self._lengths = lengths
+        self._avgdl = (sum(lengths) / len(lengths)) if lengths else 0.0
+        total = len(lengths)
+        self._idf = {
+            term: math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self._postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def scores(self, query: str) -> Dict[int, float]:
+        """查询对各文档的 BM25 分数，只包含分数大于 0 的文档"""
+        result: Dict[int, float] = {}
+        if not self._avgdl:
+            return result
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = self._idf[term]
+            for doc, freq in postings:
+                norm = freq + self.k1 * (1 - self.b + self.b * self._lengths[doc] / self._avgdl)
+                result[doc] = result.get(doc, 0.0) + idf * freq * (self.k1 + 1) / norm
+        return result
+
+    def top_k(self, query: str, k: int, allowed: Optional[Collection[str]] = None) -> List[str]:
+        """分数最高的 k 个工具名（按分数降序），allowed 限定候选工具名"""
+        ranked = sorted(
+            (item for item in self.scores(query).items() if allowed is None or self.names[item[0]] in allowed),
+            key=lambda item: (-item[1], item[0]),
+        )
+        return [self.names[doc] for doc, _ in ranked[:k]]
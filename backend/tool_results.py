@@ -0,0 +1,189 @@
+"""
+MCP 工具结果的大小控制
+
+工具可能返回几 MB 的文档或图片，原样拼进 <mcp> SSE 事件和 role: tool 消息会同时撑大
+内存、SSE 帧与下一轮 prompt 的 token 数。这里分三层处理：
+
+- 接收时：文本内容按 MCP_RESULT_MAX_BYTES 截断；图片、音频、二进制资源只保留类型与
+  大小摘要，不把 base64 转成文本，也不在热路径上解码。
+- 发给模型：按工具的字节与 token 预算保留开头和结尾，中间用明确的标记说明省略了多少。
+  默认 MCP_TOOL_RESULT_BYTES / MCP_TOOL_RESULT_TOKENS，MCP_TOOL_RESULT_BUDGETS 可按
+  工具覆盖：{"服务器名_工具名" 或 "工具名": {"bytes": N, "tokens": M}}。
+- 发给客户端：另按 MCP_RESULT_CLIENT_BYTES 截断，并按 MCP_RESULT_CHUNK_BYTES 分成多个
+  SSE 事件逐块输出。
+"""
+
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from metrics import MCP_TOOL_RESULT_CHARS, MCP_TOOL_RESULT_TRUNCATED_TOTAL
+from usage import estimate_tokens
+from utils import logger, json_dumps
+
+MAX_RESULT_BYTES = int(os.getenv("MCP_RESULT_MAX_BYTES", str(1024 * 1024)))
+CLIENT_RESULT_BYTES = int(os.getenv("MCP_RESULT_CLIENT_BYTES", str(256 * 1024)))
+CLIENT_CHUNK_BYTES = max(256, int(os.getenv("MCP_RESULT_CHUNK_BYTES", "8192")))
+DEFAULT_BUDGET = {
+    "bytes": int(os.getenv("MCP_TOOL_RESULT_BYTES", "32768")),
+    "tokens": int(os.getenv("MCP_TOOL_RESULT_TOKENS", "4000")),
+}
+
+
+def _load_budgets(raw: str) -> Dict[str, Dict[str, int]]:
+    if not raw:
+        return {}
+    try:
+        return {str(k): {key: int(v) for key, v in value.items()} for k, value in json.loads(raw).items()}
+    except Exception as e:
+        logger.warning("MCP_TOOL_RESULT_BUDGETS 配置无效，已忽略: %s", e)
+        return {}
+
+
+_budgets = _load_budgets(os.getenv("MCP_TOOL_RESULT_BUDGETS", ""))
+
+
+def budget_for(server: str, tool: str) -> Dict[str, int]:
+    """工具结果发给模型时的预算 {"bytes": 字节上限, "tokens": token 上限}，0 表示不限"""
+    for name in (f"{server}_{tool}", tool):
+        if name in _budgets:
+            return {**DEFAULT_BUDGET, **_budgets[name]}
+    return DEFAULT_BUDGET
+
+
+def _base64_size(data: Optional[str]) -> int:
+    """base64 字符串对应的原始字节数（不解码）"""
+    if not data:
+        return 0
+    return len(data) * 3 // 4 - data[-2:].count("=")
+
+
+def _format_size(size: int) -> str:
+    if size >= 1024 * 1024:
+        return f"{size / 1024 / 1024:.1f} MB"
+    if size >= 1024:
+        return f"{size / 1024:.1f} KB"
+    return f"{size} B"
+
+
+def render_content(contents: List[Any], structured: Any = None) -> Tuple[str, List[Dict[str, Any]], bool]:
+    """把 MCP 内容块渲染为文本，返回 (文本, 附件摘要, 是否超过 MCP_RESULT_MAX_BYTES 被截断)"""
+    parts: List[str] = []
+    attachments: List[Dict[str, Any]] = []
+    length = 0
+    truncated = False
+    for content in contents:
+        kind = getattr(content, "type", "")
+        if kind == "text":
+            piece = content.text
+        elif kind in ("image", "audio"):
+            size = _base64_size(content.data)
+            attachments.append({"type": kind, "mimeType": content.mimeType, "bytes": size})
+            piece = f"[{'图片' if kind == 'image' else '音频'} {content.mimeType}，{_format_size(size)}，未内联]"
+        elif kind == "resource":
+            resource = content.resource
+            text = getattr(resource, "text", None)
+            if text is not None:
+                piece = f"[资源 {resource.uri}]\n{text}"
+            else:
+                size = _base64_size(getattr(resource, "blob", None))
+                attachments.append({"type": "resource", "uri": str(resource.uri),
+                                    "mimeType": resource.mimeType, "bytes": size})
+                piece = f"[资源 {resource.uri} {resource.mimeType or ''}，{_format_size(size)}，未内联]"
+        elif kind == "resource_link":
+            attachments.append({"type": "resource_link", "uri": str(content.uri), "mimeType": content.mimeType})
+            piece = f"[资源链接 {content.name} {content.uri}]"
+        else:
+            continue
+
+        # 按字符数粗略截断，最后再按字节精确截断（字符数不超过字节数）
+        if length + len(piece) > MAX_RESULT_BYTES:
+            parts.append(piece[:max(0, MAX_RESULT_BYTES - length)])
+            truncated = True
+            break
+        parts.append(piece)
+        length += len(piece)
+
+    if not parts and structured is not None:
+        parts.append(json_dumps(structured))
+
+    text = "".join(parts)
+    if truncated or len(text) * 3 > MAX_RESULT_BYTES:
+        encoded = text.encode("utf-8")
+        if len(encoded) > MAX_RESULT_BYTES:
+            text = encoded[:MAX_RESULT_BYTES].decode("utf-8", "ignore")
+            truncated = True
+    return text, attachments, truncated
+
+
+def _elide(text: str, max_bytes: int) -> Tuple[str, int]:
+    """保留开头约 2/3、结尾约 1/3，返回 (省略后的文本, 省略的字节数)"""
+    encoded = text.encode("utf-8")
+    if len(encoded) <= max_bytes:
+        return text, 0
+    head = max_bytes * 2 // 3
+    tail = max_bytes - head
+    omitted = len(encoded) - head - tail
+    return (
+        encoded[:head].decode("utf-8", "ignore")
+        + f"\n…[结果过长，已省略中间 {_format_size(omitted)}，完整结果共 {_format_size(len(encoded))}]…\n"
+        + (encoded[-tail:].decode("utf-8", "ignore") if tail else ""),
+        omitted,
+    )
+
+
+def bound_text(text: str, max_bytes: int, max_tokens: int) -> Tuple[str, bool]:
+    """按字节与 token 预算截断文本，返回 (文本, 是否截断)"""
+    original = text
+    if max_bytes > 0:
+        text, _ = _elide(text, max_bytes)
+    # token 数不会超过字符数，短文本无需估算
+    if max_tokens > 0 and len(text) > max_tokens:
+        budget = len(text.encode("utf-8"))
+        # token 数按比例收缩字节预算，最多迭代几次
+        for _ in range(4):
+            tokens = estimate_tokens(text)
+            if tokens <= max_tokens:
+                break
+            budget = int(budget * max_tokens / tokens * 0.9)
+            text, _ = _elide(original, max(64, budget))
+    return text, text is not original
+
+
+def for_model(result: Dict[str, Any], server: str, tool: str) -> Dict[str, Any]:
+    """生成写入 role: tool 消息的结果副本，超出工具预算时截断并标记"""
+    text = result.get("result")
+    if not isinstance(text, str):
+        return result
+    MCP_TOOL_RESULT_CHARS.labels(server, tool).observe(len(text))
+    budget = budget_for(server, tool)
+    bounded, truncated = bound_text(text, budget["bytes"], budget["tokens"])
+    if not truncated:
+        return result
+    MCP_TOOL_RESULT_TRUNCATED_TOTAL.labels(server, tool, "model").inc()
+    return {**result, "result": bounded, "truncated": True}
+
+
+def client_chunks(result: Dict[str, Any], server: str = "", tool: str = "") -> Iterator[str]:
+    """以 <mcp> 标记输出给客户端的工具结果；较大的结果截断到 MCP_RESULT_CLIENT_BYTES 并分块输出"""
+    text = result.get("result")
+    if isinstance(text, str) and len(text) * 3 > CLIENT_RESULT_BYTES:
+        bounded, omitted = _elide(text, CLIENT_RESULT_BYTES)
+        if omitted:
+            MCP_TOOL_RESULT_TRUNCATED_TOTAL.labels(server, tool, "client").inc()
+            result = {**result, "result": bounded, "truncated": True}
+    # 结果中的 </mcp> 会提前闭合标记，转义为 JSON 等价的 <\/mcp>
+    body = json_dumps(result).replace("</mcp>", "<\\/mcp>")
+    if len(body) <= CLIENT_CHUNK_BYTES:
+        yield f"<mcp>✅ 工具返回: {body}</mcp>\n\n"
+        return
+    yield "<mcp>✅ 工具返回: "
+    start = 0
+    while start < len(body):
+        end = min(len(body), start + CLIENT_CHUNK_BYTES)
+        # 客户端会去掉每个事件首尾的空白，切分点避开空白字符
+        while end < len(body) and end - start > 1 and (body[end].isspace() or body[end - 1].isspace()):
+            end -= 1
+        yield body[start:end]
+        start = end
+    yield "</mcp>\n\n"
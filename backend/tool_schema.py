@@ -0,0 +1,114 @@
+"""
+工具参数的本地 JSON Schema 校验
+
+模型生成的 function.arguments 可能不是合法 JSON，或不符合工具的 inputSchema。
+过去前者被静默替换为 {}，后者要等 MCP 服务器往返一次才报错。这里在发出调用前
+按 inputSchema 校验参数，不合法的调用直接把结构化错误返回给模型，不访问网络：
+
+- 编译：每个 inputSchema 只检查、构建一次校验器（按规范化后的 schema 缓存），
+  工具目录刷新时复用。
+- 依赖：使用 mcp 依赖带入的 jsonschema；未安装或 schema 本身无效时跳过本地校验，
+  交由服务器处理。
+- 未知工具：服务器已有工具目录而其中没有该工具时（模型臆造的名称），同样不发出调用。
+- 指标：mcp_tool_args_invalid_total{server, tool, reason=parse/schema/unknown_tool}，
+  不在工具目录中的服务器与工具名记为 unknown，避免模型给出的任意名称成为标签。
+"""
+
+import functools
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import MCP_TOOL_ARGS_INVALID_TOTAL
+from utils import logger
+
+# 返回给模型的错误条数上限
+MAX_ERRORS = 5
+
+
+@functools.lru_cache(maxsize=None)
+def _jsonschema():
+    try:
+        import jsonschema
+        return jsonschema
+    except ImportError:
+        logger.warning("未安装 jsonschema，跳过工具参数的本地校验")
+        return None
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile(schema_json: str) -> Any:
+    jsonschema = _jsonschema()
+    if jsonschema is None:
+        return None
+    schema = json.loads(schema_json)
+    try:
+        cls = jsonschema.validators.validator_for(schema)
+        cls.check_schema(schema)
+        return cls(schema)
+    except Exception as e:
+        logger.warning("工具 inputSchema 无效，跳过本地校验: %s", e)
+        return None
+
+
+def compile_schema(schema: Optional[Dict[str, Any]]) -> Any:
+    """编译 inputSchema 为校验器，无法校验时返回 None"""
+    if not isinstance(schema, dict) or not schema:
+        return None
+    try:
+        key = json.dumps(schema, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    except (TypeError, ValueError):
+        return None
+    return _compile(key)
+
+
+def parse_arguments(raw: Any) -> Tuple[Dict[str, Any], Optional[str]]:
+    """解析 function.arguments，返回 (参数, 错误信息)；空字符串视为无参数"""
+    if isinstance(raw, dict):
+        return raw, None
+    if raw is None or (isinstance(raw, str) and not raw.strip()):
+        return {}, None
+    try:
+        arguments = json.loads(raw)
+    except (TypeError, ValueError) as e:
+        return {}, f"参数不是合法的 JSON: {e}"
+    if not isinstance(arguments, dict):
+        return {}, f"参数必须是 JSON 对象，实际为 {type(arguments).__name__}"
+    return arguments, None
+
+
+def _error_path(error: Any) -> str:
+    return "/".join(str(p) for p in error.absolute_path) or "(根)"
+
+
+def validate_arguments(validator: Any, arguments: Dict[str, Any]) -> List[Dict[str, str]]:
+    """按校验器检查参数，返回错误列表 [{"path", "message"}]，合法时为空"""
+    if validator is None:
+        return []
+    errors = sorted(validator.iter_errors(arguments), key=lambda e: list(map(str, e.absolute_path)))
+    return [{"path": _error_path(e), "message": e.message} for e in errors[:MAX_ERRORS]]
+
+
+def invalid_result(server: str, tool: str, reason: str, message: str,
+                   errors: Optional[List[Dict[str, str]]] = None,
+                   tool_label: Optional[str] = None) -> Dict[str, Any]:
+    """不合法调用的结构化错误结果（直接作为工具结果返回给模型）
+
+    server 为指标标签值；tool_label 为 tool 的标签值，默认与 tool 相同。
+    """
+    MCP_TOOL_ARGS_INVALID_TOTAL.labels(server, tool_label or tool, reason).inc()
+    result: Dict[str, Any] = {
+        "success": False,
+        "error": f"工具 {tool} 的参数无效，未执行：{message}。请按工具参数定义修正后重试",
+    }
+    if errors:
+        result["validation_errors"] = errors
+    return result
+
+
+def unknown_tool_result(server: str, tool: str) -> Dict[str, Any]:
+    """工具目录中不存在的工具：不发出调用，返回结构化错误（server 为指标标签值）"""
+    MCP_TOOL_ARGS_INVALID_TOTAL.labels(server, "unknown", "unknown_tool").inc()
+    return {
+        "success": False,
+        "error": f"工具 {tool} 不存在，未执行。请只调用工具列表中提供的工具",
+    }
@@ -0,0 +1,231 @@
+"""
+轻量级请求链路追踪
+
+每个请求创建一个 Trace，内部通过 span() 记录各阶段耗时（Agent 查询、工具发现、
+上游调用、MCP 调用、流式输出等）。span 通过 contextvars 自动关联父子关系，
+不在 Trace 内时为空操作。完成的 Trace 进入有界缓冲区，保留最近最慢的若干条，
+供管理接口查看；设置 OTEL_EXPORT=1 且安装了 opentelemetry 时同时导出到 OpenTelemetry。
+"""
+
+import asyncio
+import heapq
+import os
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from utils import logger
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex
+
+
+class Span:
+    """单个阶段的耗时记录"""
+    __slots__ = ("span_id", "parent_id", "name", "attributes", "start", "end", "start_wall", "status")
+
+    def __init__(self, name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.start_wall = time.time()
+        self.end: Optional[float] = None
+        self.status = "ok"
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end if self.end is not None else time.perf_counter()
+        return (end - self.start) * 1000
+
+    def to_dict(self, trace_start: float) -> Dict[str, Any]:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "offset_ms": round((self.start - trace_start) * 1000, 2),
+            "duration_ms": round(self.duration_ms, 2),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """不在 Trace 内时返回的空 span"""
+    __slots__ = ()
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """一次请求的所有 span"""
+
+    def __init__(self, name: str, trace_id: Optional[str] = None, attributes: Optional[Dict[str, Any]] = None):
+        self.trace_id = trace_id or new_trace_id()
+        self.root = Span(name, None, dict(attributes or {}))
+        self.spans: List[Span] = [self.root]
+        # 单请求剖析结果（见 profiler.profile_request）
+        self.profile: Optional[Dict[str, Any]] = None
+
+    @property
+    def name(self) -> str:
+        return self.root.name
+
+    @property
+    def duration_ms(self) -> float:
+        return self.root.duration_ms
+
+    def to_dict(self, include_spans: bool = True) -> Dict[str, Any]:
+        data = {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.root.start_wall,
+            "duration_ms": round(self.duration_ms, 2),
+            "status": self.root.status,
+            "attributes": self.root.attributes,
+            "span_count": len(self.spans),
+        }
+        if include_spans:
+            data["spans"] = [s.to_dict(self.root.start) for s in self.spans]
+            if self.profile is not None:
+                data["profile"] = self.profile
+        else:
+            data["profiled"] = self.profile is not None
+        return data
+
+
+class TraceBuffer:
+    """保留最近 window 条 Trace 中最慢的 capacity 条"""
+
+    def __init__(self, capacity: int = 50, window: int = 1000):
+        self.capacity = capacity
+        self._recent: deque = deque(maxlen=window)
+
+    def add(self, trace: Trace) -> None:
+        self._recent.append(trace)
+
+    def slowest(self, limit: Optional[int] = None) -> List[Trace]:
+        limit = min(limit or self.capacity, self.capacity)
+        return heapq.nlargest(limit, self._recent, key=lambda t: t.duration_ms)
+
+    def get(self, trace_id: str) -> Optional[Trace]:
+        for trace in reversed(self._recent):
+            if trace.trace_id == trace_id:
+                return trace
+        return None
+
+
+trace_buffer = TraceBuffer(
+    capacity=int(os.getenv("TRACE_BUFFER_SIZE", "50")),
+    window=int(os.getenv("TRACE_WINDOW", "1000")),
+)
+
+
+class _OTelExporter:
+    """将完成的 Trace 以原始时间戳重放到 OpenTelemetry（可选依赖）"""
+
+    def __init__(self):
+        from opentelemetry import trace as otel_trace  # type: ignore
+        self._otel_trace = otel_trace
+        self._tracer = otel_trace.get_tracer("ai-agents-api")
+
+    def export(self, trace: Trace) -> None:
+        otel_spans: Dict[str, Any] = {}
+        for span in trace.spans:
+            parent = otel_spans.get(span.parent_id)
+            context = self._otel_trace.set_span_in_context(parent) if parent is not None else None
+            start_ns = int(span.start_wall * 1e9)
+            otel_span = self._tracer.start_span(
+                span.name,
+                context=context,
+                start_time=start_ns,
+                attributes={k: v if isinstance(v, (str, int, float, bool)) else str(v) for k, v in span.attributes.items()},
+            )
+            otel_span.set_attribute("app.trace_id", trace.trace_id)
+            if span.status != "ok":
+                otel_span.set_status(self._otel_trace.Status(self._otel_trace.StatusCode.ERROR))
+            otel_span.end(end_time=start_ns + int(span.duration_ms * 1e6))
+            otel_spans[span.span_id] = otel_span
+
+
+_otel_exporter = None
+if os.getenv("OTEL_EXPORT", "").lower() in ("1", "true", "yes", "on"):
+    try:
+        _otel_exporter = _OTelExporter()
+    except Exception as e:
+        logger.warning("OpenTelemetry 导出未启用: %s", e)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def start_trace(name: str, trace_id: Optional[str] = None, **attributes: Any):
+    """开始一次请求级 Trace，结束后写入缓冲区（并按需导出）"""
+    trace = Trace(name, trace_id, attributes)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(trace.root)
+    try:
+        yield trace
+    except (GeneratorExit, asyncio.CancelledError):
+        trace.root.status = "cancelled"
+        raise
+    except BaseException as e:
+        trace.root.status = "error"
+        trace.root.set("error", str(e) or type(e).__name__)
+        raise
+    finally:
+        trace.root.end = time.perf_counter()
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        trace_buffer.add(trace)
+        if _otel_exporter is not None:
+            try:
+                _otel_exporter.export(trace)
+            except Exception as e:
+                logger.warning("OpenTelemetry 导出失败: %s", e)
+
+
+@contextmanager
+def span(name: str, **attributes: Any):
+    """记录一个阶段，不在 Trace 内时为空操作"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield _NOOP_SPAN
+        return
+    parent = _current_span.get()
+    current = Span(name, parent.span_id if parent else None, attributes)
+    trace.spans.append(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except (GeneratorExit, asyncio.CancelledError):
+        current.status = "cancelled"
+        raise
+    except BaseException as e:
+        current.status = "error"
+        current.set("error", str(e) or type(e).__name__)
+        raise
+    finally:
+        current.end = time.perf_counter()
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # 异步生成器跨上下文结束时无法 reset，直接恢复父 span
+            _current_span.set(parent)
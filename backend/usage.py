@@ -0,0 +1,242 @@
+"""
+Token 用量统计
+
+- 上游返回 usage 时直接使用；流式请求通过 stream_options.include_usage 获取最后一个
+  usage 块。上游缺失时用本地估算兜底（安装了 tiktoken 时精确计数，否则按字符规则估算），
+  并标记 estimated。
+- 一次对话请求可能包含多轮上游调用（工具调用前后），UsageAccumulator 累加各轮用量，
+  同时计入按 Agent + 模型、按会话聚合的 UsageTracker 与 Prometheus 指标。
+"""
+
+import math
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import TOKENS_USED_TOTAL
+from utils import agent_label, parse_agent_id
+
+try:
+    import tiktoken  # type: ignore
+except Exception:
+    tiktoken = None
+
+# CJK 字符通常 1 字 ≈ 1 token，其余文本按词与标点粗略估算
+_CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]")
+_WORD_PATTERN = re.compile(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]")
+
+# 每条消息的格式开销（role、分隔符），与 OpenAI 的计数方式一致
+_MESSAGE_OVERHEAD = 4
+_REPLY_PRIMING = 3
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding(os.getenv("TOKENIZER_ENCODING", "cl100k_base"))
+        except Exception:
+            _encoding = False
+    return _encoding or None
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK_PATTERN.findall(text))
+    rest = _CJK_PATTERN.sub(" ", text)
+    tokens = 0
+    for piece in _WORD_PATTERN.findall(rest):
+        # 长单词与长数字会被切成多个 token
+        tokens += max(1, math.ceil(len(piece) / 4)) if piece.isalnum() else 1
+    return cjk + tokens
+
+
+def estimate_message_tokens(messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None) -> int:
+    """估算请求消息（含工具调用与工具定义）的 prompt token 数"""
+    total = _REPLY_PRIMING
+    for message in messages:
+        total += _MESSAGE_OVERHEAD + estimate_tokens(str(message.get("content") or ""))
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call.get("function", {})
+            total += estimate_tokens(function.get("name", "")) + estimate_tokens(function.get("arguments", ""))
+    for tool in tools or []:
+        function = tool.get("function", {})
+        total += estimate_tokens(function.get("name", "")) + estimate_tokens(function.get("description", "") or "")
+        total += estimate_tokens(str(function.get("parameters", "")))
+    return total
+
+
+def normalize_usage(
+    usage: Optional[Dict[str, Any]],
+    messages: List[Dict[str, Any]],
+    completion_text: str = "",
+    tools: Optional[List[Dict[str, Any]]] = None,
+    tool_calls: Optional[List[Dict[str, Any]]] = None,
+) -> Dict[str, Any]:
+    """整理上游返回的 usage，缺失的字段用本地估算补齐"""
+    usage = usage or {}
+    prompt = usage.get("prompt_tokens")
+    completion = usage.get("completion_tokens")
+    estimated = False
+    if prompt is None:
+        prompt = estimate_message_tokens(messages, tools)
+        estimated = True
+    if completion is None:
+        completion = estimate_tokens(completion_text)
+        for tool_call in tool_calls or []:
+            function = tool_call.get("function", {})
+            completion += estimate_tokens(function.get("name", "")) + estimate_tokens(function.get("arguments", ""))
+        estimated = True
+    result = {
+        "prompt_tokens": int(prompt),
+        "completion_tokens": int(completion),
+        "total_tokens": int(prompt) + int(completion),
+    }
+    if estimated:
+        result["estimated"] = True
+    return result
+
+
+def empty_usage() -> Dict[str, Any]:
+    return {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+
+class _Totals:
+    __slots__ = ("prompt_tokens", "completion_tokens", "requests", "rounds", "estimated_rounds", "updated_at")
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.requests = 0
+        self.rounds = 0
+        self.estimated_rounds = 0
+        self.updated_at = 0.0
+
+    def add_round(self, usage: Dict[str, Any]) -> None:
+        self.prompt_tokens += usage.get("prompt_tokens", 0)
+        self.completion_tokens += usage.get("completion_tokens", 0)
+        self.rounds += 1
+        if usage.get("estimated"):
+            self.estimated_rounds += 1
+        self.updated_at = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+            "requests": self.requests,
+            "rounds": self.rounds,
+            "estimated_rounds": self.estimated_rounds,
+            "updated_at": self.updated_at,
+        }
+
+
+class UsageTracker:
+    """进程内用量聚合：按 (agent_id, model) 与按会话，会话数量有上限（LRU 淘汰）
+
+    agent_id 按 agent_label 规范化（"07"、" 7" 与 7 计为同一个 Agent，无效值计为 unknown），
+    聚合行与指标标签的数量不受请求中的任意取值影响。
+    """
+
+    def __init__(self, max_sessions: int = 10000):
+        self.max_sessions = max_sessions
+        self._by_agent_model: Dict[Tuple[str, str], _Totals] = {}
+        self._sessions: "OrderedDict[str, Tuple[str, str, _Totals]]" = OrderedDict()
+
+    def _session(self, session_id: str, agent_id: str, model: str) -> _Totals:
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            entry = self._sessions[session_id] = (agent_id, model, _Totals())
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(session_id)
+        return entry[2]
+
+    def add_round(self, agent_id: Any, model: str, session_id: Optional[str], usage: Dict[str, Any]) -> None:
+        key = (agent_label(agent_id), model)
+        totals = self._by_agent_model.get(key)
+        if totals is None:
+            totals = self._by_agent_model[key] = _Totals()
+        totals.add_round(usage)
+        if session_id:
+            self._session(session_id, key[0], model).add_round(usage)
+
+        source = "estimated" if usage.get("estimated") else "upstream"
+        TOKENS_USED_TOTAL.labels(key[0], model, "prompt", source).inc(usage.get("prompt_tokens", 0))
+        TOKENS_USED_TOTAL.labels(key[0], model, "completion", source).inc(usage.get("completion_tokens", 0))
+
+    def finish_request(self, agent_id: Any, model: str, session_id: Optional[str]) -> None:
+        totals = self._by_agent_model.get((agent_label(agent_id), model))
+        if totals is not None:
+            totals.requests += 1
+        if session_id and session_id in self._sessions:
+            self._sessions[session_id][2].requests += 1
+
+    def summary(self, agent_id: Optional[str] = None, model: Optional[str] = None) -> List[Dict[str, Any]]:
+        rows = []
+        if agent_id is not None:
+            # 数字按整数规范化；其他取值原样比较，只有 "unknown" 能匹配到无效 ID 的聚合行
+            key = parse_agent_id(agent_id)
+            agent_id = str(key) if key is not None else str(agent_id)
+        for (agent, model_name), totals in self._by_agent_model.items():
+            if agent_id is not None and agent != agent_id:
+                continue
+            if model is not None and model_name != model:
+                continue
+            rows.append({"agent_id": agent, "model": model_name, **totals.to_dict()})
+        return rows
+
+    def session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        agent_id, model, totals = entry
+        return {"session_id": session_id, "agent_id": agent_id, "model": model, **totals.to_dict()}
+
+
+usage_tracker = UsageTracker(max_sessions=int(os.getenv("USAGE_MAX_SESSIONS", "10000")))
+
+
+class UsageAccumulator:
+    """一次对话请求内的用量累加器，每轮上游调用后调用 add"""
+
+    def __init__(self, agent_id: Any = None, model: str = "", session_id: Optional[str] = None,
+                 tracker: Optional[UsageTracker] = usage_tracker):
+        self.agent_id = agent_id
+        self.model = model
+        self.session_id = session_id
+        self.tracker = tracker
+        self.rounds: List[Dict[str, Any]] = []
+
+    def add(self, usage: Dict[str, Any]) -> None:
+        self.rounds.append(usage)
+        if self.tracker is not None:
+            self.tracker.add_round(self.agent_id, self.model, self.session_id, usage)
+
+    def finish(self) -> None:
+        if self.tracker is not None and self.rounds:
+            self.tracker.finish_request(self.agent_id, self.model, self.session_id)
+
+    def total(self) -> Dict[str, Any]:
+        prompt = sum(u.get("prompt_tokens", 0) for u in self.rounds)
+        completion = sum(u.get("completion_tokens", 0) for u in self.rounds)
+        result = {
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "total_tokens": prompt + completion,
+            "rounds": len(self.rounds),
+        }
+        if any(u.get("estimated") for u in self.rounds):
+            result["estimated"] = True
+        return result
@@ -1,14 +1,161 @@
 import os
 import json
+import time
+import hashlib
+import hmac
+from functools import wraps
 import logging
-from typing import Dict, Any, List
-from sanic.response import json as sanic_json
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Any, List, Iterable, Tuple, Optional, Callable
+from sanic.response import json as sanic_json, empty, raw, HTTPResponse
 from sanic import Request
+from log_pipeline import setup_logging
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 可选的高性能 JSON 编码器
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
+
+# 配置日志：队列化的非阻塞结构化日志（见 log_pipeline.py）
+setup_logging()
 logger = logging.getLogger(__name__)
 
+def _json_default(obj: Any) -> Any:
+    """处理标准 JSON 不支持的类型"""
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def _stdlib_dumps_bytes(obj: Any) -> bytes:
+    # ensure_ascii=False：中文直接输出 UTF-8，体积比 \uXXXX 转义更小
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+
+def _orjson_dumps_bytes(obj: Any) -> bytes:
+    try:
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    except (orjson.JSONEncodeError, TypeError):
+        # orjson 不支持的情况（如超过 64 位的整数）回退到标准库
+        return _stdlib_dumps_bytes(obj)
+
+_json_dumps_bytes: Callable[[Any], bytes] = _stdlib_dumps_bytes
+
+def set_json_encoder(name: str = "auto") -> str:
+    """切换 JSON 编码器：auto（有 orjson 时使用 orjson）、orjson、json"""
+    global _json_dumps_bytes
+    if name in ("auto", "orjson") and orjson is not None:
+        _json_dumps_bytes = _orjson_dumps_bytes
+        return "orjson"
+    if name == "orjson":
+        logger.warning("未安装 orjson，回退到标准库 json 编码器")
+    _json_dumps_bytes = _stdlib_dumps_bytes
+    return "json"
+
+JSON_ENCODER = set_json_encoder(os.getenv("JSON_ENCODER", "auto"))
+
+def json_dumps_bytes(obj: Any, **kwargs: Any) -> bytes:
+    """编码为 UTF-8 JSON 字节，可直接作为 Sanic 的 dumps 使用"""
+    return _json_dumps_bytes(obj)
+
+def json_dumps(obj: Any) -> str:
+    """编码为 JSON 字符串（保留中文，不做 ASCII 转义）"""
+    return _json_dumps_bytes(obj).decode("utf-8")
+
+class EncodedResponseCache:
+    """预编码响应体缓存
+
+    按命名空间 + 请求键存储已编码的响应体与响应头。条目可附带版本号（如 ETag），
+    读取时版本不一致视为未命中；写操作通过 invalidate(namespace) 清空对应命名空间。
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Any, bytes, Dict[str, str], float]]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, namespace: str, key: str, version: Any = None) -> Optional[Tuple[bytes, Dict[str, str]]]:
+        if not self.enabled:
+            return None
+        entry = self._entries.get((namespace, key))
+        if entry is None:
+            return None
+        entry_version, body, headers, expires_at = entry
+        if entry_version != version or expires_at < time.monotonic():
+            del self._entries[(namespace, key)]
+            return None
+        self._entries.move_to_end((namespace, key))
+        return body, headers
+
+    def put(self, namespace: str, key: str, body: bytes, headers: Optional[Dict[str, str]] = None, version: Any = None) -> None:
+        if not self.enabled:
+            return
+        self._entries[(namespace, key)] = (version, body, dict(headers or {}), time.monotonic() + self.ttl)
+        self._entries.move_to_end((namespace, key))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, namespace: str) -> None:
+        for cache_key in [k for k in self._entries if k[0] == namespace]:
+            del self._entries[cache_key]
+
+response_cache = EncodedResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", "300")),
+)
+
+def cached_json_response(body: bytes, headers: Optional[Dict[str, str]] = None):
+    """直接返回预编码的 JSON 响应体"""
+    return raw(body, content_type="application/json", headers=headers)
+
+def _env_flag(name: str, default: bool) -> bool:
+    """读取布尔型环境变量"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+class StartupTimer:
+    """启动阶段耗时统计，用于输出冷启动报告"""
+
+    def __init__(self):
+        self.phases: List[Tuple[str, float]] = []
+
+    def record(self, name: str, duration_ms: float) -> None:
+        self.phases.append((name, round(duration_ms, 1)))
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - started) * 1000)
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "phases": [{"name": name, "duration_ms": ms} for name, ms in self.phases],
+            "total_ms": round(sum(ms for _, ms in self.phases), 1),
+        }
+
+    def log_report(self, title: str) -> None:
+        details = ", ".join(f"{name}={ms}ms" for name, ms in self.phases)
+        logger.info("%s: 总计 %sms (%s)", title, self.report()['total_ms'], details)
+
+startup_timer = StartupTimer()
+
 def get_env_config() -> Dict[str, Any]:
     """获取环境配置"""
     return {
@@ -18,6 +165,21 @@ def get_env_config() -> Dict[str, Any]:
         "MYSQL_USER": os.getenv("MYSQL_USER", "root"),
         "MYSQL_PASSWORD": os.getenv("MYSQL_PASSWORD", "123456"),
         "MYSQL_DATABASE": os.getenv("MYSQL_DATABASE", "ai_agents"),
+        # 运行模式：development（单进程 + 自动重载）或 production（多 worker）
+        "APP_MODE": os.getenv("APP_MODE", "development"),
+        "HOST": os.getenv("HOST", "0.0.0.0"),
+        "PORT": int(os.getenv("PORT", "8001")),
+        "WORKERS": int(os.getenv("WORKERS", str(os.cpu_count() or 1))),
+        # 异步任务与可续传流只保存在创建它的 worker 内；多 worker 时经内部端口转交给所属 worker，
+        # worker i 监听 127.0.0.1:(该值 + i)，0 关闭。只覆盖单机，多机部署需负载均衡保持会话（见 README.md）
+        "WORKER_ROUTE_PORT": int(os.getenv("WORKER_ROUTE_PORT", str(int(os.getenv("PORT", "8001")) + 100))),
+        "WARMUP_TIMEOUT": float(os.getenv("WARMUP_TIMEOUT", "15")),
+        # 启动预热失败后的重试间隔（秒），0 关闭重试；预热成功前就绪检查返回 503
+        "WARMUP_RETRY_INTERVAL": float(os.getenv("WARMUP_RETRY_INTERVAL", "10")),
+        # 快速启动：跳过建表与初始数据写入（由 `python app.py init-db` 在部署时执行一次）
+        "FAST_START": _env_flag("FAST_START", False),
+        "GENERATE_SCHEMAS": _env_flag("GENERATE_SCHEMAS", not _env_flag("FAST_START", False)),
+        "SEED_DEFAULTS": _env_flag("SEED_DEFAULTS", not _env_flag("FAST_START", False)),
     }
 
 def success_response(data: Any = None, message: str = "success") -> sanic_json:
@@ -26,7 +188,7 @@ def success_response(data: Any = None, message: str = "success") -> sanic_json:
         "success": True,
         "message": message,
         "data": data
-    })
+    }, dumps=json_dumps_bytes)
 
 def error_response(message: str, code: int = 400, data: Any = None) -> sanic_json:
     """错误响应"""
@@ -34,7 +196,64 @@ def error_response(message: str, code: int = 400, data: Any = None) -> sanic_jso
         "success": False,
         "message": message,
         "data": data
-    }, status=code)
+    }, status=code, dumps=json_dumps_bytes)
+
+def _admin_error(request: Request) -> Optional[HTTPResponse]:
+    """校验管理员令牌，通过时返回 None，否则返回错误响应"""
+    token = os.getenv("ADMIN_TOKEN")
+    if not token:
+        return error_response("管理接口未启用（未配置 ADMIN_TOKEN）", 403)
+    provided = request.headers.get("x-admin-token", "")
+    auth = request.headers.get("authorization", "")
+    if not provided and auth.lower().startswith("bearer "):
+        provided = auth[7:].strip()
+    if not hmac.compare_digest(provided.encode("utf-8"), token.encode("utf-8")):
+        return error_response("未授权", 401)
+    return None
+
+def is_admin(request: Request) -> bool:
+    """请求是否携带有效的管理员令牌"""
+    return _admin_error(request) is None
+
+def require_admin(handler):
+    """管理接口鉴权：需配置 ADMIN_TOKEN，并通过 X-Admin-Token 或 Bearer Token 传入"""
+    @wraps(handler)
+    async def wrapper(request: Request, *args, **kwargs):
+        error = _admin_error(request)
+        if error is not None:
+            return error
+        return await handler(request, *args, **kwargs)
+    return wrapper
+
+# openai_config 中工具调用循环的数值项：(键, 是否整数, 下限, 是否不含下限)
+OPENAI_CONFIG_LIMITS = (
+    ("max_tool_steps", True, 1, False),
+    ("tool_deadline_seconds", False, 0, True),
+    ("token_budget", True, 0, False),
+    ("tool_top_k", True, 0, False),
+)
+
+def config_number(config: Dict[str, Any], key: str, default: Any, integer: bool = False,
+                  minimum: float = 0, exclusive: bool = False) -> Any:
+    """读取 openai_config 中的数值项：缺失或为 null 时返回 default，类型或范围无效时抛出 ValueError"""
+    value = config.get(key)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or (
+            integer and not float(value).is_integer()):
+        raise ValueError(f"openai_config.{key} 必须是{'整数' if integer else '数字'}")
+    if value < minimum or (exclusive and value == minimum):
+        raise ValueError(f"openai_config.{key} 必须{'大于' if exclusive else '不小于'} {minimum}")
+    return int(value) if integer else float(value)
+
+def config_string_list(config: Dict[str, Any], key: str) -> List[str]:
+    """读取 openai_config 中的字符串数组：缺失或为 null 时返回空数组，类型无效时抛出 ValueError"""
+    value = config.get(key)
+    if value is None:
+        return []
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ValueError(f"openai_config.{key} 必须是字符串数组")
+    return value
 
 def validate_agent_data(data: Dict[str, Any]) -> List[str]:
     """验证 Agent 数据"""
@@ -51,9 +270,36 @@ def validate_agent_data(data: Dict[str, Any]) -> List[str]:
     
     if "openai_config" in data and not isinstance(data["openai_config"], dict):
         errors.append("OpenAI 配置必须是对象")
+    elif isinstance(data.get("openai_config"), dict):
+        for key, integer, minimum, exclusive in OPENAI_CONFIG_LIMITS:
+            try:
+                config_number(data["openai_config"], key, None, integer, minimum, exclusive)
+            except ValueError as e:
+                errors.append(str(e))
+        try:
+            config_string_list(data["openai_config"], "always_include_tools")
+        except ValueError as e:
+            errors.append(str(e))
     
     return errors
 
+
+def parse_agent_id(value: Any) -> Optional[int]:
+    """把请求中的 agent_id（整数或数字字符串）转换为整数，无效时返回 None"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    return None
+
+
+def agent_label(agent_id: Any, found: bool = True) -> str:
+    """指标的 agent 标签值：整数 ID，查找失败或 ID 无效时为 unknown，避免请求中的任意值成为标签"""
+    key = parse_agent_id(agent_id) if found else None
+    return "unknown" if key is None else str(key)
+
 def get_database_url() -> str:
     """获取数据库连接URL"""
     # 使用 MySQL 数据库
@@ -64,9 +310,75 @@ def parse_request_json(request: Request) -> Dict[str, Any]:
     try:
         return request.json or {}
     except Exception as e:
-        logger.error(f"解析JSON失败: {str(e)}")
+        logger.error("解析JSON失败: %s", e)
         return {}
 
+# 列表接口分页参数
+DEFAULT_LIST_MAX_LIMIT = int(os.getenv("LIST_MAX_LIMIT", "200"))
+
+def parse_list_query(request: Request, allowed_fields: Iterable[str]) -> Tuple[Dict[str, Any], List[str]]:
+    """解析列表接口的 limit / cursor / fields 参数
+
+    - limit: 每页条数，不传时返回全部（兼容旧行为）
+    - cursor: 上一页返回的 X-Next-Cursor（按 id 递增的游标）
+    - fields: 逗号分隔的字段投影，例如 fields=id,name,description
+    """
+    errors = []
+    params: Dict[str, Any] = {"limit": None, "cursor": None, "fields": None}
+
+    limit = request.args.get("limit")
+    if limit is not None:
+        try:
+            params["limit"] = int(limit)
+            if not 0 < params["limit"] <= DEFAULT_LIST_MAX_LIMIT:
+                errors.append(f"limit 必须在 1 到 {DEFAULT_LIST_MAX_LIMIT} 之间")
+        except ValueError:
+            errors.append("limit 必须是整数")
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            params["cursor"] = int(cursor)
+        except ValueError:
+            errors.append("cursor 无效")
+
+    fields = request.args.get("fields")
+    if fields:
+        allowed = list(allowed_fields)
+        requested = {f.strip() for f in fields.split(",") if f.strip()}
+        unknown = requested - set(allowed)
+        if unknown:
+            errors.append(f"未知字段: {', '.join(sorted(unknown))}")
+        # 保持模型定义中的字段顺序
+        params["fields"] = [f for f in allowed if f in requested]
+
+    return params, errors
+
+def build_weak_etag(*parts: Any) -> str:
+    """根据版本信息生成弱 ETag"""
+    digest = hashlib.sha1("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """检查 If-None-Match 是否命中（弱比较）"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    target = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == target:
+            return True
+    return False
+
+def not_modified_response(etag: str):
+    """304 Not Modified 响应"""
+    return empty(status=304, headers={"ETag": etag})
+
 def format_openai_messages(prompt: str, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
     """格式化 OpenAI 消息"""
     formatted_messages = [{"role": "system", "content": prompt}]
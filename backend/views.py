@@ -1,11 +1,37 @@
 from sanic import Blueprint
-from sanic.response import json as sanic_json
+from sanic.response import json as sanic_json, text, raw, ResponseStream
 from sanic import Request
+from tortoise.functions import Max, Count
+from tortoise.exceptions import DoesNotExist
 from models import Agent, MCPServer
-from utils import success_response, error_response, validate_agent_data, parse_request_json
+from utils import (
+    success_response, error_response, validate_agent_data, parse_request_json,
+    parse_list_query, build_weak_etag, etag_matches, not_modified_response,
+    response_cache, cached_json_response, require_admin, is_admin, json_dumps, agent_label,
+)
 from handler import AgentHandler
+from tracing import start_trace, new_trace_id, trace_buffer
+from replay import session_recorder
+from loop_monitor import loop_monitor
+from usage import UsageAccumulator, usage_tracker
+from circuit_breaker import mcp_breakers
+from stdio_pool import parse_stdio_url, STDIO_SCHEME
+from jobs import JobQueueFull, SUCCEEDED as JOB_SUCCEEDED
+from stream_log import stream_logs, parse_last_event_id
+from ws_chat import ChatSocket
+from worker_route import worker_router, handler as worker_route_handler
+from llm_scheduler import set_request_class, normalize_class, CLASSES, BATCH
+from profiler import (
+    process_profiler, profile_request, ProfilerBusy, format_collapsed, pstats_text, pstats_dump,
+    DEFAULT_INTERVAL, SORT_KEYS,
+)
+from metrics import SSE_WRITE_SECONDS, CACHE_HITS_TOTAL, CACHE_MISSES_TOTAL, ERRORS_TOTAL
 import json
+import math
+import os
+import time
 import asyncio
+from contextlib import nullcontext
 
 # 创建 handler 实例
 agent_handler = AgentHandler()
@@ -13,13 +39,74 @@ agent_handler = AgentHandler()
 # 创建蓝图
 api = Blueprint("api", url_prefix="/api")
 
+async def _list_with_etag(request: Request, model_cls, decorate=None, extra_version=None):
+    """通用列表查询：支持 limit/cursor 分页、fields 投影与弱 ETag
+
+    ETag 由 max(updated_at) + 行数 + 查询参数 计算，仅需一次聚合查询；
+    命中 If-None-Match 时直接返回 304，不再读取整表。
+    decorate 可为每一项补充运行时字段，此时 extra_version 需随这些字段变化。
+    """
+    params, errors = parse_list_query(request, model_cls.SERIALIZABLE_FIELDS)
+    if errors:
+        return error_response("查询参数无效", 400, {"errors": errors})
+
+    version = await model_cls.all().annotate(
+        max_updated=Max("updated_at"), total=Count("id")
+    ).values("max_updated", "total")
+    state = version[0] if version else {}
+    etag = build_weak_etag(
+        model_cls._meta.db_table,
+        state.get("max_updated"),
+        state.get("total"),
+        request.query_string,
+        extra_version,
+    )
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+
+    # ETag 作为缓存版本号：数据未变化时直接返回预编码的响应体
+    namespace = model_cls._meta.db_table
+    cache_key = f"{request.path}?{request.query_string}"
+    cached = response_cache.get(namespace, cache_key, version=etag)
+    if cached:
+        CACHE_HITS_TOTAL.labels("response").inc()
+        body, headers = cached
+        return cached_json_response(body, headers)
+    CACHE_MISSES_TOTAL.labels("response").inc()
+
+    query = model_cls.all().order_by("id")
+    if params["cursor"] is not None:
+        query = query.filter(id__gt=params["cursor"])
+    if params["fields"]:
+        # 游标依赖 id，投影时总是加载 id
+        query = query.only(*({"id"} | set(params["fields"])))
+    if params["limit"]:
+        # 多取一条用于判断是否还有下一页
+        query = query.limit(params["limit"] + 1)
+
+    items = await query
+    next_cursor = None
+    if params["limit"] and len(items) > params["limit"]:
+        items = items[:params["limit"]]
+        next_cursor = items[-1].id
+
+    headers = {"ETag": etag}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = str(next_cursor)
+    rows = [item.to_dict(params["fields"]) for item in items]
+    if decorate is not None:
+        rows = [decorate(row) for row in rows]
+    response = success_response(rows)
+    response.headers.update(headers)
+    response_cache.put(namespace, cache_key, response.body, headers, version=etag)
+    return response
+
 # Agent 相关路由
 @api.route("/agents", methods=["GET"])
 async def list_agents(request: Request):
-    """获取所有 Agent"""
+    """获取 Agent 列表（支持分页、字段投影与 ETag）"""
     try:
-        agents = await Agent.all()
-        return success_response([agent.to_dict() for agent in agents])
+        return await _list_with_etag(request, Agent)
     except Exception as e:
         return error_response(f"获取 Agent 列表失败: {str(e)}", 500)
 
@@ -48,6 +135,7 @@ async def create_agent(request: Request):
             openai_config=data.get("openai_config", {})
         )
         
+        response_cache.invalidate(Agent._meta.db_table)
         return success_response(agent.to_dict(), "Agent 创建成功")
     except Exception as e:
         return error_response(f"创建 Agent 失败: {str(e)}", 500)
@@ -58,7 +146,7 @@ async def get_agent(request: Request, agent_id: int):
     try:
         agent = await Agent.get(id=agent_id)
         return success_response(agent.to_dict())
-    except Agent.DoesNotExist:
+    except DoesNotExist:
         return error_response("Agent 不存在", 404)
     except Exception as e:
         return error_response(f"获取 Agent 失败: {str(e)}", 500)
@@ -87,8 +175,10 @@ async def update_agent(request: Request, agent_id: int):
                 setattr(agent, field, data[field])
         
         await agent.save()
+        response_cache.invalidate(Agent._meta.db_table)
+        agent_handler.invalidate_agent(agent_id)
         return success_response(agent.to_dict(), "Agent 更新成功")
-    except Agent.DoesNotExist:
+    except DoesNotExist:
         return error_response("Agent 不存在", 404)
     except Exception as e:
         return error_response(f"更新 Agent 失败: {str(e)}", 500)
@@ -99,12 +189,31 @@ async def delete_agent(request: Request, agent_id: int):
     try:
         agent = await Agent.get(id=agent_id)
         await agent.delete()
+        response_cache.invalidate(Agent._meta.db_table)
+        agent_handler.invalidate_agent(agent_id)
         return success_response(None, "Agent 删除成功")
-    except Agent.DoesNotExist:
+    except DoesNotExist:
         return error_response("Agent 不存在", 404)
     except Exception as e:
         return error_response(f"删除 Agent 失败: {str(e)}", 500)
 
+def _session_id(data: dict):
+    """请求体中的可选会话 ID，用于按会话累计 token 用量"""
+    session_id = data.get("session_id")
+    return str(session_id)[:128] if session_id else None
+
+def _priority_class_error(data: dict):
+    """请求体中 priority_class 无效时返回错误响应"""
+    value = data.get("priority_class")
+    if value is not None and normalize_class(value) is None:
+        return error_response(f"priority_class 必须是 {' / '.join(CLASSES)} 之一", 400)
+    return None
+
+def _profile_requested(request: Request, data: dict) -> bool:
+    """单请求剖析：请求体 profile=true 或 X-Profile: 1，且需携带管理员令牌"""
+    flag = data.get("profile") or request.headers.get("x-profile", "").lower() in ("1", "true")
+    return bool(flag) and is_admin(request)
+
 # 聊天相关路由
 @api.route("/chat/send", methods=["POST"])
 async def send_message(request: Request):
@@ -119,21 +228,83 @@ async def send_message(request: Request):
         
         if not messages:
             return error_response("缺少 messages 参数", 400)
+        invalid = _priority_class_error(data)
+        if invalid:
+            return invalid
+        session_recorder.record_inbound("send", data)
+        profiling = _profile_requested(request, data)
+        set_request_class(data.get("priority_class"))
         
         # 处理消息
-        response = await agent_handler.process_message(agent_id, messages, stream=False)
+        with start_trace("chat.send", trace_id=getattr(request.ctx, "request_id", None), agent_id=agent_id, messages=len(messages)) as trace, \
+                (profile_request() if profiling else nullcontext()):
+            response = await agent_handler.process_message(
+                agent_id, messages, stream=False, session_id=_session_id(data)
+            )
+            if isinstance(response, dict) and response.get("usage"):
+                trace.root.set("usage", response["usage"])
         
         if isinstance(response, dict) and not response.get("success", True):
-            return error_response(response.get("error", "处理消息失败"), 500)
-        
-        return success_response(response)
+            result = error_response(response.get("error", "处理消息失败"), 500)
+        else:
+            result = success_response(response)
+        result.headers["X-Trace-Id"] = trace.trace_id
+        return result
     except Exception as e:
         return error_response(f"发送消息失败: {str(e)}", 500)
 
+def _stream_response(log, after_seq: int = 0, headers=None):
+    """SSE 响应：从 after_seq 之后跟随流日志，连接断开不影响后台生成"""
+    async def streaming_fn(response):
+        sse_write = SSE_WRITE_SECONDS.labels()
+        write_seconds = 0.0
+        try:
+            async for event in log.follow(after_seq):
+                started = time.perf_counter()
+                await response.write(event)
+                elapsed = time.perf_counter() - started
+                sse_write.observe(elapsed)
+                write_seconds += elapsed
+        finally:
+            if log.trace is not None:
+                total = log.trace.root.attributes.get("sse_write_ms", 0)
+                log.trace.root.set("sse_write_ms", round(total + write_seconds * 1000, 2))
+
+    from sanic.response import ResponseStream
+    return ResponseStream(
+        streaming_fn,
+        content_type="text/event-stream; charset=utf-8",
+        headers={"X-Stream-Id": log.id, **(headers or {})},
+    )
+
+@worker_route_handler("stream_resume")
+async def _resume_stream(stream_id, after_seq: int):
+    """续传已有的流：流不存在或已过期返回 410，续传点已被丢弃返回 409
+
+    流只保存在创建它的 worker 内，经 worker_router 转交给所属 worker 处理（见 worker_route.py）。
+    """
+    log = stream_logs.get(stream_id) if stream_id else None
+    if log is None:
+        return error_response("流不存在或已过期，请重新发送", 410)
+    if not log.can_resume(after_seq):
+        return error_response("续传位置无效或已超出缓冲范围，请重新发送", 409)
+    return _stream_response(log, after_seq)
+
 @api.route("/chat/stream", methods=["POST"])
 async def send_message_stream(request: Request):
-    """发送消息并流式获取回复 - 使用 SSE 风格 data: 行输出"""
+    """发送消息并流式获取回复 - 使用 SSE 风格 data: 行输出
+
+    每个事件带 `id: 流ID:序号`；断线后带 Last-Event-ID 头重新请求即从下一个事件续传，
+    不会再次调用上游。
+    """
     try:
+        last_event_id = request.headers.get("last-event-id")
+        if last_event_id:
+            stream_id, after_seq = parse_last_event_id(last_event_id)
+            if stream_id is None:
+                return error_response("流不存在或已过期，请重新发送", 410)
+            return await worker_router.call("stream_resume", stream_id, after_seq=after_seq)
+
         data = parse_request_json(request)
         agent_id = data.get("agent_id")
         messages = data.get("messages", [])
@@ -142,30 +313,250 @@ async def send_message_stream(request: Request):
             return error_response("缺少 agent_id 参数", 400)
         if not messages:
             return error_response("缺少 messages 参数", 400)
+        if not isinstance(messages, list):
+            return error_response("messages 必须是数组", 400)
+        invalid = _priority_class_error(data)
+        if invalid:
+            return invalid
+        session_recorder.record_inbound("stream", data)
 
-        # 使用真正的 agent_handler 流式处理
-        async def streaming_fn(response):
+        trace_id = getattr(request.ctx, "request_id", None) or new_trace_id()
+        profiling = _profile_requested(request, data)
+
+        usage = UsageAccumulator(agent_id, session_id=_session_id(data))
+        log = stream_logs.create()
+
+        # 生成在后台任务中进行，与 HTTP 连接解耦；剖析只采样当前任务，因此也在这里开启
+        async def produce():
+            # finish 放在最外层：Trace 或剖析建立失败时流也会结束并被清理
             try:
-                async for chunk in agent_handler.process_message_stream(agent_id, messages):
-                    # 将文本增量以 SSE data: 行写出
-                    await response.write(f"data: {chunk}\n\n")
-                await response.write("data: [DONE]\n\n")
+                set_request_class(data.get("priority_class"))
+                with start_trace("chat.stream", trace_id=trace_id, agent_id=agent_id, messages=len(messages),
+                                 stream_id=log.id) as trace, \
+                        (profile_request() if profiling else nullcontext()):
+                    log.trace = trace
+                    events = 0
+                    try:
+                        async for chunk in agent_handler.process_message_stream(agent_id, messages, usage=usage):
+                            # 将文本增量以 SSE data: 行写出
+                            log.append(f"data: {chunk}\n\n")
+                            events += 1
+                        # 具名事件 usage：各轮上游调用的 token 用量之和（仅处理 data 事件的客户端会忽略）
+                        log.append(f"event: usage\ndata: {json_dumps(usage.total())}\n\n")
+                        log.append("data: [DONE]\n\n")
+                    except asyncio.CancelledError:
+                        trace.root.status = "cancelled"
+                        log.append("data: [ERROR] 客户端断开且未续传，已停止生成\n\n")
+                    except Exception as e:
+                        # 如果真实 API 失败，返回错误信息
+                        found = not isinstance(e, DoesNotExist)
+                        ERRORS_TOTAL.labels(component="sse", agent=agent_label(agent_id, found)).inc()
+                        trace.root.status = "error"
+                        trace.root.set("error", str(e))
+                        log.append(f"data: [ERROR] {str(e)}\n\n")
+                    finally:
+                        trace.root.set("usage", usage.total())
+                        trace.root.set("sse_events", events)
             except Exception as e:
-                # 如果真实 API 失败，返回错误信息
-                await response.write(f"data: [ERROR] {str(e)}\n\n")
+                ERRORS_TOTAL.labels(component="sse", agent=agent_label(agent_id)).inc()
+                log.append(f"data: [ERROR] {str(e)}\n\n")
+            finally:
+                stream_logs.finish(log)
 
-        from sanic.response import ResponseStream
-        return ResponseStream(streaming_fn, content_type="text/event-stream; charset=utf-8")
+        log.task = asyncio.create_task(produce(), name=f"chat-stream-{log.id}")
+        return _stream_response(log, headers={"X-Trace-Id": trace_id})
     except Exception as e:
         return error_response(f"流式发送消息失败: {str(e)}", 500)
 
+@api.route("/chat/stream/<stream_id>", methods=["GET"])
+async def resume_message_stream(request: Request, stream_id: str):
+    """续传流：序号取 Last-Event-ID 头（流ID:序号）或 last_event_id 查询参数，缺省从头回放"""
+    header_id, after_seq = parse_last_event_id(request.headers.get("last-event-id"))
+    if header_id is not None and header_id != stream_id:
+        return error_response("Last-Event-ID 与流 ID 不一致", 400)
+    if header_id is None and request.args.get("last_event_id"):
+        try:
+            after_seq = max(0, int(request.args.get("last_event_id")))
+        except ValueError:
+            return error_response("last_event_id 必须是整数", 400)
+    return await worker_router.call("stream_resume", stream_id, after_seq=after_seq)
+
+@api.websocket("/chat/ws")
+async def chat_websocket(request: Request, ws):
+    """在一个 WebSocket 上复用多个流式对话（协议见 ws_chat.py）"""
+    await ChatSocket(ws, agent_handler).serve()
+
+# 批量对话：默认并发、并发上限与单次请求的条目上限
+BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "8"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("CHAT_BATCH_MAX_CONCURRENCY", "32"))
+BATCH_MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "10000"))
+
+@api.route("/chat/batch", methods=["POST"])
+async def send_message_batch(request: Request):
+    """批量对话：{items: [{agent_id, messages, session_id?, id?}], concurrency?}
+
+    以 NDJSON 逐行返回，每条对话完成即输出一行 {index, id, success, data | error}，
+    单条失败不影响其他条目；最后一行为 {summary: {...}}。
+    """
+    try:
+        data = parse_request_json(request)
+        items = data.get("items")
+        if not isinstance(items, list) or not items:
+            return error_response("缺少 items 参数", 400)
+        if len(items) > BATCH_MAX_ITEMS:
+            return error_response(f"单次最多 {BATCH_MAX_ITEMS} 条对话", 400)
+        try:
+            concurrency = int(data.get("concurrency", BATCH_CONCURRENCY))
+        except (TypeError, ValueError):
+            return error_response("concurrency 必须是整数", 400)
+        concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+        invalid = _priority_class_error(data)
+        if invalid:
+            return invalid
+
+        async def streaming_fn(response):
+            # 批量对话的上游调用默认按 batch 类别排队
+            set_request_class(data.get("priority_class"), default=BATCH)
+            started = time.perf_counter()
+            succeeded = failed = 0
+            async for result in agent_handler.process_batch(items, concurrency):
+                if result["success"]:
+                    succeeded += 1
+                else:
+                    failed += 1
+                await response.write(json_dumps(result) + "\n")
+            await response.write(json_dumps({"summary": {
+                "total": len(items),
+                "succeeded": succeeded,
+                "failed": failed,
+                "concurrency": concurrency,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+            }}) + "\n")
+
+        from sanic.response import ResponseStream
+        return ResponseStream(streaming_fn, content_type="application/x-ndjson; charset=utf-8")
+    except Exception as e:
+        return error_response(f"批量发送消息失败: {str(e)}", 500)
+
+# 异步任务路由
+@api.route("/jobs", methods=["POST"])
+async def submit_job(request: Request):
+    """提交后台执行的对话任务，立即返回任务 ID"""
+    try:
+        data = parse_request_json(request)
+        agent_id = data.get("agent_id")
+        messages = data.get("messages", [])
+
+        if not agent_id:
+            return error_response("缺少 agent_id 参数", 400)
+        if not messages:
+            return error_response("缺少 messages 参数", 400)
+        try:
+            priority = max(-10, min(10, int(data.get("priority", 0))))
+            deadline = data.get("deadline_seconds")
+            deadline = float(deadline) if deadline is not None else None
+        except (TypeError, ValueError):
+            return error_response("priority 必须是整数，deadline_seconds 必须是数字", 400)
+        if deadline is not None and deadline <= 0:
+            return error_response("deadline_seconds 必须大于 0", 400)
+        invalid = _priority_class_error(data)
+        if invalid:
+            return invalid
+
+        job = agent_handler.jobs.submit(
+            agent_id, messages, session_id=_session_id(data), priority=priority, deadline=deadline,
+            request_id=getattr(request.ctx, "request_id", None),
+            priority_class=normalize_class(data.get("priority_class")),
+        )
+        return success_response(job.to_dict(include_result=False), "任务已提交")
+    except JobQueueFull as e:
+        return error_response(str(e), 429)
+    except Exception as e:
+        return error_response(f"提交任务失败: {str(e)}", 500)
+
+# 任务只保存在创建它的 worker 内，以下操作经 worker_router 转交给所属 worker（见 worker_route.py）
+@worker_route_handler("job_get")
+async def _job_get(job_id: str, wait: float = 0.0):
+    job = agent_handler.jobs.get(job_id)
+    if job is None:
+        return error_response("任务不存在或已过期", 404)
+    if wait and not job.finished:
+        await job.wait(wait)
+    return success_response(job.to_dict())
+
+@worker_route_handler("job_stream")
+async def _job_stream(job_id: str):
+    job = agent_handler.jobs.get(job_id)
+    if job is None:
+        return error_response("任务不存在或已过期", 404)
+
+    async def streaming_fn(response):
+        async for chunk in job.follow():
+            await response.write(f"data: {chunk}\n\n")
+        await response.write(f"event: job\ndata: {json_dumps(job.to_dict(include_result=False))}\n\n")
+        if job.status == JOB_SUCCEEDED:
+            await response.write(f"event: usage\ndata: {json_dumps((job.result or {}).get('usage'))}\n\n")
+            await response.write("data: [DONE]\n\n")
+        else:
+            await response.write(f"data: [ERROR] {job.error}\n\n")
+
+    return ResponseStream(streaming_fn, content_type="text/event-stream; charset=utf-8")
+
+@worker_route_handler("job_delete")
+async def _job_delete(job_id: str):
+    job = agent_handler.jobs.get(job_id)
+    if job is None:
+        return error_response("任务不存在或已过期", 404)
+    if job.finished:
+        agent_handler.jobs.remove(job_id)
+        return success_response(None, "任务已删除")
+    await agent_handler.jobs.cancel(job)
+    return success_response(job.to_dict(include_result=False), "任务已取消")
+
+@api.route("/jobs/<job_id>", methods=["GET"])
+async def get_job(request: Request, job_id: str):
+    """任务状态与结果；wait=秒数 时最多等待任务结束（长轮询，上限 30 秒）"""
+    try:
+        wait = min(30.0, max(0.0, float(request.args.get("wait", 0))))
+    except ValueError:
+        return error_response("wait 必须是数字", 400)
+    return await worker_router.call("job_get", job_id, wait=wait)
+
+@api.route("/jobs/<job_id>/stream", methods=["GET"])
+async def stream_job(request: Request, job_id: str):
+    """附加到任务的实时输出：先回放已产生的片段，再跟随到任务结束（格式同 /chat/stream）"""
+    return await worker_router.call("job_stream", job_id)
+
+@api.route("/jobs/<job_id>", methods=["DELETE"])
+async def delete_job(request: Request, job_id: str):
+    """取消未结束的任务；已结束的任务则删除其记录"""
+    return await worker_router.call("job_delete", job_id)
+
 # MCP 服务器管理路由
+def _mcp_url_error(request: Request, api_url: str):
+    """校验 MCP 地址：支持 http(s):// 与 stdio://，后者会在后端启动子进程，需要管理员令牌"""
+    if api_url.startswith("http://") or api_url.startswith("https://"):
+        return None
+    if api_url.startswith(STDIO_SCHEME):
+        try:
+            parse_stdio_url(api_url)
+        except ValueError as e:
+            return error_response(str(e), 400)
+        if not is_admin(request):
+            return error_response("stdio:// 服务器会在后端启动子进程，需要管理员令牌", 403)
+        return None
+    return error_response("仅支持以 http://、https:// 或 stdio:// 开头的 MCP 服务器地址", 400)
+
 @api.route("/mcp/servers", methods=["GET"])
 async def list_mcp_servers(request: Request):
-    """获取所有 MCP 服务器"""
+    """获取 MCP 服务器列表（支持分页、字段投影与 ETag），附带各服务器的熔断状态"""
+    def with_breaker(row):
+        if "name" in row:
+            row["breaker"] = mcp_breakers.snapshot(row["name"])
+        return row
+
     try:
-        servers = await MCPServer.all()
-        return success_response([server.to_dict() for server in servers])
+        return await _list_with_etag(request, MCPServer, decorate=with_breaker, extra_version=mcp_breakers.version)
     except Exception as e:
         return error_response(f"获取 MCP 服务器列表失败: {str(e)}", 500)
 
@@ -181,8 +572,9 @@ async def create_mcp_server(request: Request):
         api_url = (data.get("api_url") or "").strip()
         if not api_url:
             return error_response("API 地址不能为空", 400)
-        if not (api_url.startswith("http://") or api_url.startswith("https://")):
-            return error_response("仅支持以 http:// 或 https:// 开头的 MCP HTTP 接口", 400)
+        url_error = _mcp_url_error(request, api_url)
+        if url_error is not None:
+            return url_error
 
         # 检查名称是否已存在
         existing_server = await MCPServer.filter(name=data["name"]).first()
@@ -195,6 +587,8 @@ async def create_mcp_server(request: Request):
             api_url=api_url,
             is_active=data.get("is_active", True)
         )
+        response_cache.invalidate(MCPServer._meta.db_table)
+        agent_handler.mcp_handler.invalidate_cache(server.name)
 
         return success_response(server.to_dict(), "MCP 服务器创建成功")
     except Exception as e:
@@ -207,6 +601,7 @@ async def update_mcp_server(request: Request, server_id: int):
         data = parse_request_json(request)
 
         server = await MCPServer.get(id=server_id)
+        old_name = server.name
 
         # 如果要更新名称，检查是否与其他服务器重复
         if "name" in data and data["name"] != server.name:
@@ -214,11 +609,13 @@ async def update_mcp_server(request: Request, server_id: int):
             if existing_server:
                 return error_response("服务器名称已存在", 400)
 
-        # 限制 api_url 只能是 http(s)
+        # 校验 api_url 协议；编辑表单总会带上 api_url，地址未变时不重复校验（不要求管理员令牌）
         if "api_url" in data:
             new_url = (data["api_url"] or "").strip()
-            if not (new_url.startswith("http://") or new_url.startswith("https://")):
-                return error_response("仅支持以 http:// 或 https:// 开头的 MCP HTTP 接口", 400)
+            if new_url != (server.api_url or "").strip():
+                url_error = _mcp_url_error(request, new_url)
+                if url_error is not None:
+                    return url_error
             data["api_url"] = new_url
 
         # 更新字段
@@ -227,9 +624,11 @@ async def update_mcp_server(request: Request, server_id: int):
                 setattr(server, field, data[field])
 
         await server.save()
+        response_cache.invalidate(MCPServer._meta.db_table)
+        agent_handler.mcp_handler.invalidate_cache(old_name, server.name)
 
         return success_response(server.to_dict(), "MCP 服务器更新成功")
-    except MCPServer.DoesNotExist:
+    except DoesNotExist:
         return error_response("MCP 服务器不存在", 404)
     except Exception as e:
         return error_response(f"更新 MCP 服务器失败: {str(e)}", 500)
@@ -240,9 +639,11 @@ async def delete_mcp_server(request: Request, server_id: int):
     try:
         server = await MCPServer.get(id=server_id)
         await server.delete()
+        response_cache.invalidate(MCPServer._meta.db_table)
+        agent_handler.mcp_handler.invalidate_cache(server.name)
 
         return success_response(None, "MCP 服务器删除成功")
-    except MCPServer.DoesNotExist:
+    except DoesNotExist:
         return error_response("MCP 服务器不存在", 404)
     except Exception as e:
         return error_response(f"删除 MCP 服务器失败: {str(e)}", 500)
@@ -261,3 +662,106 @@ async def get_server_tools(request: Request, server_name: str):
 async def health_check(request: Request):
     """健康检查"""
     return success_response({"status": "healthy"}, "服务正常运行")
+
+@api.route("/health/ready", methods=["GET"])
+async def readiness_check(request: Request):
+    """就绪检查 - 仅在当前 worker 预热成功后返回 200；预热失败时返回 503 并附带错误"""
+    warmup = getattr(request.app.ctx, "warmup", None)
+    if not warmup or not warmup.get("done"):
+        return error_response("服务预热中", 503, {"status": "warming_up"})
+    if not warmup.get("ok"):
+        return error_response(f"服务预热未成功: {warmup.get('error')}", 503, {"status": "warmup_failed", **warmup})
+    return success_response({"status": "ready", **warmup}, "服务已就绪")
+
+# 管理接口
+# 用量统计路由
+@api.route("/usage", methods=["GET"])
+async def get_usage(request: Request):
+    """按 Agent + 模型聚合的 token 用量（当前 worker），可用 agent_id / model 过滤"""
+    return success_response(usage_tracker.summary(
+        agent_id=request.args.get("agent_id"),
+        model=request.args.get("model"),
+    ))
+
+@api.route("/usage/sessions/<session_id>", methods=["GET"])
+async def get_session_usage(request: Request, session_id: str):
+    """单个会话累计的 token 用量"""
+    usage = usage_tracker.session(session_id)
+    if usage is None:
+        return error_response("会话不存在或没有用量记录", 404)
+    return success_response(usage)
+
+@api.route("/admin/traces", methods=["GET"])
+@require_admin
+async def list_traces(request: Request):
+    """最近请求中最慢的 Trace 列表"""
+    try:
+        limit = int(request.args.get("limit", trace_buffer.capacity))
+    except ValueError:
+        return error_response("limit 必须是整数", 400)
+    return success_response([t.to_dict(include_spans=False) for t in trace_buffer.slowest(limit)])
+
+@api.route("/admin/traces/<trace_id>", methods=["GET"])
+@require_admin
+async def get_trace(request: Request, trace_id: str):
+    """查看单个 Trace 的全部 span"""
+    trace = trace_buffer.get(trace_id)
+    if not trace:
+        return error_response("Trace 不存在或已过期", 404)
+    if request.args.get("format") == "collapsed":
+        if trace.profile is None:
+            return error_response("该 Trace 没有剖析数据", 404)
+        return text(trace.profile["collapsed"], content_type="text/plain; charset=utf-8")
+    return success_response(trace.to_dict())
+
+@api.route("/admin/loop", methods=["GET"])
+@require_admin
+async def loop_status(request: Request):
+    """当前 worker 的事件循环延迟分位数与最近的阻塞调用栈"""
+    include_stacks = request.args.get("stacks", "1").lower() not in ("0", "false")
+    return success_response(loop_monitor.snapshot(include_stacks))
+
+@api.route("/admin/profile", methods=["GET"])
+@require_admin
+async def profile_process(request: Request):
+    """对当前 worker 剖析 N 秒
+
+    mode=sample（默认）：统计采样，format=collapsed 返回折叠栈文本，format=json 返回聚合结果
+    mode=cprofile：确定性剖析，format=text 返回 pstats 文本，format=pstats 返回二进制 dump
+    """
+    try:
+        seconds = float(request.args.get("seconds", "10"))
+        interval = float(request.args.get("interval", DEFAULT_INTERVAL))
+        limit = int(request.args.get("limit", "50"))
+    except ValueError:
+        return error_response("seconds/interval/limit 参数无效", 400)
+    # float() 接受 nan/inf，比较运算拦不住 nan，需要单独拒绝
+    if not (math.isfinite(seconds) and math.isfinite(interval)):
+        return error_response("seconds/interval 必须是有限数字", 400)
+    if seconds <= 0:
+        return error_response("seconds 必须大于 0", 400)
+    mode = request.args.get("mode", "sample")
+    if mode not in ("sample", "cprofile"):
+        return error_response("mode 只能是 sample 或 cprofile", 400)
+    sort = request.args.get("sort", "cumulative")
+    if sort not in SORT_KEYS:
+        return error_response(f"sort 只能是 {', '.join(SORT_KEYS)} 之一", 400)
+
+    try:
+        if mode == "sample":
+            sampler = await process_profiler.sample(seconds, interval)
+            if request.args.get("format", "collapsed") == "json":
+                return success_response(sampler.summary(limit))
+            return text(format_collapsed(sampler.stacks), content_type="text/plain; charset=utf-8")
+
+        profile = await process_profiler.cprofile(seconds)
+        if request.args.get("format", "text") == "pstats":
+            return raw(
+                pstats_dump(profile),
+                content_type="application/octet-stream",
+                headers={"Content-Disposition": f'attachment; filename="profile-{os.getpid()}.pstats"'},
+            )
+        return text(pstats_text(profile, sort, limit),
+                    content_type="text/plain; charset=utf-8")
+    except ProfilerBusy as e:
+        return error_response(str(e), 409)
@@ -0,0 +1,176 @@
+"""
+多 worker 间的请求路由
+
+异步任务（jobs.py）与可续传流（stream_log.py）的状态保存在创建它们的 worker 进程内。
+生产模式多个 worker 共用一个端口，后续的查询、取消、续传请求会落到任意 worker 上，
+因此：
+
+- ID 带上所属 worker 的序号（`序号-随机串`，序号来自 Sanic 的 SANIC_WORKER_NAME）。
+- 生产模式且 WORKERS > 1 时，每个 worker 额外在 127.0.0.1:(WORKER_ROUTE_PORT + 序号)
+  监听内部端口（WORKER_ROUTE_PORT 默认为 PORT + 100，设为 0 关闭路由）。
+- 请求落到非所属 worker 时，经内部端口转交给所属 worker 处理，响应（含 SSE 流）原样转发。
+- 所属 worker 不可达（已重启等）时在本地处理，按资源不存在返回。
+
+内部端口只在本机监听，因此路由只覆盖单机多 worker。多台机器部署时，需要由负载均衡
+按实例保持会话（sticky），否则跨实例的请求仍按资源不存在处理。
+
+内部协议：请求为一行 JSON {"op", "key", "args"}；响应先是一行 JSON
+{"status", "content_type", "headers", "stream"}，随后为响应体，直到连接关闭。
+"""
+
+import asyncio
+import json
+import os
+import re
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from sanic.response import HTTPResponse, ResponseStream, raw
+
+from utils import logger
+
+_WORKER_NAME_RE = re.compile(r"^Sanic-Server-(\d+)-\d+$")
+_ROUTED_ID_RE = re.compile(r"^(\d+)-[0-9a-f]+$")
+
+# 转发时连接所属 worker 的超时（秒）
+CONNECT_TIMEOUT = 2.0
+
+_handlers: Dict[str, Callable[..., Awaitable[HTTPResponse]]] = {}
+
+
+def _worker_index() -> Optional[int]:
+    match = _WORKER_NAME_RE.match(os.getenv("SANIC_WORKER_NAME", ""))
+    return int(match.group(1)) if match else None
+
+
+WORKER_INDEX = _worker_index()
+
+
+def new_id() -> str:
+    """生成带当前 worker 序号的资源 ID；不在 Sanic worker 内运行时为普通随机串"""
+    suffix = uuid.uuid4().hex
+    return suffix if WORKER_INDEX is None else f"{WORKER_INDEX}-{suffix}"
+
+
+def owner_of(resource_id: str) -> Optional[int]:
+    """资源 ID 所属的 worker 序号，无法判断时返回 None"""
+    match = _ROUTED_ID_RE.match(resource_id or "")
+    return int(match.group(1)) if match else None
+
+
+def handler(op: str):
+    """注册可被路由的操作：async fn(key, **args) -> Sanic 响应"""
+    def decorator(fn):
+        _handlers[op] = fn
+        return fn
+    return decorator
+
+
+class _SocketWriter:
+    """供 ResponseStream.streaming_fn 写入内部连接"""
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self._writer = writer
+
+    async def write(self, data: Any) -> None:
+        self._writer.write(data.encode() if isinstance(data, str) else data)
+        await self._writer.drain()
+
+
+class WorkerRouter:
+    def __init__(self):
+        self.base_port = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._server is not None
+
+    async def start(self, config: Dict[str, Any]) -> None:
+        """生产模式多 worker 时启动内部端口"""
+        if config["APP_MODE"] != "production" or config["WORKERS"] <= 1 or WORKER_INDEX is None:
+            return
+        self.base_port = config["WORKER_ROUTE_PORT"]
+        if self.base_port <= 0:
+            logger.warning("WORKER_ROUTE_PORT=0：多 worker 下异步任务与流续传请求可能落到其他 worker 而找不到")
+            return
+        port = self.base_port + WORKER_INDEX
+        try:
+            self._server = await asyncio.start_server(self._serve, "127.0.0.1", port)
+        except OSError as e:
+            logger.error("Worker %s 内部路由端口 %s 启动失败: %s", WORKER_INDEX, port, e)
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def call(self, op: str, key: str, **args: Any) -> HTTPResponse:
+        """处理资源 key 的操作：属于其他 worker 时转交，否则在本地处理"""
+        owner = owner_of(key)
+        if self.enabled and owner is not None and owner != WORKER_INDEX:
+            response = await self._forward(owner, op, key, args)
+            if response is not None:
+                return response
+        return await _handlers[op](key, **args)
+
+    async def _forward(self, owner: int, op: str, key: str, args: Dict[str, Any]) -> Optional[HTTPResponse]:
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection("127.0.0.1", self.base_port + owner), CONNECT_TIMEOUT
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.warning("转交到 worker %s 失败，在本地处理: %s", owner, e)
+            return None
+        try:
+            writer.write(json.dumps({"op": op, "key": key, "args": args}).encode() + b"\n")
+            await writer.drain()
+            head = json.loads(await reader.readline())
+        except Exception as e:
+            writer.close()
+            logger.warning("转交到 worker %s 失败，在本地处理: %s", owner, e)
+            return None
+
+        if not head.get("stream"):
+            body = await reader.read()
+            writer.close()
+            return raw(body, status=head["status"], headers=head.get("headers"), content_type=head["content_type"])
+
+        async def pipe(response):
+            try:
+                while True:
+                    data = await reader.read(65536)
+                    if not data:
+                        return
+                    await response.write(data)
+            finally:
+                writer.close()
+
+        return ResponseStream(pipe, status=head["status"], headers=head.get("headers"),
+                              content_type=head["content_type"])
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = json.loads(await reader.readline())
+            response = await _handlers[request["op"]](request["key"], **request.get("args", {}))
+            stream = isinstance(response, ResponseStream)
+            headers = {k: v for k, v in response.headers.items() if k.lower() != "content-length"}
+            head = {"status": response.status, "content_type": response.content_type,
+                    "headers": headers, "stream": stream}
+            writer.write(json.dumps(head).encode() + b"\n")
+            if stream:
+                await response.streaming_fn(_SocketWriter(writer))
+            else:
+                writer.write(response.body or b"")
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # 转发方的客户端已断开
+            pass
+        except Exception as e:
+            logger.error("处理内部路由请求失败: %s", e)
+        finally:
+            writer.close()
+
+
+worker_router = WorkerRouter()
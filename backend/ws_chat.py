@@ -0,0 +1,249 @@
+"""
+对话 WebSocket：一个连接上复用多个流式对话
+
+每条消息都走 POST /api/chat/stream 需要各自建立连接、发送请求头、经过 CORS 预检，
+多个 Agent 面板也无法在同一连接上并发生成。/api/chat/ws 在一个 WebSocket 上按
+客户端指定的 stream_id 复用多个对话，帧均为 JSON 文本：
+
+客户端 → 服务端
+- {"type": "start", "stream_id", "agent_id", "messages", "session_id"?, "credits"?, "priority_class"?}
+- {"type": "credit", "stream_id", "credits"}：追加可发送的片段数
+- {"type": "cancel", "stream_id"}
+- {"type": "ping"}
+
+服务端 → 客户端
+- {"type": "started", "stream_id", "trace_id"}
+- {"type": "chunk", "stream_id", "seq", "data"}：data 与 SSE 的 data: 行内容相同
+- {"type": "usage", "stream_id", "usage"}
+- {"type": "done" | "cancelled", "stream_id"}
+- {"type": "error", "stream_id"?, "error"}
+- {"type": "pong"}
+
+流控：每个流有一定额度（start 中的 credits，默认 WS_INITIAL_CREDITS），每个 chunk
+消耗 1；额度用完后暂停读取该流的生成，直到客户端发送 credit。其他帧不消耗额度。
+暂停期间该流仍占用上游并发额度与上游连接，因此额度为 0 超过 WS_STALL_TIMEOUT 秒时
+取消该流并发送 error 帧。
+每个连接最多同时进行 WS_MAX_STREAMS 个流，连接关闭时取消其上所有流。
+"""
+
+import asyncio
+import json
+import os
+import time
+from typing import Any, Dict, Optional
+
+from tortoise.exceptions import DoesNotExist
+
+from llm_scheduler import set_request_class, normalize_class
+from log_pipeline import set_request_id
+from metrics import CHAT_WS_CONNECTIONS, CHAT_WS_STREAMS, ERRORS_TOTAL
+from replay import session_recorder
+from tracing import start_trace, new_trace_id
+from usage import UsageAccumulator
+from utils import logger, json_dumps, agent_label
+
+WS_MAX_STREAMS = int(os.getenv("WS_MAX_STREAMS", "8"))
+WS_INITIAL_CREDITS = int(os.getenv("WS_INITIAL_CREDITS", "64"))
+WS_MAX_CREDITS = int(os.getenv("WS_MAX_CREDITS", "4096"))
+# 额度为 0 时等待客户端追加的最长时间（秒）
+WS_STALL_TIMEOUT = float(os.getenv("WS_STALL_TIMEOUT", "30"))
+
+# 全部连接上的计数，用于 gauge
+_connections = 0
+_streams = 0
+
+
+class StreamStalled(Exception):
+    """客户端长时间不追加额度"""
+
+
+class _Stream:
+    """连接上的一个对话流及其发送额度"""
+
+    def __init__(self, stream_id: str, credits: int):
+        self.id = stream_id
+        self.trace_id = new_trace_id()
+        self.credits = credits
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def grant(self, credits: int) -> None:
+        self.credits = min(self.credits + credits, WS_MAX_CREDITS)
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def acquire(self) -> None:
+        """消耗 1 个额度，额度为 0 时等待客户端追加，超过 WS_STALL_TIMEOUT 秒抛出 StreamStalled"""
+        if self.credits <= 0:
+            deadline = time.monotonic() + WS_STALL_TIMEOUT
+            while self.credits <= 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise StreamStalled(f"{WS_STALL_TIMEOUT:g} 秒内未收到 credit，已取消生成")
+                try:
+                    await asyncio.wait_for(self._changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        self.credits -= 1
+
+
+def _credits(value: Any, default: int) -> int:
+    if value is None:
+        return default
+    return max(0, min(int(value), WS_MAX_CREDITS))
+
+
+class ChatSocket:
+    """一个 WebSocket 连接上的多路对话"""
+
+    def __init__(self, ws, agent_handler):
+        self.ws = ws
+        self.agent_handler = agent_handler
+        self.closed = False
+        self._streams: Dict[str, _Stream] = {}
+
+    async def send(self, frame: Dict[str, Any]) -> None:
+        if self.closed:
+            return
+        try:
+            await self.ws.send(json_dumps(frame))
+        except Exception as e:
+            # 连接已断开：接收循环随后结束并取消所有流
+            logger.info("对话 WebSocket 发送失败: %s", e)
+            self.closed = True
+
+    async def serve(self) -> None:
+        global _connections
+        _connections += 1
+        CHAT_WS_CONNECTIONS.set(_connections)
+        try:
+            async for message in self.ws:
+                await self._dispatch(message)
+        except Exception as e:
+            logger.info("对话 WebSocket 连接结束: %s", e)
+        finally:
+            self.closed = True
+            _connections -= 1
+            CHAT_WS_CONNECTIONS.set(_connections)
+            tasks = [s.task for s in self._streams.values() if s.task is not None]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _dispatch(self, message: Any) -> None:
+        try:
+            frame = json.loads(message)
+        except (TypeError, ValueError):
+            await self.send({"type": "error", "error": "帧必须是 JSON 文本"})
+            return
+        if not isinstance(frame, dict):
+            await self.send({"type": "error", "error": "帧必须是 JSON 对象"})
+            return
+
+        kind = frame.get("type")
+        if kind == "ping":
+            await self.send({"type": "pong"})
+            return
+        stream_id = frame.get("stream_id")
+        if not isinstance(stream_id, str) or not stream_id or len(stream_id) > 128:
+            await self.send({"type": "error", "error": "缺少 stream_id 参数"})
+            return
+        try:
+            if kind == "start":
+                await self._start(stream_id, frame)
+            elif kind == "credit":
+                stream = self._streams.get(stream_id)
+                if stream is not None:
+                    stream.grant(_credits(frame.get("credits"), 0))
+            elif kind == "cancel":
+                stream = self._streams.get(stream_id)
+                if stream is not None and stream.task is not None:
+                    stream.task.cancel()
+            else:
+                await self.send({"type": "error", "stream_id": stream_id, "error": f"未知的帧类型: {kind}"})
+        except (TypeError, ValueError):
+            await self.send({"type": "error", "stream_id": stream_id, "error": "credits 必须是整数"})
+
+    async def _start(self, stream_id: str, frame: Dict[str, Any]) -> None:
+        agent_id = frame.get("agent_id")
+        messages = frame.get("messages") or []
+        if stream_id in self._streams:
+            await self.send({"type": "error", "stream_id": stream_id, "error": "stream_id 已在使用中"})
+            return
+        if not agent_id:
+            await self.send({"type": "error", "stream_id": stream_id, "error": "缺少 agent_id 参数"})
+            return
+        if not messages:
+            await self.send({"type": "error", "stream_id": stream_id, "error": "缺少 messages 参数"})
+            return
+        if not isinstance(messages, list):
+            await self.send({"type": "error", "stream_id": stream_id, "error": "messages 必须是数组"})
+            return
+        if frame.get("priority_class") is not None and normalize_class(frame["priority_class"]) is None:
+            await self.send({"type": "error", "stream_id": stream_id, "error": "priority_class 无效"})
+            return
+        if len(self._streams) >= WS_MAX_STREAMS:
+            await self.send({"type": "error", "stream_id": stream_id,
+                             "error": f"单个连接最多同时进行 {WS_MAX_STREAMS} 个对话"})
+            return
+        session_recorder.record_inbound("stream", {
+            k: frame[k] for k in ("agent_id", "messages", "session_id") if k in frame
+        })
+        session_id = frame.get("session_id")
+        stream = _Stream(stream_id, _credits(frame.get("credits"), WS_INITIAL_CREDITS))
+        self._streams[stream_id] = stream
+        stream.task = asyncio.create_task(
+            self._run(stream, agent_id, messages, str(session_id)[:128] if session_id else None,
+                      frame.get("priority_class")),
+            name=f"chat-ws-{stream_id}",
+        )
+
+    async def _run(self, stream: _Stream, agent_id: Any, messages: Any, session_id: Optional[str],
+                   priority_class: Optional[str]) -> None:
+        global _streams
+        _streams += 1
+        CHAT_WS_STREAMS.set(_streams)
+        # 计数与 _streams 的登记在最外层 finally 中撤销：Trace 建立失败时流也会结束
+        try:
+            set_request_id(stream.trace_id)
+            set_request_class(priority_class)
+            usage = UsageAccumulator(agent_id, session_id=session_id)
+            with start_trace("chat.ws", trace_id=stream.trace_id, agent_id=agent_id, messages=len(messages),
+                             stream_id=stream.id) as trace:
+                events = 0
+                chunks = self.agent_handler.process_message_stream(agent_id, messages, usage=usage)
+                try:
+                    await self.send({"type": "started", "stream_id": stream.id, "trace_id": stream.trace_id})
+                    async for chunk in chunks:
+                        await stream.acquire()
+                        events += 1
+                        await self.send({"type": "chunk", "stream_id": stream.id, "seq": events, "data": chunk})
+                    await self.send({"type": "usage", "stream_id": stream.id, "usage": usage.total()})
+                    await self.send({"type": "done", "stream_id": stream.id})
+                except asyncio.CancelledError:
+                    trace.root.status = "cancelled"
+                    await self.send({"type": "cancelled", "stream_id": stream.id})
+                except StreamStalled as e:
+                    trace.root.status = "cancelled"
+                    trace.root.set("error", str(e))
+                    logger.info("对话 WebSocket 流 %s 额度耗尽: %s", stream.id, e)
+                    await self.send({"type": "error", "stream_id": stream.id, "error": str(e)})
+                except Exception as e:
+                    found = not isinstance(e, DoesNotExist)
+                    ERRORS_TOTAL.labels(component="ws", agent=agent_label(agent_id, found)).inc()
+                    trace.root.status = "error"
+                    trace.root.set("error", str(e))
+                    await self.send({"type": "error", "stream_id": stream.id, "error": str(e)})
+                finally:
+                    # 立即关闭生成器，释放上游并发额度与上游连接
+                    await chunks.aclose()
+                    trace.root.set("usage", usage.total())
+                    trace.root.set("ws_events", events)
+        except Exception as e:
+            ERRORS_TOTAL.labels(component="ws", agent=agent_label(agent_id)).inc()
+            logger.error("对话 WebSocket 流 %s 启动失败: %s", stream.id, e)
+            await self.send({"type": "error", "stream_id": stream.id, "error": str(e)})
+        finally:
+            self._streams.pop(stream.id, None)
+            _streams -= 1
+            CHAT_WS_STREAMS.set(_streams)
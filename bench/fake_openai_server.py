@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+OpenAI 兼容的假 LLM 服务器（压测用）
+
+模拟 /v1/chat/completions 的流式与非流式响应，可配置首 token 延迟、
+输出速率与工具调用行为（流式请求以 delta.tool_calls 片段返回工具调用），
+用于在没有真实模型的情况下压测后端。
+
+用法:
+  python fake_openai_server.py --port 9100 --ttft 0.3 --tps 50 --tokens 200 --tool-calls first
+  后端启动时设置 OPENAI_BASE_URL=http://127.0.0.1:9100/v1
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from sanic import Sanic
+from sanic.response import json as sanic_json, ResponseStream
+
+app = Sanic("fake-openai")
+
+# 默认配置，可被命令行参数与请求头 X-Fake-* 覆盖
+CONFIG = {
+    "ttft": 0.3,          # 首 token 延迟（秒）
+    "tps": 50.0,          # 每秒输出 token 数
+    "tokens": 200,        # 每次回复的 token 数
+    "tool_calls": "first",  # never / first / always
+    "tool_name": "",      # 指定调用的工具名，空则使用 tools 中的第一个
+    "tool_delay": 0.2,    # 返回工具调用前的延迟（秒）
+}
+# 多 worker 时通过环境变量把命令行配置传给子进程
+CONFIG.update(json.loads(os.getenv("FAKE_OPENAI_CONFIG", "{}")))
+
+WORDS = ["这是", "一个", "用于", "压测", "的", "模拟", "回复", "，", "包含", "中文", "和", "English", "tokens", "。"]
+
+
+def _option(request, name: str, cast):
+    """请求头 X-Fake-<Name> 可覆盖单次请求的配置"""
+    header = request.headers.get(f"x-fake-{name.replace('_', '-')}")
+    return cast(header) if header is not None else CONFIG[name]
+
+
+def _usage(messages, completion_tokens: int):
+    prompt_tokens = sum(len(str(m.get("content") or "")) for m in messages) // 2 + 1
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _should_call_tool(request, body) -> bool:
+    tools = body.get("tools") or []
+    if not tools:
+        return False
+    mode = _option(request, "tool_calls", str)
+    if mode == "always":
+        return True
+    if mode == "first":
+        # 本轮对话中还没有工具结果时才调用工具
+        return not any(m.get("role") == "tool" for m in body.get("messages", []))
+    return False
+
+
+def _tool_call(request, body):
+    tools = body["tools"]
+    name = _option(request, "tool_name", str) or tools[0]["function"]["name"]
+    return {
+        "id": f"call_{uuid.uuid4().hex[:8]}",
+        "type": "function",
+        "function": {"name": name, "arguments": "{}"},
+    }
+
+
+@app.get("/v1/models")
+async def list_models(request):
+    return sanic_json({"object": "list", "data": [{"id": "fake-model", "object": "model"}]})
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request):
+    body = request.json or {}
+    messages = body.get("messages", [])
+    model = body.get("model", "fake-model")
+    ttft = _option(request, "ttft", float)
+    tps = max(_option(request, "tps", float), 0.001)
+    tokens = _option(request, "tokens", int)
+    created = int(time.time())
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+    call_tool = _should_call_tool(request, body)
+    if call_tool and not body.get("stream"):
+        await asyncio.sleep(_option(request, "tool_delay", float))
+        return sanic_json({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "", "tool_calls": [_tool_call(request, body)]},
+                "finish_reason": "tool_calls",
+            }],
+            "usage": _usage(messages, 10),
+        })
+
+    words = [WORDS[i % len(WORDS)] for i in range(tokens)]
+
+    if not body.get("stream"):
+        await asyncio.sleep(ttft + tokens / tps)
+        return sanic_json({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(words)},
+                "finish_reason": "stop",
+            }],
+            "usage": _usage(messages, tokens),
+        })
+
+    include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+    async def stream(response):
+        def chunk(delta, finish_reason=None):
+            return "data: " + json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }, ensure_ascii=False) + "\n\n"
+
+        async def finish(finish_reason, completion_tokens):
+            await response.write(chunk({}, finish_reason))
+            if include_usage:
+                await response.write("data: " + json.dumps({
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [],
+                    "usage": _usage(messages, completion_tokens),
+                }) + "\n\n")
+            await response.write("data: [DONE]\n\n")
+
+        if call_tool:
+            # 与真实上游一致：工具调用以 delta.tool_calls 片段流式返回，首个片段带 id 与函数名，
+            # 之后的片段只追加 arguments
+            await asyncio.sleep(_option(request, "tool_delay", float))
+            call = _tool_call(request, body)
+            await response.write(chunk({"role": "assistant", "content": None, "tool_calls": [{
+                "index": 0, "id": call["id"], "type": "function",
+                "function": {"name": call["function"]["name"], "arguments": ""},
+            }]}))
+            for fragment in ("{", "}"):
+                await response.write(chunk({"tool_calls": [{"index": 0, "function": {"arguments": fragment}}]}))
+            await finish("tool_calls", 10)
+            return
+
+        await asyncio.sleep(ttft)
+        await response.write(chunk({"role": "assistant", "content": ""}))
+        interval = 1.0 / tps
+        started = time.perf_counter()
+        for i, word in enumerate(words):
+            # 按目标速率节流，避免 sleep 误差累积
+            delay = started + i * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await response.write(chunk({"content": word}))
+        await finish("stop", tokens)
+
+    return ResponseStream(stream, content_type="text/event-stream; charset=utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的假 LLM 服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft", type=float, default=CONFIG["ttft"], help="首 token 延迟（秒）")
+    parser.add_argument("--tps", type=float, default=CONFIG["tps"], help="每秒输出 token 数")
+    parser.add_argument("--tokens", type=int, default=CONFIG["tokens"], help="每次回复的 token 数")
+    parser.add_argument("--tool-calls", choices=["never", "first", "always"], default=CONFIG["tool_calls"],
+                        help="工具调用行为：never 不调用；first 每轮对话首次调用；always 每次都调用")
+    parser.add_argument("--tool-name", default=CONFIG["tool_name"], help="调用的工具名，默认取 tools 中第一个")
+    parser.add_argument("--tool-delay", type=float, default=CONFIG["tool_delay"], help="返回工具调用前的延迟（秒）")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    CONFIG.update(
+        ttft=args.ttft,
+        tps=args.tps,
+        tokens=args.tokens,
+        tool_calls=args.tool_calls,
+        tool_name=args.tool_name,
+        tool_delay=args.tool_delay,
+    )
+    os.environ["FAKE_OPENAI_CONFIG"] = json.dumps(CONFIG)
+    print(f"[FakeOpenAI] http://{args.host}:{args.port}/v1 {json.dumps(CONFIG, ensure_ascii=False)}")
+    app.run(host=args.host, port=args.port, workers=args.workers, access_log=False, single_process=args.workers == 1)
+
+
+if __name__ == "__main__":
+    main()
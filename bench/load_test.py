@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+后端端到端压测工具
+
+以固定并发驱动 /api/chat/send 与 /api/chat/stream，统计延迟 p50/p95/p99、
+首 token 延迟（TTFT）、tokens/s 与错误数，并把结果写入 JSON 便于跨提交对比。
+
+用法:
+  python load_test.py --concurrency 20 --requests 200 --endpoint both --output results.json
+  python load_test.py --concurrency 20 --duration 60 --compare baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+# 分位数算法与后端指标共用 backend/metrics.py（无第三方依赖）
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from metrics import nearest_rank  # noqa: E402
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """最近秩法百分位：第 ceil(pct% * n) 个值"""
+    if not values:
+        return None
+    return nearest_rank(sorted(values), pct / 100)
+
+
+def _ms(value: Optional[float]) -> Optional[float]:
+    return round(value * 1000, 2) if value is not None else None
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+class Sample:
+    __slots__ = ("ok", "latency", "ttft", "tokens", "error")
+
+    def __init__(self):
+        self.ok = False
+        self.latency = 0.0
+        self.ttft: Optional[float] = None
+        self.tokens = 0
+        self.error: Optional[str] = None
+
+
+async def run_send(client: httpx.AsyncClient, payload: Dict[str, Any]) -> Sample:
+    sample = Sample()
+    started = time.perf_counter()
+    try:
+        response = await client.post("/chat/send", json=payload)
+        sample.latency = time.perf_counter() - started
+        body = response.json()
+        if response.status_code != 200 or not body.get("success"):
+            sample.error = f"HTTP {response.status_code}: {body.get('message')}"
+        else:
+            data = body.get("data") or {}
+            usage = data.get("usage") or {}
+            sample.tokens = usage.get("completion_tokens") or 0
+            sample.ok = True
+    except Exception as e:
+        sample.latency = time.perf_counter() - started
+        sample.error = f"{type(e).__name__}: {e}"
+    return sample
+
+
+async def run_stream(client: httpx.AsyncClient, payload: Dict[str, Any]) -> Sample:
+    sample = Sample()
+    started = time.perf_counter()
+    try:
+        async with client.stream("POST", "/chat/stream", json=payload) as response:
+            if response.status_code != 200:
+                sample.error = f"HTTP {response.status_code}"
+            event = ""
+            usage_tokens = None
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                    continue
+                if not line.startswith("data:"):
+                    if not line:
+                        event = ""
+                    continue
+                data = line[5:].strip()
+                if event == "usage":
+                    # 后端在 [DONE] 前发送的具名 usage 事件
+                    try:
+                        usage_tokens = json.loads(data).get("completion_tokens")
+                    except ValueError:
+                        pass
+                    continue
+                if data == "[DONE]":
+                    sample.ok = sample.error is None
+                    break
+                if data.startswith("[ERROR]"):
+                    sample.error = data
+                    break
+                # <mcp> 为工具调用进度事件，不计入模型输出
+                if not data or data.startswith("<mcp>"):
+                    continue
+                if sample.ttft is None:
+                    sample.ttft = time.perf_counter() - started
+                sample.tokens += 1
+        if usage_tokens:
+            sample.tokens = usage_tokens
+        sample.latency = time.perf_counter() - started
+    except Exception as e:
+        sample.latency = time.perf_counter() - started
+        sample.error = f"{type(e).__name__}: {e}"
+    return sample
+
+
+def summarize(samples: List[Sample], wall_time: float) -> Dict[str, Any]:
+    ok = [s for s in samples if s.ok]
+    latencies = [s.latency for s in ok]
+    ttfts = [s.ttft for s in ok if s.ttft is not None]
+    per_request_tps = [
+        s.tokens / (s.latency - s.ttft)
+        for s in ok
+        if s.ttft is not None and s.latency > s.ttft and s.tokens > 1
+    ]
+    errors: Dict[str, int] = {}
+    for s in samples:
+        if s.error:
+            errors[s.error[:120]] = errors.get(s.error[:120], 0) + 1
+    total_tokens = sum(s.tokens for s in ok)
+    return {
+        "requests": len(samples),
+        "ok": len(ok),
+        "errors": len(samples) - len(ok),
+        "error_samples": errors,
+        "wall_time_s": round(wall_time, 3),
+        "rps": round(len(ok) / wall_time, 2) if wall_time else 0,
+        "latency_ms": {f"p{p}": _ms(percentile(latencies, p)) for p in (50, 95, 99)},
+        "ttft_ms": {f"p{p}": _ms(percentile(ttfts, p)) for p in (50, 95, 99)},
+        "tokens_per_s": {
+            "per_request_p50": round(percentile(per_request_tps, 50), 2) if per_request_tps else None,
+            "aggregate": round(total_tokens / wall_time, 2) if wall_time else 0,
+        },
+        "tokens_total": total_tokens,
+    }
+
+
+async def drive(endpoint: str, args, payload: Dict[str, Any]) -> Dict[str, Any]:
+    runner = run_stream if endpoint == "stream" else run_send
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    samples: List[Sample] = []
+    issued = 0
+    deadline = time.perf_counter() + args.duration if args.duration else None
+
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        async def worker():
+            nonlocal issued
+            while True:
+                if deadline is not None:
+                    if time.perf_counter() >= deadline:
+                        return
+                elif issued >= args.requests:
+                    return
+                issued += 1
+                samples.append(await runner(client, payload))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        wall_time = time.perf_counter() - started
+
+    return summarize(samples, wall_time)
+
+
+async def ensure_agent(args) -> int:
+    if args.agent_id:
+        return args.agent_id
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=30) as client:
+        response = await client.get("/agents", params={"fields": "id,name"})
+        for agent in response.json().get("data") or []:
+            if agent["name"] == args.agent_name:
+                return agent["id"]
+        response = await client.post("/agents", json={
+            "name": args.agent_name,
+            "description": "压测用 Agent",
+            "prompt": "你是一个压测助手。",
+            "mcp_tools": args.mcp_tools,
+            "openai_config": {"model": args.model},
+        })
+        body = response.json()
+        if not body.get("success"):
+            raise SystemExit(f"创建压测 Agent 失败: {body.get('message')}")
+        return body["data"]["id"]
+
+
+def compare(current: Dict[str, Any], baseline_path: str) -> None:
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\n对比基线 {baseline_path}（{baseline['meta'].get('git_commit')} -> {current['meta'].get('git_commit')}）")
+    for endpoint, result in current["results"].items():
+        base = baseline.get("results", {}).get(endpoint)
+        if not base:
+            continue
+        print(f"[{endpoint}]")
+        rows = [
+            ("latency p50", base["latency_ms"]["p50"], result["latency_ms"]["p50"]),
+            ("latency p95", base["latency_ms"]["p95"], result["latency_ms"]["p95"]),
+            ("latency p99", base["latency_ms"]["p99"], result["latency_ms"]["p99"]),
+            ("ttft p50", base["ttft_ms"]["p50"], result["ttft_ms"]["p50"]),
+            ("ttft p95", base["ttft_ms"]["p95"], result["ttft_ms"]["p95"]),
+            ("rps", base["rps"], result["rps"]),
+            ("tokens/s", base["tokens_per_s"]["aggregate"], result["tokens_per_s"]["aggregate"]),
+            ("errors", base["errors"], result["errors"]),
+        ]
+        for name, old, new in rows:
+            if old is None or new is None:
+                continue
+            delta = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"  {name:<12} {old:>10} -> {new:<10} {delta}")
+
+
+async def main_async(args) -> Dict[str, Any]:
+    agent_id = await ensure_agent(args)
+    payload = {"agent_id": agent_id, "messages": [{"role": "user", "content": args.message}]}
+    endpoints = ["send", "stream"] if args.endpoint == "both" else [args.endpoint]
+    results = {}
+    for endpoint in endpoints:
+        print(f"压测 /chat/{endpoint}: 并发 {args.concurrency}，"
+              + (f"持续 {args.duration}s" if args.duration else f"{args.requests} 个请求"))
+        results[endpoint] = await drive(endpoint, args, payload)
+        print(json.dumps(results[endpoint], ensure_ascii=False, indent=2))
+    return {
+        "meta": {
+            "git_commit": git_commit(),
+            "label": args.label,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "base_url": args.base_url,
+            "agent_id": agent_id,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "duration": args.duration,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI Agents 后端压测")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8001/api")
+    parser.add_argument("--endpoint", choices=["send", "stream", "both"], default="both")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=100, help="每个接口的请求总数（未设置 --duration 时生效）")
+    parser.add_argument("--duration", type=float, default=0, help="每个接口的持续压测时间（秒）")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--agent-id", type=int, default=0, help="已有 Agent ID，不指定时自动创建压测 Agent")
+    parser.add_argument("--agent-name", default="bench-agent")
+    parser.add_argument("--mcp-tools", nargs="*", default=["time_server_get_current_time"],
+                        help="自动创建 Agent 时绑定的 MCP 工具（传空可压测纯对话）")
+    parser.add_argument("--model", default="fake-model")
+    parser.add_argument("--message", default="现在几点了？")
+    parser.add_argument("--label", default="")
+    parser.add_argument("--output", default="", help="结果 JSON 输出路径")
+    parser.add_argument("--compare", default="", help="与之前的结果 JSON 对比")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+    failed = sum(r["errors"] for r in report["results"].values())
+    sys.exit(1 if failed and failed == sum(r["requests"] for r in report["results"].values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+重放录制会话中的入站请求
+
+后端以 RECORD_MODE=record 运行时会把 /api/chat/* 请求与上游流量一起写入录制文件。
+离线对比时，以 RECORD_MODE=replay 启动新版本后端（不访问网络），再用本脚本按录制
+时的到达间隔（可缩放）重新发起这些请求，输出与 load_test.py 相同格式的统计结果。
+
+用法:
+  python replay_session.py ../backend/recordings/session-*.jsonl --output replay.json
+  python replay_session.py ../backend/recordings/*.jsonl --time-scale 0 --compare replay-old.json
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+import httpx
+
+from load_test import compare, git_commit, run_send, run_stream, summarize
+
+
+def load_inbound(paths: List[str]) -> List[Dict[str, Any]]:
+    """读取录制文件中的入站请求，按录制时间排序"""
+    entries = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry.get("kind") == "inbound":
+                    entries.append(entry)
+    entries.sort(key=lambda e: e.get("t", 0))
+    return entries
+
+
+async def replay(args) -> Dict[str, Any]:
+    entries = load_inbound(args.files)
+    if not entries:
+        raise SystemExit("录制文件中没有入站请求")
+    print(f"重放 {len(entries)} 个请求，时间倍率 {args.time_scale}")
+
+    base_t = entries[0].get("t", 0)
+    samples: Dict[str, list] = {"send": [], "stream": []}
+    semaphore = asyncio.Semaphore(args.concurrency) if args.concurrency else None
+
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout) as client:
+        async def issue(entry):
+            # 按录制时的到达间隔发起请求
+            delay = (entry.get("t", 0) - base_t) / 1000 * args.time_scale
+            if delay > 0:
+                await asyncio.sleep(delay)
+            runner = run_stream if entry["endpoint"] == "stream" else run_send
+            if semaphore is None:
+                sample = await runner(client, entry["body"])
+            else:
+                async with semaphore:
+                    sample = await runner(client, entry["body"])
+            samples[entry["endpoint"]].append(sample)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(issue(e) for e in entries))
+        wall_time = time.perf_counter() - started
+
+    results = {endpoint: summarize(items, wall_time) for endpoint, items in samples.items() if items}
+    for endpoint, result in results.items():
+        print(f"[{endpoint}]")
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    return {
+        "meta": {
+            "git_commit": git_commit(),
+            "label": args.label,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "base_url": args.base_url,
+            "recordings": args.files,
+            "time_scale": args.time_scale,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重放录制会话中的入站请求")
+    parser.add_argument("files", nargs="+", help="录制文件（JSONL）")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8001/api")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="到达间隔倍率，0 表示全部立即发起")
+    parser.add_argument("--concurrency", type=int, default=0, help="最大并发，0 表示不限制")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--label", default="")
+    parser.add_argument("--output", default="", help="结果 JSON 输出路径")
+    parser.add_argument("--compare", default="", help="与之前的结果 JSON 对比")
+    args = parser.parse_args()
+
+    report = asyncio.run(replay(args))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
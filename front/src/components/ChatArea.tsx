@@ -4,10 +4,14 @@ import { SendOutlined, UserOutlined, RobotOutlined } from '@ant-design/icons';
 import { useAppStore } from '../store';
 import { chatApi } from '../services/api';
 import { API_BASE_URL } from '../services/api';
+import { chatSocket, ChatSocketUnavailable } from '../services/chatSocket';
 
 const { Title, Text } = Typography;
 const { TextArea } = Input;
 
+// 流式回复中断后的续传次数
+const STREAM_RESUME_RETRIES = 3;
+
 // 渲染带有思考标记和 MCP 工具调用的消息内容
 const renderMessageContent = (content: string) => {
   // 先处理 <think>...</think> 和 <mcp>...</mcp> 标记
@@ -101,7 +105,8 @@ const ChatArea: React.FC = () => {
     try {
       // 2) 组装历史消息（不包括系统提示词，后端会加）
       const history = useAppStore.getState().currentSession?.messages.map(m => ({ role: m.role, content: m.content })) || [];
-      const payload = { agent_id: currentAgent.id, messages: history };
+      // session_id 用于后端按会话累计 token 用量
+      const payload = { agent_id: currentAgent.id, messages: history, session_id: currentSession.id };
 
       // 3) 先插入一个空的 assistant 占位消息，用于流式增量更新
       const replyId = `reply-${Date.now()}`;
@@ -113,7 +118,31 @@ const ChatArea: React.FC = () => {
         created_at: new Date().toISOString(),
       });
 
-      // 4) 优先尝试流式
+      let received = false;
+      const appendText = (text: string) => {
+        if (!received) {
+          // 第一次收到内容时，清空占位“思考中...”
+          updateMessage(currentSession.id, replyId, { content: '' });
+        }
+        appendToMessage(currentSession.id, replyId, text);
+        received = true;
+        scrollToBottom();
+      };
+
+      // 4) 优先通过 WebSocket 在同一连接上复用流式对话，不可用时回退到 HTTP SSE
+      try {
+        await chatSocket.stream(payload, { onChunk: data => { const text = data.trim(); if (text !== '') appendText(text); } });
+        if (!received) updateMessage(currentSession.id, replyId, { content: '[空响应]' });
+        return;
+      } catch (wsErr: any) {
+        if (!(wsErr instanceof ChatSocketUnavailable) || received) {
+          // 服务端错误或中途断开：与 SSE 的 [ERROR] 一样附加在已收到的内容后
+          appendText(`[ERROR] ${wsErr?.message || '流式生成失败'}`);
+          return;
+        }
+      }
+
+      // 5) 回退：HTTP 流式
       const resp = await fetch(`${API_BASE_URL}/chat/stream`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
@@ -130,71 +159,92 @@ const ChatArea: React.FC = () => {
         return;
       }
 
-      // 5) 读取 SSE data: 流，边到边渲染
-      const reader = resp.body.getReader();
+      // 6) 读取 SSE data: 流，边到边渲染；连接中断时带 Last-Event-ID 续传（后端不会重新生成）
       const decoder = new TextDecoder('utf-8');
-      let buffer = '';
-      let received = false;
+      let lastEventId = '';
+      let finished = false;
+      let stream: ReadableStream<Uint8Array> = resp.body;
 
-      while (true) {
-        const { value, done } = await reader.read();
-        if (done) break;
-        buffer += decoder.decode(value, { stream: true });
+      for (let attempt = 0; ; attempt++) {
+        const reader = stream.getReader();
+        let buffer = '';
+        try {
+          while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
 
-        let idx;
-        while (true) {
-          idx = buffer.indexOf('\n\n');
-          let sepLen = 2;
-          if (idx === -1) {
-            idx = buffer.indexOf('\r\n\r\n');
-            sepLen = idx === -1 ? -1 : 4;
-          }
-          if (idx === -1) break;
-          const raw = buffer.slice(0, idx).trim();
-          buffer = buffer.slice(idx + sepLen);
-          if (!raw.startsWith('data:')) continue;
-          // 有些实现会在一个事件块里包含多行 data: 或者拼接多个 data:
-          const segments = raw
-            .split(/\r?\n+/)               // 先按换行拆分
-            .flatMap(l => l.split(/(?=data:\s*)/)) // 再按 data: 边界切分
-            .map(s => s.replace(/^data:\s*/, '').trim())
-            .filter(s => s.length > 0);
+            let idx;
+            while (true) {
+              idx = buffer.indexOf('\n\n');
+              let sepLen = 2;
+              if (idx === -1) {
+                idx = buffer.indexOf('\r\n\r\n');
+                sepLen = idx === -1 ? -1 : 4;
+              }
+              if (idx === -1) break;
+              let raw = buffer.slice(0, idx).trim();
+              buffer = buffer.slice(idx + sepLen);
+              // 事件头：id: 记录续传位置，event: 为具名事件（如 usage），不作为文本渲染
+              let named = false;
+              while (/^(id|event):/.test(raw)) {
+                const nl = raw.indexOf('\n');
+                const line = (nl === -1 ? raw : raw.slice(0, nl)).trim();
+                if (line.startsWith('id:')) lastEventId = line.slice(3).trim();
+                else named = true;
+                raw = nl === -1 ? '' : raw.slice(nl + 1);
+              }
+              if (named || !raw.startsWith('data:')) continue;
+              // 有些实现会在一个事件块里包含多行 data: 或者拼接多个 data:
+              const segments = raw
+                .split(/\r?\n+/)               // 先按换行拆分
+                .flatMap(l => l.split(/(?=data:\s*)/)) // 再按 data: 边界切分
+                .map(s => s.replace(/^data:\s*/, '').trim())
+                .filter(s => s.length > 0);
 
-          let done = false;
-          for (const seg of segments) {
-            if (seg === '[DONE]') { done = true; break; }
+              let done = false;
+              for (const seg of segments) {
+                if (seg === '[DONE]') { done = true; break; }
+                if (seg.startsWith('[ERROR]')) finished = true;
 
-            // 解析 OpenAI chunk JSON，提取 choices[0].delta.content
-            let text = '';
-            try {
-              const j = JSON.parse(seg);
-              text = j?.choices?.[0]?.delta?.content ?? '';
-              if (!text && j?.choices?.[0]?.message?.content) {
-                text = j.choices[0].message.content;
-              }
-            } catch {
-              // 非 JSON（例如后端直接推送纯文本增量），直接当作文本
-              text = seg;
-            }
+                // 解析 OpenAI chunk JSON，提取 choices[0].delta.content
+                let text = '';
+                try {
+                  const j = JSON.parse(seg);
+                  text = j?.choices?.[0]?.delta?.content ?? '';
+                  if (!text && j?.choices?.[0]?.message?.content) {
+                    text = j.choices[0].message.content;
+                  }
+                } catch {
+                  // 非 JSON（例如后端直接推送纯文本增量），直接当作文本
+                  text = seg;
+                }
 
-            // 过滤思考标记，但保留空格和其他内容
-            if (text !== undefined && text !== null) {
-              // 保留所有内容，包括 <think> 标签，不做任何过滤
+                // 过滤思考标记，但保留空格和其他内容
+                if (text !== undefined && text !== null) {
+                  // 保留所有内容，包括 <think> 标签，不做任何过滤
 
-              // 即使是空格也要保留，只过滤掉纯标签内容
-              if (text !== '') {
-                if (!received) {
-                  // 第一次收到内容时，清空占位“思考中...”
-                  updateMessage(currentSession.id, replyId, { content: '' });
+                  // 即使是空格也要保留，只过滤掉纯标签内容
+                  if (text !== '') appendText(text);
                 }
-                appendToMessage(currentSession.id, replyId, text);
-                received = true;
-                scrollToBottom();
               }
+              if (done) { finished = true; break; }
             }
           }
-          if (done) break;
+        } catch (readErr) {
+          // 网络中断：有续传位置时重连，否则按原错误处理
+          if (!lastEventId || attempt >= STREAM_RESUME_RETRIES) throw readErr;
         }
+
+        if (finished || !lastEventId || attempt >= STREAM_RESUME_RETRIES) break;
+        await new Promise(r => setTimeout(r, 500 * (attempt + 1)));
+        const resumed = await fetch(`${API_BASE_URL}/chat/stream`, {
+          method: 'POST',
+          headers: { 'Last-Event-ID': lastEventId }
+        });
+        // 流已过期或缓冲已溢出：保留已收到的内容，不再续传
+        if (!resumed.ok || !resumed.body) break;
+        stream = resumed.body;
       }
 
       // 若未收到任何片段，给一个兜底文案
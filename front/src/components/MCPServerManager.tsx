@@ -1,5 +1,5 @@
 import { useState, useEffect } from 'react';
-import { Button, List, Avatar, Popconfirm, message, Modal, Form, Input, Switch } from 'antd';
+import { Button, List, Avatar, Popconfirm, message, Modal, Form, Input, Switch, Tag, Tooltip } from 'antd';
 import { PlusOutlined, CloudServerOutlined, DeleteOutlined, EditOutlined } from '@ant-design/icons';
 import { mcpApi } from '../services/api';
 import { THEME } from '../theme';
@@ -159,6 +159,13 @@ const MCPServerManager: React.FC<MCPServerManagerProps> = ({ onServersChange })
                         checked={server.is_active}
                         onChange={(checked) => handleToggleActive(server, checked)}
                       />
+                      {server.breaker && server.breaker.state !== 'closed' && (
+                        <Tooltip title={server.breaker.last_error || undefined}>
+                          <Tag color={server.breaker.state === 'open' ? 'red' : 'orange'}>
+                            {server.breaker.state === 'open' ? '已熔断' : '探测恢复中'}
+                          </Tag>
+                        </Tooltip>
+                      )}
                     </div>
                   }
                   description={
@@ -251,9 +258,9 @@ const MCPServerManager: React.FC<MCPServerManagerProps> = ({ onServersChange })
             label={<span style={{ fontWeight: 600 }}>API 地址</span>}
             rules={[
               { required: true, message: '请输入 API 地址' },
-              { pattern: /^https?:\/\//i, message: '仅支持以 http:// 或 https:// 开头的 MCP HTTP 接口' }
+              { pattern: /^(https?|stdio):\/\//i, message: '仅支持以 http://、https:// 或 stdio:// 开头的 MCP 服务器地址' }
             ]}
-            tooltip="请输入 MCP HTTP(S) 接口，例如：http://host:port/mcp"
+            tooltip="MCP HTTP(S) 接口，例如 http://host:port/mcp；或 stdio:// 启动命令（需管理员令牌），例如 stdio://python mcp_example/time_server.py stdio"
           >
             <Input
               placeholder="例如：http://localhost:9090/mcp"
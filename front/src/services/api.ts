@@ -75,6 +75,7 @@ export const chatApi = {
   sendMessage: async (data: {
     agent_id: number;
     messages: Array<{ role: string; content: string }>;
+    session_id?: string;
   }) => {
     const response = await api.post('/chat/send', data);
     return response.data;
@@ -84,6 +85,7 @@ export const chatApi = {
   sendMessageStream: async (data: {
     agent_id: number;
     messages: Array<{ role: string; content: string }>;
+    session_id?: string;
   }) => {
     const response = await api.post('/chat/stream', data);
     return response.data;
@@ -0,0 +1,119 @@
+import { API_BASE_URL } from './api';
+
+// 对话 WebSocket：一个连接上按 stream_id 复用多个流式对话（协议见 backend/ws_chat.py）
+const WS_URL = `${API_BASE_URL.replace(/^http/, 'ws')}/chat/ws`;
+
+// 每个流的初始额度；每消费一半就补充一半，保持服务端持续推送
+const INITIAL_CREDITS = 64;
+const CREDIT_BATCH = INITIAL_CREDITS / 2;
+
+interface Frame {
+  type: string;
+  stream_id?: string;
+  seq?: number;
+  data?: string;
+  usage?: any;
+  error?: string;
+  trace_id?: string;
+}
+
+export interface ChatStreamHandlers {
+  onChunk: (data: string) => void;
+  onUsage?: (usage: any) => void;
+}
+
+// WebSocket 不可用（连接失败或中途断开），调用方可回退到 HTTP SSE
+export class ChatSocketUnavailable extends Error {}
+
+interface PendingStream {
+  handlers: ChatStreamHandlers;
+  received: number;
+  resolve: () => void;
+  reject: (err: Error) => void;
+}
+
+class ChatSocket {
+  private ws: WebSocket | null = null;
+  private opening: Promise<WebSocket> | null = null;
+  private streams = new Map<string, PendingStream>();
+  private counter = 0;
+
+  private connect(): Promise<WebSocket> {
+    if (this.ws && this.ws.readyState === WebSocket.OPEN) return Promise.resolve(this.ws);
+    if (!this.opening) {
+      this.opening = new Promise((resolve, reject) => {
+        const ws = new WebSocket(WS_URL);
+        ws.onopen = () => {
+          this.ws = ws;
+          this.opening = null;
+          resolve(ws);
+        };
+        ws.onerror = () => {
+          this.opening = null;
+          reject(new ChatSocketUnavailable('WebSocket 连接失败'));
+        };
+        ws.onclose = () => {
+          this.ws = null;
+          this.opening = null;
+          // 连接断开时结束其上所有流
+          this.streams.forEach(s => s.reject(new ChatSocketUnavailable('WebSocket 连接已断开')));
+          this.streams.clear();
+        };
+        ws.onmessage = (ev) => {
+          try {
+            this.onFrame(JSON.parse(ev.data));
+          } catch {
+            // 忽略无法解析的帧
+          }
+        };
+      });
+    }
+    return this.opening;
+  }
+
+  private send(frame: Record<string, any>) {
+    if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+      this.ws.send(JSON.stringify(frame));
+    }
+  }
+
+  private onFrame(frame: Frame) {
+    const id = frame.stream_id;
+    const stream = id ? this.streams.get(id) : undefined;
+    if (!id || !stream) return;
+    switch (frame.type) {
+      case 'chunk':
+        stream.handlers.onChunk(frame.data ?? '');
+        stream.received += 1;
+        if (stream.received % CREDIT_BATCH === 0) {
+          this.send({ type: 'credit', stream_id: id, credits: CREDIT_BATCH });
+        }
+        break;
+      case 'usage':
+        stream.handlers.onUsage?.(frame.usage);
+        break;
+      case 'done':
+      case 'cancelled':
+        this.streams.delete(id);
+        stream.resolve();
+        break;
+      case 'error':
+        this.streams.delete(id);
+        stream.reject(new Error(frame.error || '流式生成失败'));
+        break;
+    }
+  }
+
+  // 发起一个流式对话，done/cancelled 时完成，error 时以服务端错误失败；signal 中止时发送 cancel
+  async stream(payload: Record<string, any>, handlers: ChatStreamHandlers, signal?: AbortSignal): Promise<void> {
+    const ws = await this.connect();
+    const id = `s${Date.now()}-${++this.counter}`;
+    return new Promise<void>((resolve, reject) => {
+      this.streams.set(id, { handlers, received: 0, resolve, reject });
+      ws.send(JSON.stringify({ type: 'start', stream_id: id, credits: INITIAL_CREDITS, ...payload }));
+      signal?.addEventListener('abort', () => this.send({ type: 'cancel', stream_id: id }));
+    });
+  }
+}
+
+export const chatSocket = new ChatSocket();
@@ -30,6 +30,14 @@ export interface ChatMessage {
 }
 
 // MCP 服务器类型定义
+export interface MCPBreakerState {
+  state: 'closed' | 'open' | 'half_open';
+  failure_threshold: number;
+  reset_timeout: number;
+  opened_at: number | null;
+  last_error: string | null;
+}
+
 export interface MCPServer {
   id: number;
   name: string;
@@ -38,4 +46,5 @@ export interface MCPServer {
   is_active: boolean;
   created_at: string;
   updated_at: string;
+  breaker?: MCPBreakerState;
 }
@@ -84,7 +84,7 @@ def main():
     """主函数 - 启动 MCP 服务器
     用法:
       python time_server.py sse [port]    # 启动 HTTP(S)+SSE 服务器，默认端口 9090
-      python time_server.py stdio         # 启动 stdio 服务器（仅用于本地调试）
+      python time_server.py stdio         # 启动 stdio 服务器（后端以 stdio:// 地址常驻调用）
     """
     transport = "stdio"
     if len(sys.argv) > 1:
@@ -119,8 +119,8 @@ def main():
             print(f"无法启动 MCP 服务器: {e}", file=sys.stderr)
             sys.exit(1)
     else:
-        # 本地调试：stdio
-        print("[MCP] Starting stdio server...")
-        pass
+        # stdio：stdout 是协议通道，提示信息只能写到 stderr
+        print("[MCP] Starting stdio server...", file=sys.stderr)
+        mcp.run(transport="stdio")
 if __name__ == "__main__":
     main()